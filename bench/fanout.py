@@ -0,0 +1,123 @@
+"""
+测量同一 token 的多个连接下单条文本消息的分发耗时
+
+用法：
+    python bench/fanout.py [main.py 路径] [标签]
+
+使用假的 WebSocket（不需要 Redis），分别在发送立即完成和每次发送耗时 1 毫秒
+两种情况下，对 1 / 10 / 100 个连接连续推送消息，直到所有连接都收到全部消息，
+输出平均每条消息的耗时。可以传入旧版本的 main.py 做前后对比，例如：
+
+    git show 8e72f36^:main.py > /tmp/main_before.py
+    python bench/fanout.py /tmp/main_before.py before
+    python bench/fanout.py main.py after
+"""
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOCKET_COUNTS = (1, 10, 100)
+WINDOW = 64  # 带发送队列的版本最多允许积压的消息数（低于 OUTBOUND_QUEUE_MAX_ITEMS，避免丢弃）
+MESSAGE = {"title": "测试", "content": "hello" * 40, "priority": 2, "timestamp": "2026-10-16T12:00:00"}
+
+
+class DeliveryTracker:
+    """统计已被所有连接收到的消息数"""
+
+    def __init__(self, sockets: int):
+        self.sockets = sockets
+        self.counts: dict = {}
+        self.complete = 0
+        self.changed = asyncio.Event()
+
+    def received(self, index: int):
+        count = self.counts[index] = self.counts.get(index, 0) + 1
+        if count == self.sockets:
+            del self.counts[index]
+            self.complete += 1
+            self.changed.set()
+
+    async def wait_until(self, complete: int):
+        while self.complete < complete:
+            self.changed.clear()
+            await self.changed.wait()
+
+
+class FakeWebSocket:
+    """只计数的 WebSocket，send_* 按指定延迟模拟网络写入"""
+
+    def __init__(self, tracker: DeliveryTracker, delay: float):
+        self.tracker = tracker
+        self.delay = delay
+        self.received = 0
+        self.client = None
+
+    async def accept(self, *args, **kwargs):
+        pass
+
+    async def send_json(self, data, *args, **kwargs):
+        await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+    async def send_text(self, text):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.tracker.received(self.received)
+        self.received += 1
+
+    async def send_bytes(self, data):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+    async def close(self, code=1000, reason=""):
+        pass
+
+
+def load_main(path: str):
+    spec = importlib.util.spec_from_file_location("bench_main", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def measure(main, sockets: int, delay: float, rounds: int) -> float:
+    manager = main.ConnectionManager()
+    client_token = f"bench-{sockets}-{delay}"
+    tracker = DeliveryTracker(sockets)
+    websockets = [FakeWebSocket(tracker, delay) for _ in range(sockets)]
+    for websocket in websockets:
+        await manager.connect(client_token, websocket)
+    await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    for sent in range(1, rounds + 1):
+        await manager.send_message(client_token, dict(MESSAGE))
+        await tracker.wait_until(sent - WINDOW + 1)
+    # 带发送队列的版本在后台写出，等待所有连接收到全部消息
+    await tracker.wait_until(rounds)
+    elapsed = time.perf_counter() - started
+
+    for websocket in websockets:
+        manager.disconnect(client_token, websocket)
+    await asyncio.sleep(0.05)
+    return elapsed / rounds * 1000
+
+
+async def run(path: str, label: str):
+    main = load_main(path)
+    main.logger.disabled = True
+    logging.disable(logging.CRITICAL)
+    for sockets in SOCKET_COUNTS:
+        for delay, name in ((0, "instant"), (0.001, "1ms")):
+            rounds = 200 if delay else 2000
+            per_message = await measure(main, sockets, delay, rounds)
+            print(f"{label:8} sockets={sockets:3} {name:8} {per_message:8.3f} ms/message")
+
+
+if __name__ == "__main__":
+    target = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, "main.py")
+    asyncio.run(run(target, sys.argv[2] if len(sys.argv) > 2 else "main"))
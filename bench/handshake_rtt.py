@@ -0,0 +1,126 @@
+"""
+统计每次 WebSocket 连接产生的 Redis 往返次数与命令数
+
+用法：
+    python bench/handshake_rtt.py [main.py 路径] [模拟往返延迟(毫秒)]
+
+默认加载仓库中的 main.py，使用 fakeredis（需安装 fakeredis 与 lupa）。
+可以传入旧版本的 main.py 做前后对比，例如：
+
+    git show be4f0f2^:main.py > /tmp/main_before.py
+    python bench/handshake_rtt.py /tmp/main_before.py 1
+    python bench/handshake_rtt.py main.py 1
+
+每个 Redis 往返会额外等待指定的延迟，用来近似跨机房部署时的握手耗时。
+统计的是客户端发出的命令，Lua 脚本在服务端执行的命令不计入。
+"""
+import asyncio
+import base64
+import importlib.util
+import logging
+import os
+import sys
+import time
+
+import fakeredis
+import redis.asyncio.client as redis_client_module
+from fastapi.testclient import TestClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONNECTS = 200  # 每轮连接次数
+
+
+class RedisCounter:
+    """替换 redis-py 的命令执行入口，统计往返次数与命令数"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.round_trips = 0
+        self.commands = 0
+        self.by_command = {}
+
+    def install(self):
+        counter = self
+        execute_command = redis_client_module.Redis.execute_command
+        execute_pipeline = redis_client_module.Pipeline._execute_pipeline
+        execute_transaction = redis_client_module.Pipeline._execute_transaction
+
+        async def counted_command(client, *args, **options):
+            await counter.record([args])
+            return await execute_command(client, *args, **options)
+
+        async def counted_pipeline(pipe, connection, commands, raise_on_error):
+            await counter.record([cmd.args if hasattr(cmd, "args") else cmd[0] for cmd in commands])
+            return await execute_pipeline(pipe, connection, commands, raise_on_error)
+
+        async def counted_transaction(pipe, connection, commands, raise_on_error):
+            await counter.record([cmd.args if hasattr(cmd, "args") else cmd[0] for cmd in commands])
+            return await execute_transaction(pipe, connection, commands, raise_on_error)
+
+        redis_client_module.Redis.execute_command = counted_command
+        redis_client_module.Pipeline._execute_pipeline = counted_pipeline
+        redis_client_module.Pipeline._execute_transaction = counted_transaction
+
+    async def record(self, commands):
+        self.round_trips += 1
+        self.commands += len(commands)
+        for args in commands:
+            name = str(args[0]).upper()
+            self.by_command[name] = self.by_command.get(name, 0) + 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+    def reset(self):
+        self.round_trips = 0
+        self.commands = 0
+        self.by_command = {}
+
+
+def load_main(path: str):
+    spec = importlib.util.spec_from_file_location("bench_main", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run(path: str, delay: float):
+    main = load_main(path)
+    main.logger.disabled = True
+    logging.disable(logging.CRITICAL)
+
+    server = fakeredis.FakeServer()
+
+    async def from_url(url, **kwargs):
+        return fakeredis.FakeAsyncRedis(server=server, **kwargs)
+
+    main.redis.from_url = from_url
+    counter = RedisCounter(delay)
+    counter.install()
+    headers = {"X-Forwarded-For": "192.168.1.10"}
+
+    def connect_all(prefix: str):
+        counter.reset()
+        started = time.perf_counter()
+        for i in range(CONNECTS):
+            with client.websocket_connect(f"/stream?token={prefix}-device-{i:04d}", headers=headers):
+                pass
+        elapsed = time.perf_counter() - started
+        # 等待断开后的后台任务完成
+        time.sleep(0.2 + delay * 4)
+        return elapsed, counter.round_trips, counter.commands, dict(counter.by_command)
+
+    with TestClient(main.app) as client:
+        connect_all("warmup")
+        for label, prefix in (("新设备", "new"), ("重连", "new")):
+            elapsed, round_trips, commands, by_command = connect_all(prefix)
+            detail = ", ".join(f"{name}={count / CONNECTS:g}" for name, count in sorted(by_command.items()))
+            print(
+                f"{label}: 每次连接 {round_trips / CONNECTS:.2f} 次往返, {commands / CONNECTS:.2f} 条命令, "
+                f"平均 {elapsed / CONNECTS * 1000:.2f} ms  [{detail}]"
+            )
+
+
+if __name__ == "__main__":
+    target = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, "main.py")
+    rtt_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    run(target, rtt_ms / 1000)
@@ -0,0 +1,63 @@
+"""
+测量 log_event 每次调用的开销
+
+用法：
+    python bench/log_event.py [main.py 路径] [标签]
+
+关闭标准日志输出后在事件循环中连续调用 log_event，分别输出：
+- 调用方耗时：log_event 本身返回前花费的时间
+- 总耗时：包括日志真正进入环形缓冲区（旧版本由每次调用创建的任务异步写入）
+可以传入旧版本的 main.py 做前后对比，例如：
+
+    git show f9103d0^:main.py > /tmp/main_before.py
+    python bench/log_event.py /tmp/main_before.py before
+    python bench/log_event.py main.py after
+"""
+import asyncio
+import gc
+import importlib.util
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CALLS = 100_000
+ROUNDS = 5
+
+
+def load_main(path: str):
+    spec = importlib.util.spec_from_file_location("bench_main", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def measure(main) -> tuple:
+    """返回 (调用方耗时, 总耗时)，单位微秒/次"""
+    target = main.log_queue.last_seq + CALLS
+    gc.collect()
+    started = time.perf_counter()
+    for i in range(CALLS):
+        main.log_event("INFO", "BINARY", f"📤 开始发送图片: image{i}.png, 大小: 1.2 MB, 分5块", "20261016120000_abcdef")
+    returned = time.perf_counter()
+    # 旧版本的日志由任务异步写入，让出事件循环直到全部写完
+    while main.log_queue.last_seq < target:
+        await asyncio.sleep(0)
+    finished = time.perf_counter()
+    return (returned - started) / CALLS * 1e6, (finished - started) / CALLS * 1e6
+
+
+async def run(path: str, label: str):
+    main = load_main(path)
+    main.logger.disabled = True
+    logging.disable(logging.CRITICAL)
+    results = [await measure(main) for _ in range(ROUNDS)]
+    call_site = min(r[0] for r in results)
+    total = min(r[1] for r in results)
+    print(f"{label:8} 调用方 {call_site:6.2f} us/次, 含写入缓冲区 {total:6.2f} us/次（{CALLS} 次 x {ROUNDS} 轮取最小值）")
+
+
+if __name__ == "__main__":
+    target = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, "main.py")
+    asyncio.run(run(target, sys.argv[2] if len(sys.argv) > 2 else "main"))
@@ -1,5 +1,5 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query, Request, Depends, Cookie, UploadFile, File
-from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
@@ -8,17 +8,43 @@ import base64
 import json
 import asyncio
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Set, Optional
+from typing import Dict, List, Set, Optional
+from collections import OrderedDict, deque
 import logging
 import os
 import re
 import secrets
 import hashlib
+import operator
+import csv
+import ipaddress
+import mmap
+import struct
+import socket
+import time
+import threading
+import fcntl
+import bisect
+import heapq
+import mimetypes
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import Response
+from starlette.requests import ClientDisconnect
+from websockets import frames as ws_frames
+from websockets.exceptions import NegotiationError
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
 import httpx
 import pytz
 
+# Pillow 为可选依赖，未安装时不转码图片
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 # 配置时区为中国时区
 CHINA_TZ = pytz.timezone('Asia/Shanghai')
 
@@ -98,121 +124,1444 @@ app.add_middleware(CustomCORSMiddleware)
 # Redis 连接
 redis_client = None
 
+# 多 worker 消息分发配置
+# local: 仅投递到当前进程持有的连接（单 worker）
+# redis: 通过 Redis pub/sub 将消息分发到所有 worker
+FANOUT_MODE = os.getenv("FANOUT_MODE", "local").lower()
+FANOUT_CHANNEL = os.getenv("FANOUT_CHANNEL", "znhd:fanout")
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+WORKER_HEARTBEAT_INTERVAL = 10  # worker 心跳间隔（秒）
+WORKER_HEARTBEAT_TTL = 30  # 超过该时间未心跳的 worker 视为离线（秒）
+CONNECTIONS_TTL = 24*60*60  # connections:{token} 连接计数过期时间（秒）
+
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))  # 单个连接的发送超时（秒）
+
+# 每个连接的发送队列上限，超出时的处理策略:
+# drop-oldest: 丢弃队列中优先级不高于新消息的最早消息（腾不出空间时丢弃新消息）; drop-newest: 丢弃新消息; disconnect: 断开该连接
+OUTBOUND_QUEUE_MAX_ITEMS = int(os.getenv("OUTBOUND_QUEUE_MAX_ITEMS", "256"))
+OUTBOUND_QUEUE_MAX_BYTES = int(os.getenv("OUTBOUND_QUEUE_MAX_BYTES", str(32 * 1024 * 1024)))
+OUTBOUND_OVERFLOW_POLICY = os.getenv("OUTBOUND_OVERFLOW_POLICY", "drop-oldest").lower()
+OUTBOUND_OVERFLOW_POLICIES = ("drop-oldest", "drop-newest", "disconnect")
+if OUTBOUND_OVERFLOW_POLICY not in OUTBOUND_OVERFLOW_POLICIES:
+    logger.warning(f"未知的 OUTBOUND_OVERFLOW_POLICY={OUTBOUND_OVERFLOW_POLICY}，使用 drop-oldest")
+    OUTBOUND_OVERFLOW_POLICY = "drop-oldest"
+
+# 二进制数据分块：初始块大小，开启自适应时按每个连接实测的发送耗时在上下限之间调整
+BINARY_CHUNK_SIZE = int(os.getenv("BINARY_CHUNK_SIZE", str(64 * 1024)))
+BINARY_CHUNK_ADAPTIVE = os.getenv("BINARY_CHUNK_ADAPTIVE", "true").lower() == "true"
+BINARY_CHUNK_MIN = int(os.getenv("BINARY_CHUNK_MIN", str(16 * 1024)))
+BINARY_CHUNK_MAX = int(os.getenv("BINARY_CHUNK_MAX", str(1024 * 1024)))
+BINARY_CHUNK_TARGET = float(os.getenv("BINARY_CHUNK_TARGET_MS", "50")) / 1000  # 单块目标发送耗时
+STREAM_RELAY_WINDOW = int(os.getenv("STREAM_RELAY_WINDOW", "4"))  # 流式转发时每个传输最多缓存的块数
+# 流式上传需要整体发布给其他 worker 时最多缓存的字节数
+STREAM_REMOTE_MAX_BYTES = int(os.getenv("STREAM_REMOTE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# WebSocket 协议版本（客户端通过 /stream?proto=2 协商，未指定时为 1）
+# v1: binary_start、不带标记的二进制块、binary_end，同一连接上的传输只能串行
+# v2: binary_start/binary_end 带 stream_id，每个二进制块带 12 字节头部，
+#     同一连接上最多 V2_MAX_STREAMS 个传输按块交错发送
+WS_PROTOCOL_VERSION = 2
+V2_MAX_STREAMS = int(os.getenv("V2_MAX_STREAMS", "4"))
+V2_CHUNK_HEADER = struct.Struct("!BBHII")  # 版本 | 标志 | 保留 | stream_id | 块序号（大端）
+V2_FLAG_LAST = 0x01  # 已知为最后一块时置位
+# 每个连接记住的已发送图片哈希数（仅 v2 连接，重复图片改发 binary_ref）
+CLIENT_KNOWN_IMAGES = int(os.getenv("CLIENT_KNOWN_IMAGES", "256"))
+
+# 发送优先级（Message.priority，数值越大越紧急，超出范围的按边界处理）
+# 每个连接按优先级调度：高优先级消息先发送，并可在低优先级传输的二进制块之间插队；
+# 排队每满 PRIORITY_AGING_SECONDS 秒有效优先级提升一级，低优先级消息最多等待
+# (PRIORITY_MAX - 优先级) * PRIORITY_AGING_SECONDS 秒后与最高优先级同等对待
+PRIORITY_MIN = 0
+PRIORITY_MAX = 10
+PRIORITY_DEFAULT = 2
+PRIORITY_AGING_SECONDS = float(os.getenv("PRIORITY_AGING_SECONDS", "5"))
+
+
+def priority_class(value) -> int:
+    try:
+        return min(max(int(value), PRIORITY_MIN), PRIORITY_MAX)
+    except (TypeError, ValueError):
+        return PRIORITY_DEFAULT
+
+
+class LatencyStats:
+    """按优先级统计消息从入队到发送完成的耗时（保留最近的样本计算分位数）"""
+
+    def __init__(self, samples: int = 1000):
+        self.samples = samples
+        self.levels: Dict[int, dict] = {}
+
+    def record(self, priority: int, latency: float):
+        level = self.levels.get(priority)
+        if level is None:
+            level = self.levels[priority] = {"count": 0, "max": 0.0, "recent": deque(maxlen=self.samples)}
+        level["count"] += 1
+        level["max"] = max(level["max"], latency)
+        level["recent"].append(latency)
+
+    def snapshot(self) -> dict:
+        result = {}
+        for priority in sorted(self.levels, reverse=True):
+            level = self.levels[priority]
+            recent = sorted(level["recent"])
+            pick = lambda q: round(recent[min(int(len(recent) * q), len(recent) - 1)] * 1000, 2)
+            result[str(priority)] = {
+                "count": level["count"],
+                "p50_ms": pick(0.5),
+                "p95_ms": pick(0.95),
+                "p99_ms": pick(0.99),
+                "max_ms": round(level["max"] * 1000, 2)
+            }
+        return result
+
+
+delivery_latency = LatencyStats()
+
+
+def transfer_text(conn: "ClientConnection", message: dict, stream_id: int) -> str:
+    """序列化 binary_start / binary_end，v2 连接附带 stream_id"""
+    if conn.proto >= 2:
+        message = dict(message, stream_id=stream_id)
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+
+def transfer_chunk(conn: "ClientConnection", stream_id: int, seq: int, chunk, last: bool = False):
+    """v1 连接直接发送数据块，v2 连接在块前加上传输头部"""
+    if conn.proto < 2:
+        return chunk
+    return V2_CHUNK_HEADER.pack(2, V2_FLAG_LAST if last else 0, 0, stream_id, seq) + chunk
+
+
+# WebSocket 压缩策略（permessage-deflate）:
+# text: 只压缩不小于 WS_COMPRESS_MIN_BYTES 的文本消息，二进制消息（图片）从不压缩
+# all: 压缩所有消息（websockets 默认行为）; off: 不协商压缩
+WS_COMPRESSION = os.getenv("WS_COMPRESSION", "text").lower()
+if WS_COMPRESSION not in ("text", "all", "off"):
+    logger.warning(f"未知的 WS_COMPRESSION={WS_COMPRESSION}，使用 text")
+    WS_COMPRESSION = "text"
+WS_COMPRESS_MIN_BYTES = int(os.getenv("WS_COMPRESS_MIN_BYTES", "128"))
+
+
+class CompressionStats:
+    """按消息类型统计发送字节数和压缩耗时"""
+    FIELDS = ("messages", "compressed", "raw_bytes", "wire_bytes", "cpu_seconds")
+
+    def __init__(self):
+        self.kinds = {kind: dict.fromkeys(self.FIELDS, 0) for kind in ("text", "binary")}
+
+    def record(self, kind: str, raw: int, wire: int, compressed: bool, cpu: float):
+        stats = self.kinds[kind]
+        stats["messages"] += 1
+        stats["compressed"] += compressed
+        stats["raw_bytes"] += raw
+        stats["wire_bytes"] += wire
+        stats["cpu_seconds"] += cpu
+
+    def snapshot(self) -> dict:
+        result = {"policy": WS_COMPRESSION, "min_bytes": WS_COMPRESS_MIN_BYTES}
+        for kind, stats in self.kinds.items():
+            count = stats["messages"]
+            result[kind] = {
+                **stats,
+                "cpu_seconds": round(stats["cpu_seconds"], 6),
+                "avg_raw_bytes": round(stats["raw_bytes"] / count, 1) if count else 0,
+                "avg_wire_bytes": round(stats["wire_bytes"] / count, 1) if count else 0,
+                "avg_cpu_us": round(stats["cpu_seconds"] / count * 1e6, 2) if count else 0,
+                "ratio": round(stats["wire_bytes"] / stats["raw_bytes"], 4) if stats["raw_bytes"] else 1.0
+            }
+        return result
+
+
+ws_compression_stats = CompressionStats()
+
+
+class PolicyPerMessageDeflate(PerMessageDeflate):
+    """
+    按 WS_COMPRESSION 策略逐条决定是否压缩
+
+    RFC 7692 允许发送方对单条消息不设置 RSV1 而原样发送，
+    跳过的消息不经过压缩器，不影响上下文接管
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._kind = "text"
+        self._compress = True
+
+    def encode(self, frame: ws_frames.Frame) -> ws_frames.Frame:
+        if frame.opcode in ws_frames.CTRL_OPCODES:
+            return frame
+        if frame.opcode is not ws_frames.OP_CONT:
+            self._kind = "binary" if frame.opcode is ws_frames.OP_BINARY else "text"
+            self._compress = WS_COMPRESSION == "all" or (
+                self._kind == "text" and len(frame.data) >= WS_COMPRESS_MIN_BYTES
+            )
+        if not self._compress:
+            ws_compression_stats.record(self._kind, len(frame.data), len(frame.data), False, 0.0)
+            return frame
+        start = time.perf_counter()
+        encoded = super().encode(frame)
+        ws_compression_stats.record(self._kind, len(frame.data), len(encoded.data), True, time.perf_counter() - start)
+        return encoded
+
+
+class PolicyDeflateFactory(ServerPerMessageDeflateFactory):
+    """协商 permessage-deflate，返回按策略压缩的扩展实例"""
+
+    def process_request_params(self, params, accepted_extensions):
+        if WS_COMPRESSION == "off":
+            raise NegotiationError("permessage-deflate 已关闭")
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, PolicyPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings
+        )
+
+
+# uvicorn 的 websockets 实现在每次握手时按模块属性名创建压缩扩展工厂，替换为按策略压缩的版本
+try:
+    import uvicorn.protocols.websockets.websockets_impl as uvicorn_websockets_impl
+    uvicorn_websockets_impl.ServerPerMessageDeflateFactory = PolicyDeflateFactory
+except ImportError:
+    logger.warning("未找到 uvicorn websockets 实现，WebSocket 压缩策略不生效")
+
+
+class OutboundText:
+    """待发送的文本消息（已序列化，所有连接共用）"""
+    __slots__ = ("text", "size", "priority", "replay")
+    kind = "message"
+
+    def __init__(self, text: str, priority: int = PRIORITY_DEFAULT):
+        self.text = text
+        self.size = len(text)  # 按字符数估算
+        self.priority = priority_class(priority)
+        self.replay = None  # 补发的离线消息: (MailboxAck, 信箱 ID)
+
+    def frames(self, conn: "ClientConnection"):
+        yield self.text
+
+    def sent(self, conn: "ClientConnection"):
+        if self.replay is not None:
+            self.replay[0].settle(conn, self.replay[1], True)
+
+    def discarded(self, conn: "ClientConnection"):
+        if self.replay is not None:
+            self.replay[0].settle(conn, self.replay[1], False)
+
+    def failed(self, conn: "ClientConnection", error: Exception):
+        self.discarded(conn)
+        if isinstance(error, asyncio.TimeoutError):
+            logger.error(f"客户端 {conn.client_token} 发送消息超时（{WS_SEND_TIMEOUT}秒）")
+        else:
+            logger.error(f"客户端 {conn.client_token} 发送消息时出错: {error}")
+
+
+class MailboxAck:
+    """
+    一次离线消息补发的确认屏障
+
+    每条补发的消息写入 socket、被队列丢弃或发送失败时登记一次，全部有结果后才确认：
+    v1 客户端不会逐条确认，只删除实际写入 socket 的条目，被丢弃或发送失败的留在信箱中下次补发；
+    v2 客户端自己逐条确认，这里不删除。结束时同时释放握手时取得的信箱占用
+    """
+
+    def __init__(self, client_token: str, auto_ack: bool, claim: str = ""):
+        self.client_token = client_token
+        self.auto_ack = auto_ack
+        self.claim = claim
+        self.pending = 0
+        self.written: list = []
+        self.sealed = False
+
+    def track(self, item, entry_id: str):
+        """登记一条已放入发送队列的补发消息"""
+        item.replay = (self, entry_id)
+        self.pending += 1
+
+    def seal(self, conn: "ClientConnection"):
+        """所有补发消息都已登记"""
+        self.sealed = True
+        self._maybe_finish(conn)
+
+    def settle(self, conn: "ClientConnection", entry_id: str, written: bool):
+        self.pending -= 1
+        if written:
+            self.written.append(entry_id)
+        self._maybe_finish(conn)
+
+    def _maybe_finish(self, conn: "ClientConnection"):
+        if not self.sealed or self.pending:
+            return
+        self.sealed = False
+        written = self.written if self.auto_ack else []
+        if self.claim or written:
+            conn.manager._spawn(mailbox.release(self.client_token, self.claim, *written))
+
+
+class OutboundBinary:
+    """待发送的二进制数据：binary_start、若干二进制块、binary_end"""
+    kind = "binary"
+
+    def __init__(self, data: bytes, metadata: dict = None):
+        metadata = metadata or {}
+        self.data = data
+        self.size = len(data)
+        self.transfer_id = metadata.get("transfer_id", "")
+        self.filename = metadata.get("filename", "")
+        self.priority = priority_class(metadata.get("priority", PRIORITY_DEFAULT))
+        self.sha256 = metadata.get("sha256") or hashlib.sha256(data).hexdigest()
+        # 按初始块大小估算，实际块数取决于各连接的块大小
+        self.chunks = (self.size + BINARY_CHUNK_SIZE - 1) // BINARY_CHUNK_SIZE
+        self.sent_chunks: Dict["ClientConnection", int] = {}
+        self.start = {
+            "type": "binary_start",
+            "data_type": metadata.get("data_type", "image"),
+            "filename": self.filename,
+            "size": self.size,
+            "content_type": metadata.get("content_type", "image/jpeg"),
+            "transfer_id": self.transfer_id
+        }
+        if metadata.get("mailbox_id"):
+            self.start["mailbox_id"] = metadata["mailbox_id"]
+        self.replay = None  # 补发的离线消息: (MailboxAck, 信箱 ID)
+
+    def frames(self, conn: "ClientConnection"):
+        if conn.proto >= 2 and conn.knows_image(self.sha256):
+            # 客户端已收到过相同图片，只发送引用，客户端缓存未命中时回复 cache_miss
+            self.sent_chunks[conn] = 0
+            image_cache.record_ref(self.size)
+            log_event("DEBUG", "BINARY", f"发送 binary_ref: {self.filename}, sha256:{self.sha256[:12]}", self.transfer_id)
+            yield json.dumps(dict(self.start, type="binary_ref", sha256=self.sha256), ensure_ascii=False, separators=(",", ":"))
+            return
+        stream_id = conn.next_stream_id()
+        log_event("DEBUG", "BINARY", f"发送 binary_start: {self.filename}", self.transfer_id)
+        start = dict(self.start, sha256=self.sha256) if conn.proto >= 2 else self.start
+        yield transfer_text(conn, start, stream_id)
+        # memoryview 切片不复制数据，所有连接共享同一份图片
+        view = memoryview(self.data)
+        offset = chunks = 0
+        while offset < self.size:
+            end = offset + conn.chunk_size
+            yield transfer_chunk(conn, stream_id, chunks, view[offset:end], end >= self.size)
+            offset = end
+            chunks += 1
+        self.sent_chunks[conn] = chunks
+        if conn.proto >= 2:
+            conn.remember_image(self.sha256)
+        log_event("DEBUG", "BINARY", f"发送 binary_end: {self.filename}, 块数:{chunks}", self.transfer_id)
+        yield transfer_text(conn, {
+            "type": "binary_end",
+            "transfer_id": self.transfer_id,
+            "size": self.size,
+            "chunks": chunks
+        }, stream_id)
+
+    def sent(self, conn: "ClientConnection"):
+        if self.replay is not None:
+            self.replay[0].settle(conn, self.replay[1], True)
+        chunks = self.sent_chunks.pop(conn, 0)
+        if chunks == 0 and self.size:
+            log_event("INFO", "BINARY", f"✅ 图片引用已发送: {self.filename}, 节省:{format_size(self.size)}", self.transfer_id)
+            return
+        log_event("INFO", "BINARY", f"✅ 图片发送完成: {self.filename}, 块数:{chunks}, 大小:{format_size(self.size)}", self.transfer_id)
+
+    def discarded(self, conn: "ClientConnection"):
+        self.sent_chunks.pop(conn, None)
+        if self.replay is not None:
+            self.replay[0].settle(conn, self.replay[1], False)
+
+    def failed(self, conn: "ClientConnection", error: Exception):
+        self.discarded(conn)
+        if isinstance(error, asyncio.TimeoutError):
+            error = f"发送超时（{WS_SEND_TIMEOUT}秒）"
+        log_event("ERROR", "BINARY", f"❌ 发送失败到 {conn.client_token[:20]}...: {error}", self.transfer_id)
+
+
+class StreamRelay:
+    """
+    上传流到多个连接的中继（binary_start、按到达顺序转发的二进制块、binary_end）
+
+    上传方每攒够一块就放入窗口，各连接的写任务按自己的进度读取；
+    窗口最多保留 STREAM_RELAY_WINDOW 块，最慢的连接没跟上时上传方等待（背压），
+    因此单个传输的内存占用与图片大小无关。
+    最慢的连接超过 WS_SEND_TIMEOUT 仍未跟上时会被断开，不再拖住上传；
+    该计时从写任务开始发送本传输时算起，仍排在其他传输之后的连接不算掉队
+    """
+    kind = "stream"
+
+    def __init__(self, metadata: dict, size: int = 0):
+        self.metadata = metadata
+        self.transfer_id = metadata.get("transfer_id", "")
+        self.filename = metadata.get("filename", "")
+        self.priority = priority_class(metadata.get("priority", PRIORITY_DEFAULT))
+        self.declared_size = size  # Content-Length，未知时为 0
+        # 发送队列按窗口大小计算占用
+        self.size = STREAM_RELAY_WINDOW * BINARY_CHUNK_SIZE
+        self.received = 0
+        self.chunks: deque = deque()
+        self.base = 0  # chunks[0] 的块序号
+        self.positions: Dict["ClientConnection", int] = {}
+        # 写任务开始发送本传输的时间，尚未开始的连接不在其中
+        self.started: Dict["ClientConnection", float] = {}
+        self.finished = False
+        self.aborted = False
+        self._cond = asyncio.Condition()
+
+    def attach(self, conn: "ClientConnection"):
+        self.positions[conn] = 0
+
+    def _detach(self, conn: "ClientConnection"):
+        self.started.pop(conn, None)
+        if self.positions.pop(conn, None) is not None:
+            self._trim()
+
+    def _trim(self):
+        """丢弃所有连接都已发送的块"""
+        low = min(self.positions.values(), default=self.base + len(self.chunks))
+        while self.chunks and self.base < low:
+            self.chunks.popleft()
+            self.base += 1
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    async def feed(self, chunk: bytes):
+        """上传方追加一块，窗口已满时等待最慢的连接"""
+        async with self._cond:
+            while self.positions and len(self.chunks) >= STREAM_RELAY_WINDOW:
+                try:
+                    await asyncio.wait_for(self._cond.wait(), WS_SEND_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self._drop_laggards()
+            self.chunks.append(chunk)
+            self.received += len(chunk)
+            if not self.positions:
+                self._trim()
+            self._cond.notify_all()
+
+    async def finish(self, aborted: bool = False):
+        async with self._cond:
+            self.finished = True
+            self.aborted = aborted
+            self._cond.notify_all()
+
+    def _drop_laggards(self):
+        low = min(self.positions.values())
+        deadline = time.monotonic() - WS_SEND_TIMEOUT
+        for conn, position in list(self.positions.items()):
+            started = self.started.get(conn)
+            if position == low and started is not None and started <= deadline:
+                log_event("WARNING", "BINARY", f"⚠️ 连接跟不上上传速度，已断开: {conn.client_token[:20]}...", self.transfer_id)
+                self._detach(conn)
+                conn.manager.drop_connection(conn, 1011)
+
+    async def frames(self, conn: "ClientConnection"):
+        self.started[conn] = time.monotonic()
+        stream_id = conn.next_stream_id()
+        log_event("DEBUG", "BINARY", f"发送 binary_start (流式): {self.filename}", self.transfer_id)
+        yield transfer_text(conn, {
+            "type": "binary_start",
+            "data_type": self.metadata.get("data_type", "image"),
+            "filename": self.filename,
+            "size": self.declared_size,
+            "content_type": self.metadata.get("content_type", "image/jpeg"),
+            "transfer_id": self.transfer_id
+        }, stream_id)
+        sent = 0
+        while True:
+            async with self._cond:
+                position = self.positions.get(conn)
+                if position is None:
+                    raise RuntimeError("流式传输已中止")
+                while position >= self.base + len(self.chunks) and not self.finished:
+                    await self._cond.wait()
+                if position >= self.base + len(self.chunks):
+                    break
+                chunk = self.chunks[position - self.base]
+            # 流式上传在结束前无法确定最后一块，不设置 LAST 标志
+            yield transfer_chunk(conn, stream_id, sent, chunk)
+            sent += 1
+            async with self._cond:
+                if conn in self.positions:
+                    self.positions[conn] = position + 1
+                    self._trim()
+                    self._cond.notify_all()
+        self.positions.pop(conn, None)
+        self.started.pop(conn, None)
+        self._trim()
+        if self.aborted:
+            raise RuntimeError("上传中断")
+        log_event("DEBUG", "BINARY", f"发送 binary_end (流式): {self.filename}, 块数:{sent}", self.transfer_id)
+        yield transfer_text(conn, {
+            "type": "binary_end",
+            "transfer_id": self.transfer_id,
+            "size": self.received,
+            "chunks": sent
+        }, stream_id)
+
+    def sent(self, conn: "ClientConnection"):
+        log_event("INFO", "BINARY", f"✅ 图片流式发送完成: {self.filename}, 大小:{format_size(self.received)}", self.transfer_id)
+
+    def discarded(self, conn: "ClientConnection"):
+        if conn in self.positions:
+            self._detach(conn)
+            conn.manager._spawn(self._notify())
+
+    def failed(self, conn: "ClientConnection", error: Exception):
+        self.discarded(conn)
+        if isinstance(error, asyncio.TimeoutError):
+            error = f"发送超时（{WS_SEND_TIMEOUT}秒）"
+        log_event("ERROR", "BINARY", f"❌ 流式发送失败到 {conn.client_token[:20]}...: {error}", self.transfer_id)
+
+
+class ClientConnection:
+    """
+    单个 WebSocket 连接：有界发送队列 + 写任务
+
+    发送方只把消息放入队列，由写任务写入 socket，
+    卡住的客户端不会阻塞发送方；队列超过条数或字节上限时按 OUTBOUND_OVERFLOW_POLICY 处理。
+    队列为空时总是接受新消息，因此单条超大消息也能发送。
+
+    队列按优先级出队（同优先级先进先出），文本消息和二进制传输分两个堆存放，
+    每发送一帧都重新选择有效优先级最高的消息，因此紧急消息可以插入低优先级传输的二进制块之间，
+    等待传输名额的传输也不会挡住其后的文本消息。
+    v1 连接同时只发送一个二进制传输（文本消息可以插队）；
+    v2 连接最多同时发送 V2_MAX_STREAMS 个，同优先级的传输每发一块轮换一次，更紧急的传输不受该上限限制
+    """
+
+    def __init__(self, manager: "ConnectionManager", client_token: str, websocket: WebSocket, proto: int = 1):
+        self.manager = manager
+        self.client_token = client_token
+        self.websocket = websocket
+        self.proto = proto
+        # 堆: (截止时间, 序号, 入队时间, 消息)，截止时间见 _deadline；文本消息和二进制传输分开排队
+        self.texts: list = []
+        self.transfers: list = []
+        self._seq = 0
+        self.queued_bytes = 0
+        # 正在发送的传输: [消息, 帧迭代器, 入队时间]（文本消息一次发完，不进入该列表）
+        self.active: deque = deque()
+        self._stream_id = 0
+        # 该连接已完整收到的图片哈希（LRU）
+        self.known_images: "OrderedDict[str, None]" = OrderedDict()
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        # 二进制块大小及实测吞吐（字节/秒，指数平滑）
+        self.chunk_size = BINARY_CHUNK_SIZE
+        self.throughput = 0.0
+        self.connected_at = now_china()
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+
+    def stop(self):
+        """停止写任务并释放队列"""
+        self.closed = True
+        for heap in (self.texts, self.transfers):
+            for _, _, _, item in heap:
+                item.discarded(self)
+            heap.clear()
+        for item, _, _ in self.active:
+            item.discarded(self)
+        self.active.clear()
+        self.queued_bytes = 0
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    def knows_image(self, sha256: str) -> bool:
+        if sha256 not in self.known_images:
+            return False
+        self.known_images.move_to_end(sha256)
+        return True
+
+    def remember_image(self, sha256: str):
+        self.known_images[sha256] = None
+        self.known_images.move_to_end(sha256)
+        while len(self.known_images) > CLIENT_KNOWN_IMAGES:
+            self.known_images.popitem(last=False)
+
+    def next_stream_id(self) -> int:
+        self._stream_id = (self._stream_id + 1) & 0xFFFFFFFF
+        return self._stream_id
+
+    def queue_depth(self) -> int:
+        return len(self.texts) + len(self.transfers)
+
+    @staticmethod
+    def _over_limit(depth: int, queued_bytes: int, size: int) -> bool:
+        """队列中已有 depth 条、queued_bytes 字节时，再放入 size 字节是否超限（空队列总是接受）"""
+        return bool(depth) and (
+            depth >= OUTBOUND_QUEUE_MAX_ITEMS
+            or queued_bytes + size > OUTBOUND_QUEUE_MAX_BYTES
+        )
+
+    def _full(self, item) -> bool:
+        return self._over_limit(self.queue_depth(), self.queued_bytes, item.size)
+
+    def enqueue(self, item) -> bool:
+        """放入发送队列，返回是否被接受"""
+        if self.closed:
+            return False
+        if self._full(item):
+            if OUTBOUND_OVERFLOW_POLICY == "drop-newest":
+                self.dropped += 1
+                log_event("WARNING", "WEBSOCKET", f"⚠️ 发送队列已满，丢弃新消息 ({self.queue_depth()} 条, {format_size(self.queued_bytes)})", self.client_token[:20])
+                return False
+            if OUTBOUND_OVERFLOW_POLICY == "disconnect":
+                log_event("WARNING", "WEBSOCKET", f"⚠️ 发送队列已满，断开慢连接 ({self.queue_depth()} 条, {format_size(self.queued_bytes)})", self.client_token[:20])
+                self.manager.drop_connection(self, 1013, "发送队列已满")
+                return False
+            # 只丢弃优先级不高于新消息的条目，按优先级从低到高、同优先级先入队者优先
+            candidates = sorted(
+                (entry for heap in (self.texts, self.transfers) for entry in heap
+                 if entry[3].priority <= item.priority),
+                key=lambda entry: (entry[3].priority, entry[1])
+            )
+            depth, queued_bytes, victims = self.queue_depth(), self.queued_bytes, set()
+            for entry in candidates:
+                if not self._over_limit(depth, queued_bytes, item.size):
+                    break
+                victims.add(entry[1])
+                depth -= 1
+                queued_bytes -= entry[3].size
+            if self._over_limit(depth, queued_bytes, item.size):
+                # 腾不出空间时不丢弃更高优先级的消息，改为拒绝新消息
+                self.dropped += 1
+                log_event("WARNING", "WEBSOCKET", f"⚠️ 发送队列已满且都是更高优先级的消息，丢弃新消息 ({self.queue_depth()} 条, {format_size(self.queued_bytes)})", self.client_token[:20])
+                return False
+            for heap in (self.texts, self.transfers):
+                kept = [entry for entry in heap if entry[1] not in victims]
+                for entry in heap:
+                    if entry[1] in victims:
+                        self.queued_bytes -= entry[3].size
+                        entry[3].discarded(self)
+                heap[:] = kept
+                heapq.heapify(heap)
+            self.dropped += len(victims)
+            log_event("WARNING", "WEBSOCKET", f"⚠️ 发送队列已满，丢弃最低优先级中最早的 {len(victims)} 条消息", self.client_token[:20])
+        now = time.monotonic()
+        self._seq += 1
+        heap = self.texts if item.kind == "message" else self.transfers
+        heapq.heappush(heap, (self._deadline(item.priority, now), self._seq, now, item))
+        self.queued_bytes += item.size
+        self._ready.set()
+        return True
+
+    async def _send_frame(self, frame):
+        async with asyncio.timeout(WS_SEND_TIMEOUT):
+            if isinstance(frame, str):
+                await self.websocket.send_text(frame)
+                self.sent_bytes += len(frame)
+                return
+            started = time.perf_counter()
+            await self.websocket.send_bytes(frame)
+            self._observe(len(frame), time.perf_counter() - started)
+            self.sent_bytes += len(frame)
+
+    def _observe(self, size: int, elapsed: float):
+        """记录一次二进制块发送耗时，按目标耗时加倍或减半块大小"""
+        if elapsed > 0:
+            rate = size / elapsed
+            self.throughput = rate if not self.throughput else self.throughput * 0.8 + rate * 0.2
+        if not BINARY_CHUNK_ADAPTIVE or size < self.chunk_size:
+            # 最后一块通常不满，不参与调整
+            return
+        if elapsed < BINARY_CHUNK_TARGET / 2:
+            self.chunk_size = min(self.chunk_size * 2, BINARY_CHUNK_MAX)
+        elif elapsed > BINARY_CHUNK_TARGET * 2:
+            self.chunk_size = max(self.chunk_size // 2, BINARY_CHUNK_MIN)
+
+    @staticmethod
+    def effective_priority(priority: int, enqueued_at: float, now: float) -> int:
+        """排队越久有效优先级越高，防止低优先级消息饿死"""
+        if PRIORITY_AGING_SECONDS <= 0:
+            return priority
+        return min(priority + int((now - enqueued_at) / PRIORITY_AGING_SECONDS), PRIORITY_MAX)
+
+    @staticmethod
+    def _deadline(priority: int, enqueued_at: float) -> float:
+        """排队顺序：入队时间 + (PRIORITY_MAX - 优先级) * PRIORITY_AGING_SECONDS，越小越先发送（不老化时只按优先级）"""
+        if PRIORITY_AGING_SECONDS <= 0:
+            return -priority
+        return enqueued_at + (PRIORITY_MAX - priority) * PRIORITY_AGING_SECONDS
+
+    def _admit(self):
+        """按优先级把排队的传输移入发送中列表"""
+        limit = V2_MAX_STREAMS if self.proto >= 2 else 1
+        while self.transfers:
+            deadline, _, enqueued_at, item = self.transfers[0]
+            if len(self.active) >= limit:
+                # v2 连接上比所有发送中传输都紧急的传输直接插队
+                if self.proto < 2 or any(
+                    self._deadline(entry[0].priority, entry[2]) <= deadline for entry in self.active
+                ):
+                    break
+            heapq.heappop(self.transfers)
+            self.queued_bytes -= item.size
+            self.active.append([item, item.frames(self), enqueued_at])
+
+    def _select(self):
+        """
+        选出下一帧所属的消息：有效优先级最高的发送中传输（同级按轮换顺序取第一个），
+        队首文本消息不低于它时先发文本（从队列取出），都没有时返回 None
+        """
+        entry = None
+        now = time.monotonic() if self.active else 0
+        if len(self.active) == 1:
+            entry = self.active[0]
+        elif self.active:
+            entry = max(self.active, key=lambda entry: self.effective_priority(entry[0].priority, entry[2], now))
+        if self.texts:
+            _, _, enqueued_at, item = self.texts[0]
+            if entry is None or self.effective_priority(item.priority, enqueued_at, now) >= \
+                    self.effective_priority(entry[0].priority, entry[2], now):
+                heapq.heappop(self.texts)
+                self.queued_bytes -= item.size
+                return [item, item.frames(self), enqueued_at]
+        return entry
+
+    @staticmethod
+    async def _next_frame(frames):
+        """取下一帧，迭代结束时返回 None（同时支持同步和异步生成器）"""
+        if hasattr(frames, "__anext__"):
+            try:
+                return await frames.__anext__()
+            except StopAsyncIteration:
+                return None
+        try:
+            return next(frames)
+        except StopIteration:
+            return None
+
+    async def _writer(self):
+        while not self.closed:
+            self._admit()
+            entry = self._select()
+            if entry is None:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            item, frames, enqueued_at = entry
+            try:
+                if item.kind == "message":
+                    # 文本消息只有一帧，不进入发送中列表
+                    for frame in frames:
+                        await self._send_frame(frame)
+                    frame = None
+                else:
+                    frame = await self._next_frame(frames)
+                    if frame is not None:
+                        await self._send_frame(frame)
+            except Exception as e:
+                # 先移出发送中列表，stop() 不会再对它调用 discarded()
+                if item.kind != "message":
+                    self.active.remove(entry)
+                item.failed(self, e)
+                # 超时的发送可能只写了半个帧，连接已不可用
+                self.manager.drop_connection(self, 1011)
+                return
+            if frame is None:
+                if item.kind != "message":
+                    self.active.remove(entry)
+                self.sent_messages += 1
+                delivery_latency.record(item.priority, time.monotonic() - enqueued_at)
+                item.sent(self)
+            elif self.proto >= 2 and len(self.active) > 1 and not isinstance(frame, str):
+                # v2 同优先级的消息交错发送：每发一个二进制块把它移到末尾（v1 同优先级按入队顺序）
+                self.active.remove(entry)
+                self.active.append(entry)
+
+    def stats(self) -> dict:
+        return {
+            "client_token": self.client_token,
+            "connected_at": self.connected_at.isoformat(),
+            "queue_depth": self.queue_depth(),
+            "queue_bytes": self.queued_bytes,
+            "proto": self.proto,
+            "known_images": len(self.known_images),
+            "active": [f"{item.kind}:{item.priority}" for item, _, _ in self.active],
+            "sent_messages": self.sent_messages,
+            "sent_bytes": self.sent_bytes,
+            "dropped": self.dropped,
+            "chunk_size": self.chunk_size,
+            "throughput": round(self.throughput)
+        }
+
+
 # WebSocket 连接管理
 
 
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, Set[WebSocket]] = {}
-
-    async def connect(self, client_token: str, websocket: WebSocket):
-        await websocket.accept()
+        # 每个 socket 对应的发送队列
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        self.worker_id = WORKER_ID
+        self.cluster = FANOUT_MODE == "redis"
+        self._background: Set[asyncio.Task] = set()
+        self._fanout_tasks: list = []
+        self._pubsub = None
+
+    async def connect(self, client_token: str, websocket: WebSocket, proto: int = 1):
+        try:
+            await websocket.accept()
+        except Exception:
+            # 握手脚本已登记连接计数，接受失败时撤销
+            self._spawn(self._release_presence(client_token))
+            raise
         if client_token not in self.active_connections:
             self.active_connections[client_token] = set()
         self.active_connections[client_token].add(websocket)
+        conn = self.clients[websocket] = ClientConnection(self, client_token, websocket, proto)
+        conn.start()
+        if proto >= 2:
+            # 告知客户端协商结果，旧版客户端不会请求 v2，也就不会收到该消息
+            conn.enqueue(OutboundText(json.dumps({
+                "type": "hello",
+                "proto": proto,
+                "max_streams": V2_MAX_STREAMS,
+                "chunk_header": V2_CHUNK_HEADER.format
+            }), PRIORITY_MAX))
         log_event("INFO", "WEBSOCKET", f"🔌 客户端已连接, 总连接数: {len(self.active_connections[client_token])}", client_token[:20])
 
     def disconnect(self, client_token: str, websocket: WebSocket):
         if client_token in self.active_connections:
+            if websocket in self.active_connections[client_token]:
+                self._spawn(self._release_presence(client_token))
             self.active_connections[client_token].discard(websocket)
             if not self.active_connections[client_token]:
                 del self.active_connections[client_token]
+        conn = self.clients.pop(websocket, None)
+        if conn is not None:
+            conn.stop()
         log_event("INFO", "WEBSOCKET", f"❌ 客户端已断开连接", client_token[:20])
 
+    def _spawn(self, coro):
+        """启动后台任务并保留引用，避免任务被垃圾回收"""
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    def drop_connection(self, conn: ClientConnection, code: int = 1000, reason: str = ""):
+        """移除并关闭一个连接（发送失败、超时或队列溢出时）"""
+        self.disconnect(conn.client_token, conn.websocket)
+        self._spawn(self._close_quietly(conn.websocket, code, reason))
+
+    def queue_stats(self) -> list:
+        """各连接的发送队列状态"""
+        return [conn.stats() for conn in self.clients.values()]
+
+    def local_count(self, client_token: str) -> int:
+        """当前 worker 上该 token 的连接数"""
+        return len(self.active_connections.get(client_token, ()))
+
+    # ---------- 集群模式：连接计数 ----------
+
+    async def _release_presence(self, client_token: str):
+        """
+        连接断开时减少当前 worker 的连接计数（计数在握手脚本中增加），
+        该指纹在所有存活 worker 上都没有连接时移出在线索引；
+        计数与在线索引在同一个脚本中更新，不会与并发重连的握手交错
+        """
+        if not redis_client or presence_script is None:
+            return
+        try:
+            await presence_script(
+                keys=[f"connections:{client_token}", "cluster:workers", ONLINE_INDEX],
+                args=[self.worker_id, -1, client_token, time.time() - WORKER_HEARTBEAT_TTL, CONNECTIONS_TTL]
+            )
+        except Exception as e:
+            logger.error(f"更新连接计数失败 {client_token[:20]}...: {e}")
+
+    async def connection_count(self, client_token: str) -> int:
+        """获取该 token 的连接总数（集群模式下汇总所有存活 worker）"""
+        local = self.local_count(client_token)
+        if not self.cluster or not redis_client:
+            return local
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hgetall(f"connections:{client_token}")
+            pipe.zrangebyscore("cluster:workers", time.time() - WORKER_HEARTBEAT_TTL, "+inf")
+            counts, alive = await pipe.execute()
+        except Exception as e:
+            logger.error(f"获取集群连接数失败 {client_token[:20]}...: {e}")
+            return local
+        alive = set(alive)
+        remote = sum(int(v) for k, v in counts.items() if k in alive and k != self.worker_id)
+        return local + max(remote, 0)
+
+    async def connection_counts(self, client_tokens) -> Dict[str, int]:
+        """批量获取连接总数，集群模式下所有 token 共用一次 Redis 往返"""
+        tokens = list(dict.fromkeys(client_tokens))
+        counts = {token: self.local_count(token) for token in tokens}
+        if not tokens or not self.cluster or not redis_client:
+            return counts
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for token in tokens:
+                pipe.hgetall(f"connections:{token}")
+            pipe.zrangebyscore("cluster:workers", time.time() - WORKER_HEARTBEAT_TTL, "+inf")
+            *per_token, alive = await pipe.execute()
+        except Exception as e:
+            logger.error(f"批量获取集群连接数失败: {e}")
+            return counts
+        alive = set(alive)
+        for token, worker_counts in zip(tokens, per_token):
+            remote = sum(int(v) for k, v in worker_counts.items() if k in alive and k != self.worker_id)
+            counts[token] += max(remote, 0)
+        return counts
+
+    # ---------- 集群模式：pub/sub 分发 ----------
+
+    async def start_fanout(self):
+        """启动心跳与订阅任务"""
+        if not self.cluster:
+            return
+        if not redis_client:
+            logger.warning("FANOUT_MODE=redis 但 Redis 未连接，退回单 worker 投递")
+            self.cluster = False
+            return
+        self._fanout_tasks = [
+            asyncio.create_task(self._heartbeat_loop()),
+            asyncio.create_task(self._subscribe_loop()),
+        ]
+        log_event("INFO", "SYSTEM", f"🌐 集群分发已启用, worker: {self.worker_id}, 频道: {FANOUT_CHANNEL}")
+
+    async def stop_fanout(self):
+        for task in self._fanout_tasks:
+            task.cancel()
+        self._fanout_tasks = []
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.close()
+            except Exception:
+                pass
+            self._pubsub = None
+        if self.cluster and redis_client:
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                pipe.zrem("cluster:workers", self.worker_id)
+                for client_token in self.active_connections:
+                    pipe.hdel(f"connections:{client_token}", self.worker_id)
+                await pipe.execute()
+            except Exception as e:
+                logger.error(f"注销 worker 失败: {e}")
+
+    async def _heartbeat_loop(self):
+        """定期登记 worker 心跳，并清理长时间未心跳的 worker"""
+        while True:
+            try:
+                now = time.time()
+                pipe = redis_client.pipeline(transaction=False)
+                pipe.zadd("cluster:workers", {self.worker_id: now})
+                pipe.zremrangebyscore("cluster:workers", "-inf", now - WORKER_HEARTBEAT_TTL * 10)
+                await pipe.execute()
+            except Exception as e:
+                logger.error(f"worker 心跳失败: {e}")
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+    async def _subscribe_loop(self):
+        """订阅分发频道，把其他 worker 发布的消息投递到本地连接"""
+        while True:
+            try:
+                self._pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                await self._pubsub.subscribe(FANOUT_CHANNEL)
+                async for item in self._pubsub.listen():
+                    if item.get("type") != "message":
+                        continue
+                    try:
+                        envelope = json.loads(item["data"])
+                    except (TypeError, ValueError):
+                        continue
+                    if envelope.get("origin") == self.worker_id:
+                        continue
+                    self._spawn(self._handle_envelope(envelope))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"订阅分发频道失败, 1秒后重试: {e}")
+                await asyncio.sleep(1)
+
+    async def _handle_envelope(self, envelope: dict):
+        """处理来自其他 worker 的分发消息"""
+        kind = envelope.get("kind")
+        client_token = envelope.get("client_token", "")
+        try:
+            if kind == "message":
+                if self.local_count(client_token):
+                    await self.send_message(client_token, envelope["message"])
+            elif kind == "message_batch":
+                for entry in envelope.get("messages", ()):
+                    if self.local_count(entry["client_token"]):
+                        await self.send_message(entry["client_token"], entry["message"])
+            elif kind == "binary":
+                if self.local_count(client_token):
+                    data = base64.b64decode(envelope["data"])
+                    await self.send_binary(client_token, data, envelope.get("metadata"))
+            elif kind == "close":
+                await self.close_local(client_token, envelope.get("code", 1000), envelope.get("reason", ""))
+            elif kind == "invalidate":
+                if envelope.get("app_token") is None:
+                    app_token_cache.clear()
+                else:
+                    app_token_cache.invalidate(envelope["app_token"])
+            elif kind == "session":
+                active_sessions[envelope["session"]] = datetime.fromisoformat(envelope["expiry"])
+            elif kind == "session_revoke":
+                active_sessions.pop(envelope["session"], None)
+        except Exception as e:
+            logger.error(f"处理分发消息失败 ({kind}): {e}")
+
+    async def broadcast(self, envelope: dict):
+        """向所有 worker 发布控制消息（本 worker 不会收到自己的消息）"""
+        if not self.cluster or not redis_client:
+            return
+        envelope["origin"] = self.worker_id
+        try:
+            await redis_client.publish(FANOUT_CHANNEL, json.dumps(envelope, ensure_ascii=False))
+        except Exception as e:
+            logger.error(f"发布分发消息失败: {e}")
+
+    async def publish_message(self, client_token: str, message: dict) -> int:
+        """投递文本消息到该 token 的所有连接，返回连接总数"""
+        total = await self.connection_count(client_token)
+        if total == 0:
+            return 0
+        local = self.local_count(client_token)
+        if total > local:
+            await self.broadcast({"kind": "message", "client_token": client_token, "message": message})
+        if local:
+            await self.send_message(client_token, message)
+        return total
+
+    async def publish_messages(self, deliveries: list) -> Dict[str, int]:
+        """
+        批量投递文本消息，deliveries 为 [(client_token, message)]，返回每个 token 的连接总数
+
+        同一个 message 对象只序列化一次；其他 worker 上的连接合并为一条分发消息
+        """
+        counts = await self.connection_counts(token for token, _ in deliveries)
+        serialized: Dict[int, OutboundText] = {}
+        remote = []
+        for client_token, message in deliveries:
+            total = counts[client_token]
+            if total == 0:
+                continue
+            local = self.local_count(client_token)
+            if total > local:
+                remote.append({"client_token": client_token, "message": message})
+            if local:
+                item = serialized.get(id(message))
+                if item is None:
+                    item = serialized[id(message)] = OutboundText(
+                        json.dumps(message, ensure_ascii=False, separators=(",", ":")),
+                        message.get("priority", PRIORITY_DEFAULT)
+                    )
+                self._enqueue(client_token, item)
+        if remote:
+            await self.broadcast({"kind": "message_batch", "messages": remote})
+        return counts
+
+    async def publish_binary(self, client_token: str, data: bytes, metadata: dict = None) -> int:
+        """投递二进制数据到该 token 的所有连接，返回连接总数"""
+        total = await self.connection_count(client_token)
+        if total == 0:
+            return 0
+        local = self.local_count(client_token)
+        if total > local:
+            await self.broadcast_binary(client_token, data, metadata)
+        if local:
+            await self.send_binary(client_token, data, metadata)
+        return total
+
+    async def broadcast_binary(self, client_token: str, data: bytes, metadata: dict = None):
+        """把二进制数据发布给其他 worker"""
+        await self.broadcast({
+            "kind": "binary",
+            "client_token": client_token,
+            "metadata": metadata or {},
+            "data": base64.b64encode(data).decode()
+        })
+
+    def open_stream(self, client_token: str, metadata: dict, size: int = 0) -> StreamRelay:
+        """创建流式中继并挂到该 token 所有本地连接的发送队列"""
+        relay = StreamRelay(metadata, size)
+        for websocket in list(self.active_connections.get(client_token, ())):
+            conn = self.clients.get(websocket)
+            if conn is None:
+                continue
+            relay.attach(conn)
+            if not conn.enqueue(relay):
+                relay.positions.pop(conn, None)
+        return relay
+
+    async def close_local(self, client_token: str, code: int = 1000, reason: str = ""):
+        """关闭当前 worker 上该 token 的所有连接"""
+        for conn in list(self.active_connections.get(client_token, ())):
+            self.disconnect(client_token, conn)
+            try:
+                await conn.close(code=code, reason=reason)
+            except Exception:
+                pass
+
+    @staticmethod
+    async def _close_quietly(connection: WebSocket, code: int = 1000, reason: str = ""):
+        try:
+            await asyncio.wait_for(connection.close(code=code, reason=reason), WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    def _enqueue(self, client_token: str, item) -> int:
+        """把消息放入该 token 所有本地连接的发送队列，返回接受的连接数"""
+        accepted = 0
+        for websocket in list(self.active_connections.get(client_token, ())):
+            conn = self.clients.get(websocket)
+            if conn is not None and conn.enqueue(item):
+                accepted += 1
+        return accepted
+
     async def send_message(self, client_token: str, message: dict):
-        if client_token in self.active_connections:
-            disconnected = set()
-            for connection in self.active_connections[client_token]:
-                try:
-                    await connection.send_json(message)
-                except Exception as e:
-                    logger.error(f"客户端 {client_token} 发送消息时出错: {e}")
-                    disconnected.add(connection)
+        """
+        发送文本消息到该 token 的所有本地连接
 
-            # 清理断开的连接
-            for conn in disconnected:
-                self.disconnect(client_token, conn)
+        消息只序列化一次，放入各连接的发送队列，由各自的写任务并发发送
+        """
+        if client_token not in self.active_connections:
+            return
+        text = json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+        self._enqueue(client_token, OutboundText(text, message.get("priority", PRIORITY_DEFAULT)))
 
     async def send_binary(self, client_token: str, data: bytes, metadata: dict = None):
         """发送二进制数据（如图片）给客户端"""
-        if client_token in self.active_connections:
-            disconnected = set()
-            total_size = len(data)
-            chunk_size = 64 * 1024  # 64KB 每块
-            total_chunks = (total_size + chunk_size - 1) // chunk_size
-            transfer_id = metadata.get("transfer_id", "") if metadata else ""
-            filename = metadata.get("filename", "") if metadata else ""
-            
-            # 添加分割线
-            # log_event("INFO", "BINARY", "=" * 50, transfer_id)
-            # 记录日志
-            log_event("INFO", "BINARY", f"📤 开始发送图片: {filename}, 大小: {format_size(total_size)}, 分{total_chunks}块", transfer_id)
-            
-            for connection in self.active_connections[client_token]:
-                try:
-                    # 先发送元数据
-                    metadata_msg = {
-                        "type": "binary_start",
-                        "data_type": metadata.get("data_type", "image"),
-                        "filename": filename,
-                        "size": total_size,
-                        "content_type": metadata.get("content_type", "image/jpeg"),
-                        "transfer_id": transfer_id
-                    }
-                    log_event("DEBUG", "BINARY", f"发送 binary_start: {filename}", transfer_id)
-                    await connection.send_json(metadata_msg)
-                    
-                    # 分块发送二进制数据
-                    sent_chunks = 0
-                    sent_bytes = 0
-                    for i in range(0, total_size, chunk_size):
-                        chunk = data[i:i + chunk_size]
-                        await connection.send_bytes(chunk)
-                        sent_chunks += 1
-                        sent_bytes += len(chunk)
-                    
-                    # 发送完成标记
-                    end_msg = {
-                        "type": "binary_end",
-                        "transfer_id": transfer_id,
-                        "size": total_size,
-                        "chunks": sent_chunks
-                    }
-                    log_event("DEBUG", "BINARY", f"发送 binary_end: {filename}, 块数:{sent_chunks}", transfer_id)
-                    await connection.send_json(end_msg)
-                    
-                    log_event("INFO", "BINARY", f"✅ 图片发送完成: {filename}, 块数:{sent_chunks}, 大小:{format_size(sent_bytes)}", transfer_id)
-                    # log_event("INFO", "BINARY", "=" * 50, transfer_id)
-                except Exception as e:
-                    log_event("ERROR", "BINARY", f"❌ 发送失败到 {client_token[:20]}...: {str(e)}", transfer_id)
-                    disconnected.add(connection)
+        if client_token not in self.active_connections:
+            return
+        item = OutboundBinary(data, metadata)
+        # 缓存图片内容，客户端回复 cache_miss 时从这里补发
+        image_cache.put(item.sha256, data, item.start["content_type"], client_token)
+        log_event("INFO", "BINARY", f"📤 开始发送图片: {item.filename}, 大小: {format_size(item.size)}, 分{item.chunks}块", item.transfer_id)
+        self._enqueue(client_token, item)
 
-            # 清理断开的连接
-            for conn in disconnected:
-                self.disconnect(client_token, conn)
+
+    async def deliver_mailbox(self, websocket: WebSocket, entries: list, claim: str = ""):
+        """
+        连接建立后一次性补发离线信箱中的消息
+
+        确认游标、占用信箱和读取都已在握手脚本中完成，entries 和 claim 为其结果
+        """
+        conn = self.clients.get(websocket)
+        if conn is None or not MAILBOX_ENABLED:
+            return
+        budget = OUTBOUND_QUEUE_MAX_BYTES
+        delivered = []
+        # v1 客户端不会发送确认：补发的消息都有结果后自动确认实际写入的条目
+        ack = MailboxAck(conn.client_token, auto_ack=conn.proto < 2, claim=claim)
+        for entry_id, kind, payload in entries:
+            if kind == "binary":
+                item = OutboundBinary(base64.b64decode(payload["data"]), dict(payload["metadata"], mailbox_id=entry_id))
+            else:
+                item = OutboundText(
+                    json.dumps(dict(payload, mailbox_id=entry_id), ensure_ascii=False, separators=(",", ":")),
+                    payload.get("priority", PRIORITY_DEFAULT)
+                )
+            # 超出发送队列容量的消息留在信箱中，下次连接时再补发
+            if delivered and item.size > budget:
+                break
+            if not conn.enqueue(item):
+                break
+            ack.track(item, entry_id)
+            budget -= item.size
+            delivered.append(entry_id)
+        ack.seal(conn)
+        if not delivered:
+            return
+        mailbox.delivered += len(delivered)
+        log_event("INFO", "MESSAGE", f"📬 补发离线消息 {len(delivered)}/{len(entries)} 条到 {conn.client_token[:20]}...", "")
+
+    async def handle_client_message(self, websocket: WebSocket, data: str):
+        """处理客户端发来的控制消息，无法识别的内容只记录日志"""
+        conn = self.clients.get(websocket)
+        try:
+            message = json.loads(data)
+        except ValueError:
+            message = None
+        if conn is None or not isinstance(message, dict):
+            logger.info(f"已接收来自 {conn.client_token[:20] if conn else '-'}... 的消息: {data}")
+            return
+        if message.get("type") == "ack":
+            # 客户端确认已处理该条离线消息（v2 连接上消息可能交错完成，因此按条确认）
+            await mailbox.remove(conn.client_token, str(message.get("mailbox_id", "")))
+            return
+        if message.get("type") == "cache_miss":
+            # 客户端缓存已淘汰该图片：从服务端缓存补发完整数据
+            sha256 = str(message.get("sha256", ""))
+            conn.known_images.pop(sha256, None)
+            transfer_id = str(message.get("transfer_id", ""))
+            cached = image_cache.get(sha256, conn.client_token)
+            if cached is None:
+                log_event("WARNING", "BINARY", f"⚠️ 客户端缓存未命中且服务端缓存已淘汰: {sha256[:12]}", transfer_id)
+                conn.enqueue(OutboundText(json.dumps({
+                    "type": "binary_error",
+                    "transfer_id": transfer_id,
+                    "sha256": sha256,
+                    "reason": "cache_evicted"
+                })))
+                return
+            image, content_type = cached
+            log_event("INFO", "BINARY", f"🔁 客户端缓存未命中, 补发图片: {sha256[:12]}, 大小: {format_size(len(image))}", transfer_id)
+            conn.enqueue(OutboundBinary(image, {
+                "data_type": "image",
+                "filename": str(message.get("filename", "")),
+                "content_type": content_type,
+                "transfer_id": transfer_id,
+                "sha256": sha256
+            }))
+            return
+        logger.info(f"已接收来自 {conn.client_token[:20]}... 的消息: {data}")
 
 
 manager = ConnectionManager()
 
+# ==================== 离线信箱 ====================
+
+MAILBOX_ENABLED = os.getenv("MAILBOX_ENABLED", "true").lower() == "true"
+MAILBOX_MAX_LEN = int(os.getenv("MAILBOX_MAX_LEN", "100"))  # 每个客户端最多暂存的消息数
+MAILBOX_TTL = int(os.getenv("MAILBOX_TTL", "86400"))  # 暂存时间（秒）
+MAILBOX_MAX_IMAGE_BYTES = int(os.getenv("MAILBOX_MAX_IMAGE_BYTES", str(1024 * 1024)))  # 可暂存的最大图片
+MAILBOX_MAX_BYTES = int(os.getenv("MAILBOX_MAX_BYTES", str(4 * 1024 * 1024)))  # 每个客户端暂存内容的总字节数上限
+MAILBOX_CLAIM_TTL = int(os.getenv("MAILBOX_CLAIM_TTL", "120"))  # 补发期间占用信箱的最长时间（秒）
+
+# 补发结束：删除已确认的条目，并在占用者仍是自己时释放占用
+# KEYS: mailbox:{token}, mailbox_claim:{token}
+# ARGV: 占用标识, 要删除的条目 ID...
+MAILBOX_RELEASE_LUA = """
+local removed = 0
+if #ARGV > 1 then
+    removed = redis.call('XDEL', KEYS[1], unpack(ARGV, 2))
+end
+if redis.call('GET', KEYS[2]) == ARGV[1] then
+    redis.call('DEL', KEYS[2])
+end
+return removed
+"""
+
+# 写入一条离线消息，同时限制条数和总字节数（超出时丢弃最早的条目）
+# mailbox_bytes:{token} 只在写入时增加、删除条目时不减，是实际用量的上界；
+# 超出预算时才按现有条目重新统计，因此确认、游标清理和 MAXLEN 裁剪都不必维护它
+# KEYS: mailbox:{token}, mailbox_bytes:{token}
+# ARGV: kind, data, 最大条数, 最大字节数, TTL
+# 返回: 信箱 ID，单条超过字节上限时返回 false
+MAILBOX_PUSH_LUA = """
+local size = #ARGV[2]
+local max_bytes = tonumber(ARGV[4])
+if size > max_bytes then
+    return false
+end
+local used = tonumber(redis.call('GET', KEYS[2]) or '0')
+if used + size > max_bytes then
+    local entries = redis.call('XRANGE', KEYS[1], '-', '+')
+    local sizes = {}
+    used = 0
+    for i, entry in ipairs(entries) do
+        local fields = entry[2]
+        sizes[i] = 0
+        for j = 1, #fields, 2 do
+            if fields[j] == 'data' then
+                sizes[i] = #fields[j + 1]
+            end
+        end
+        used = used + sizes[i]
+    end
+    local i = 1
+    while used + size > max_bytes and i <= #entries do
+        redis.call('XDEL', KEYS[1], entries[i][1])
+        used = used - sizes[i]
+        i = i + 1
+    end
+end
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', ARGV[3], '*', 'kind', ARGV[1], 'data', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('SET', KEYS[2], used + size, 'EX', ARGV[5])
+return id
+"""
+
+mailbox_release_script = None
+mailbox_push_script = None
+
+
+def parse_stream_id(entry_id: str) -> tuple:
+    """解析 Redis Stream ID（毫秒时间戳-序号），格式错误时抛出 ValueError"""
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+class Mailbox:
+    """
+    离线信箱：没有活跃连接时暂存消息，客户端连接后一次性补发
+
+    使用 Redis Stream mailbox:{client_token}（限制条数和总字节数，键 TTL + 读取时按 ID 时间过滤限制保留时间），
+    没有 Redis 时无法解析 appToken，也就不会暂存消息。
+    补发前先占用信箱（mailbox_claim:{client_token}，同时连接的其他 socket 不会重复补发），
+    Redis 模式下游标确认、占用和读取都在握手脚本中完成，不额外增加往返
+    """
+
+    def __init__(self, max_len: int, max_bytes: int, ttl: int):
+        self.max_len = max_len
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.queued = 0
+        self.delivered = 0
+        self.acked = 0
+
+    @staticmethod
+    def key(client_token: str) -> str:
+        return f"mailbox:{client_token}"
+
+    @staticmethod
+    def claim_key(client_token: str) -> str:
+        return f"mailbox_claim:{client_token}"
+
+    @staticmethod
+    def bytes_key(client_token: str) -> str:
+        return f"mailbox_bytes:{client_token}"
+
+    @staticmethod
+    def cursor_min_id(cursor: str) -> str:
+        """客户端游标对应的 XTRIM MINID（删除该条及更早的条目），格式错误返回空串"""
+        try:
+            ms, seq = parse_stream_id(cursor)
+        except ValueError:
+            return ""
+        return f"{ms}-{seq + 1}"
+
+    async def push(self, client_token: str, kind: str, payload: dict) -> Optional[str]:
+        """暂存一条消息，返回信箱 ID，失败返回 None"""
+        return (await self.push_many([(client_token, kind, payload)]))[0]
+
+    async def push_many(self, entries: list) -> list:
+        """暂存多条消息 [(client_token, kind, payload)]，一次 Redis 往返，返回对应的信箱 ID 列表"""
+        if redis_client is None:
+            return [None] * len(entries)
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for client_token, kind, payload in entries:
+                data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+                await mailbox_push_script(
+                    keys=[self.key(client_token), self.bytes_key(client_token)],
+                    args=[kind, data, self.max_len, self.max_bytes, self.ttl],
+                    client=pipe
+                )
+            entry_ids = [entry_id or None for entry_id in await pipe.execute()]
+        except Exception as e:
+            logger.error(f"写入离线信箱失败: {e}")
+            return [None] * len(entries)
+        self.queued += sum(1 for entry_id in entry_ids if entry_id)
+        return entry_ids
+
+    def _entries(self, rows) -> list:
+        """过滤过期条目并解析，返回 [(entry_id, kind, payload)]"""
+        cutoff = int((time.time() - self.ttl) * 1000)
+        entries = []
+        for entry_id, kind, data in rows:
+            if parse_stream_id(entry_id)[0] < cutoff:
+                continue
+            try:
+                entries.append((entry_id, kind, json.loads(data)))
+            except ValueError:
+                continue
+        return entries
+
+    def replay_entries(self, raw: list) -> list:
+        """解析握手脚本返回的 XRANGE 结果"""
+        rows = []
+        for entry_id, flat in raw:
+            fields = dict(zip(flat[::2], flat[1::2]))
+            rows.append((entry_id, fields.get("kind", "message"), fields.get("data", "{}")))
+        return self._entries(rows)
+
+    async def release(self, client_token: str, claim: str, *entry_ids: str) -> int:
+        """补发结束：删除已确认的条目并释放占用，返回删除的条数"""
+        if not claim:
+            return await self.remove(client_token, *entry_ids) if entry_ids else 0
+        try:
+            removed = await mailbox_release_script(
+                keys=[self.key(client_token), self.claim_key(client_token)],
+                args=[claim, *entry_ids]
+            )
+        except Exception as e:
+            logger.error(f"确认离线信箱失败: {e}")
+            return 0
+        self.acked += removed
+        return removed
+
+    async def remove(self, client_token: str, *entry_ids: str) -> int:
+        """按条确认消息，返回删除的条数"""
+        valid = []
+        for entry_id in entry_ids:
+            try:
+                parse_stream_id(entry_id)
+            except ValueError:
+                continue
+            valid.append(entry_id)
+        if not valid or redis_client is None:
+            return 0
+        try:
+            removed = await redis_client.xdel(self.key(client_token), *valid)
+        except Exception as e:
+            logger.error(f"确认离线信箱失败: {e}")
+            return 0
+        self.acked += removed
+        return removed
+
+    def stats(self) -> dict:
+        return {
+            "enabled": MAILBOX_ENABLED,
+            "max_bytes": self.max_bytes,
+            "queued": self.queued,
+            "delivered": self.delivered,
+            "acked": self.acked
+        }
+
+
+mailbox = Mailbox(MAILBOX_MAX_LEN, MAILBOX_MAX_BYTES, MAILBOX_TTL)
+
 # ==================== 日志队列（环形缓冲区）====================
 
 MAX_LOGS = 1000  # 最大日志条数
+LOG_STREAM_KEEPALIVE = float(os.getenv("LOG_STREAM_KEEPALIVE", "15"))  # 实时日志心跳间隔（秒）
+LOG_STREAM_BATCH_DELAY = float(os.getenv("LOG_STREAM_BATCH_DELAY", "0.2"))  # 合并突发日志的等待时间（秒）
+LOG_RATE_WINDOW_MINUTES = int(os.getenv("LOG_RATE_WINDOW_MINUTES", "60"))  # 日志速率统计窗口（分钟）
 
 
 class LogEntry:
     """日志条目"""
-    def __init__(self, level: str, category: str, message: str, transfer_id: str = ""):
-        self.id = secrets.token_hex(8)
-        # 使用中国时区时间戳
-        self.timestamp = now_china().isoformat()
+    __slots__ = ("seq", "epoch", "level", "category", "message", "transfer_id")
+
+    def __init__(self, seq: int, level: str, category: str, message: str, transfer_id: str = ""):
+        self.seq = seq  # 单调递增序号
+        self.epoch = time.time()
         self.level = level  # INFO, WARNING, ERROR, DEBUG
         self.category = category  # BINARY, WEBSOCKET, MESSAGE, AUTH, REDIS, SYSTEM
         self.message = message
         self.transfer_id = transfer_id
+
+    @property
+    def timestamp(self) -> str:
+        """中国时区时间戳（读取时才格式化，写入日志时不做时区换算）"""
+        return datetime.fromtimestamp(self.epoch, CHINA_TZ).isoformat()
     
     def to_dict(self):
         return {
-            "id": self.id,
+            "id": self.seq,
+            "seq": self.seq,
             "timestamp": self.timestamp,
             "level": self.level,
             "category": self.category,
@@ -221,70 +1570,685 @@ class LogEntry:
         }
 
 
+class LogRing:
+    """定长环形数组，下标 0 为最旧的元素"""
+    __slots__ = ("_buf", "_capacity", "_head", "_size")
+
+    def __init__(self, capacity: int):
+        self._buf = [None] * capacity
+        self._capacity = capacity
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index: int):
+        return self._buf[(self._head + index) % self._capacity]
+
+    def append(self, item):
+        """追加元素，已满时覆盖并返回最旧的元素"""
+        evicted = None
+        if self._size == self._capacity:
+            evicted = self.popleft()
+        self._buf[(self._head + self._size) % self._capacity] = item
+        self._size += 1
+        return evicted
+
+    def popleft(self):
+        item = self._buf[self._head]
+        self._buf[self._head] = None
+        self._head = (self._head + 1) % self._capacity
+        self._size -= 1
+        return item
+
+    def clear(self):
+        self._buf = [None] * self._capacity
+        self._head = 0
+        self._size = 0
+
+    def bisect_right(self, value, key) -> int:
+        """返回第一个 key(item) > value 的下标（元素需按 key 有序）"""
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(self[mid]) <= value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+_seq_key = operator.attrgetter("seq")
+_epoch_key = operator.attrgetter("epoch")
+
+
+def parse_log_time(value: str) -> float:
+    """解析查询参数中的时间（未带时区时按中国时区），返回 Unix 时间戳"""
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = CHINA_TZ.localize(dt)
+    return dt.timestamp()
+
+
+class RateWindow:
+    """
+    滚动速率窗口：按分钟分桶的定长计数数组
+
+    每个桶记录所属的分钟，写入时发现桶已过期则先清零，
+    因此不需要定时任务推进窗口
+    """
+    __slots__ = ("_counts", "_minutes", "_size")
+
+    def __init__(self, size: int = LOG_RATE_WINDOW_MINUTES):
+        self._size = size
+        self._counts = [0] * size
+        self._minutes = [-1] * size
+
+    def add(self, minute: int, count: int = 1):
+        index = minute % self._size
+        if self._minutes[index] != minute:
+            self._minutes[index] = minute
+            self._counts[index] = 0
+        self._counts[index] += count
+
+    def series(self, minute: int) -> list:
+        """返回窗口内每分钟的计数（从旧到新，最后一项为当前分钟）"""
+        result = []
+        for m in range(minute - self._size + 1, minute + 1):
+            index = m % self._size
+            result.append(self._counts[index] if self._minutes[index] == m else 0)
+        return result
+
+
 class LogQueue:
-    """日志队列（环形缓冲区）"""
+    """
+    日志队列（环形缓冲区）
+
+    主环按序号保存全部日志，另为每个级别、每个分类维护一个索引环；
+    条目从主环淘汰时，必然也是对应索引环中最旧的条目。
+    所有操作都是同步的且只在事件循环线程中调用，不需要加锁
+    """
     def __init__(self, max_size=MAX_LOGS):
         self.max_size = max_size
-        self.logs = []
-        self.lock = asyncio.Lock()
+        self.logs = LogRing(max_size)
+        self.by_level: Dict[str, LogRing] = {}
+        self.by_category: Dict[str, LogRing] = {}
+        # 缓冲区内各级别、各分类的条数，追加和淘汰时增量维护
+        self.level_counts: Dict[str, int] = {}
+        self.category_counts: Dict[str, int] = {}
+        # 各级别的滚动速率窗口（不随清空重置）
+        self.rates: Dict[str, RateWindow] = {}
+        self.last_seq = 0
+        # 磁盘日志存储（LOG_STORE_DIR 配置时在启动阶段挂载）
+        self.store = None
+        # 清空次数及清空时的序号，实时推送据此通知客户端重置列表
+        self.generation = 0
+        self.cleared_seq = 0
+        # 等待新日志的实时推送订阅者
+        self.waiters: Set[asyncio.Future] = set()
+
+    def _index(self, rings: Dict[str, LogRing], name: str) -> LogRing:
+        ring = rings.get(name)
+        if ring is None:
+            ring = rings[name] = LogRing(self.max_size)
+        return ring
     
-    async def add(self, level: str, category: str, message: str, transfer_id: str = ""):
+    def add(self, level: str, category: str, message: str, transfer_id: str = ""):
         """添加日志"""
-        async with self.lock:
-            entry = LogEntry(level, category, message, transfer_id)
-            self.logs.append(entry)
-            # 超过最大容量时删除最旧的日志
-            if len(self.logs) > self.max_size:
-                self.logs.pop(0)
+        self.last_seq += 1
+        entry = LogEntry(self.last_seq, level, category, message, transfer_id)
+        # 超过最大容量时淘汰最旧的日志
+        evicted = self.logs.append(entry)
+        if evicted is not None:
+            self.by_level[evicted.level].popleft()
+            self.by_category[evicted.category].popleft()
+            self._decrement(self.level_counts, evicted.level)
+            self._decrement(self.category_counts, evicted.category)
+        self._index(self.by_level, level).append(entry)
+        self._index(self.by_category, category).append(entry)
+        self.level_counts[level] = self.level_counts.get(level, 0) + 1
+        self.category_counts[category] = self.category_counts.get(category, 0) + 1
+        
+        window = self.rates.get(level)
+        if window is None:
+            window = self.rates[level] = RateWindow()
+        window.add(int(entry.epoch // 60))
+        if self.store is not None:
+            self.store.append(entry)
+        if self.waiters:
+            self._notify()
     
-    async def get(self, level: str = None, category: str = None,
-                  since: str = None, limit: int = 100):
-        """获取日志（支持过滤）"""
-        async with self.lock:
-            filtered = self.logs.copy()
-            
-            # 按级别过滤
-            if level:
-                filtered = [log for log in filtered if log.level == level]
-            
-            # 按分类过滤
-            if category:
-                filtered = [log for log in filtered if log.category == category]
-            
-            # 按时间过滤
-            if since:
-                since_dt = datetime.fromisoformat(since)
-                filtered = [log for log in filtered if datetime.fromisoformat(log.timestamp) > since_dt]
-            
-            # 按时间倒序排列
-            filtered.sort(key=lambda x: x.timestamp, reverse=True)
-            
-            # 限制数量
-            return [log.to_dict() for log in filtered[:limit]]
+    @staticmethod
+    def _decrement(counts: Dict[str, int], name: str):
+        remaining = counts[name] - 1
+        if remaining:
+            counts[name] = remaining
+        else:
+            del counts[name]
+    
+    def _notify(self):
+        """唤醒所有等待新日志的订阅者"""
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+    
+    async def wait(self, timeout: float) -> bool:
+        """等待新日志或清空事件，超时返回 False"""
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiters.discard(waiter)
+    
+    def attach_store(self, store: "LogStore"):
+        """
+        挂载磁盘日志存储
+
+        序号接续磁盘中已有的最大序号；挂载前产生的日志尚未对外展示，
+        整体平移序号后补写到磁盘
+        """
+        offset = store.last_seq
+        for i in range(len(self.logs)):
+            entry = self.logs[i]
+            entry.seq += offset
+            store.append(entry)
+        self.last_seq += offset
+        self.cleared_seq += offset
+        self.store = store
+    
+    def get(self, level: str = None, category: str = None,
+            since: str = None, since_seq: int = None, limit: int = 100,
+            before_seq: int = None):
+        """获取日志（按时间倒序，支持按级别/分类/时间/序号过滤）"""
+        # 选择最小的候选环，另一个条件逐条判断
+        ring = self.logs
+        if level:
+            ring = self.by_level.get(level)
+        if category:
+            category_ring = self.by_category.get(category)
+            if ring is None or category_ring is None:
+                return []
+            if len(category_ring) < len(ring):
+                ring = category_ring
+        if ring is None:
+            return []
+        
+        # 按序号或时间确定下界（环内条目按序号和时间有序）
+        start = 0
+        if since_seq is not None:
+            start = ring.bisect_right(since_seq, _seq_key)
+        if since:
+            start = max(start, ring.bisect_right(parse_log_time(since), _epoch_key))
+        end = len(ring)
+        if before_seq is not None:
+            end = ring.bisect_right(before_seq - 1, _seq_key)
+        
+        result = []
+        for i in range(end - 1, start - 1, -1):
+            log = ring[i]
+            if (level and log.level != level) or (category and log.category != category):
+                continue
+            result.append(log.to_dict())
+            if len(result) >= limit:
+                break
+        return result
+    
+    def seq_at_time(self, epoch: float) -> Optional[int]:
+        """返回缓冲区中第一条晚于指定时间的日志序号，早于缓冲区时返回 None"""
+        if not len(self.logs) or self.logs[0].epoch > epoch:
+            return None
+        index = self.logs.bisect_right(epoch, _epoch_key)
+        return self.logs[index].seq if index < len(self.logs) else self.last_seq + 1
     
-    async def get_stats(self):
-        """获取日志统计"""
-        async with self.lock:
-            by_level = {}
-            by_category = {}
-            for log in self.logs:
-                by_level[log.level] = by_level.get(log.level, 0) + 1
-                by_category[log.category] = by_category.get(log.category, 0) + 1
-            return {
-                "total": len(self.logs),
-                "by_level": by_level,
-                "by_category": by_category
+    def get_stats(self, with_series: bool = False):
+        """获取日志统计（计数增量维护，不遍历缓冲区）"""
+        return {
+            "total": len(self.logs),
+            "total_appended": self.last_seq,
+            "by_level": dict(self.level_counts),
+            "by_category": dict(self.category_counts),
+            "rates": self.get_rates(with_series)
+        }
+    
+    def get_rates(self, with_series: bool = False):
+        """获取各级别最近 1 分钟、5 分钟和整个窗口内的日志数"""
+        minute = int(time.time() // 60)
+        rates = {}
+        for level, window in self.rates.items():
+            series = window.series(minute)
+            rate = {
+                "last_minute": series[-1],
+                "last_5_minutes": sum(series[-5:]),
+                "window": sum(series),
             }
+            if with_series:
+                rate["per_minute"] = series
+            rates[level] = rate
+        return {"window_minutes": LOG_RATE_WINDOW_MINUTES, "by_level": rates}
     
-    async def clear(self):
+    def clear(self):
         """清空日志"""
-        async with self.lock:
-            self.logs.clear()
+        self.logs.clear()
+        self.by_level.clear()
+        self.by_category.clear()
+        self.level_counts.clear()
+        self.category_counts.clear()
+        self.generation += 1
+        self.cleared_seq = self.last_seq
+        self._notify()
 
 
 log_queue = LogQueue()
 
 
+# ==================== 磁盘日志存储（可选）====================
+
+LOG_STORE_DIR = os.getenv("LOG_STORE_DIR", "")  # 为空时不落盘
+LOG_SEGMENT_SIZE = int(os.getenv("LOG_SEGMENT_SIZE", str(16 * 1024 * 1024)))  # 单个段文件大小上限（字节）
+LOG_RETENTION_DAYS = float(os.getenv("LOG_RETENTION_DAYS", "7"))  # 段文件保留天数
+LOG_INDEX_INTERVAL = int(os.getenv("LOG_INDEX_INTERVAL", "64"))  # 每隔多少条日志记录一个索引点
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1"))  # 写盘间隔（秒）
+LOG_STORE_MAX_PENDING = 50000  # 待写盘日志上限，磁盘阻塞时丢弃最旧的
+LOG_STORE_MAX_SLOTS = 64  # 多 worker 时的子目录数量上限
+
+
+class SegmentIndex:
+    """
+    已封存日志段的稀疏索引（内存映射）
+
+    每条记录: 序号(u64) | 时间戳(f64) | 数据文件偏移(u64)，按序号递增
+    """
+    RECORD = struct.Struct("<QdQ")
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._count = os.fstat(self._file.fileno()).st_size // self.RECORD.size
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._count else None
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index: int):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return self.RECORD.unpack_from(self._mm, index * self.RECORD.size)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+
+class LogSegment:
+    """日志段：JSONL 数据文件 + 稀疏索引文件，文件名为段内第一条日志的序号"""
+
+    def __init__(self, directory: str, first_seq: int):
+        self.first_seq = first_seq
+        base = os.path.join(directory, f"{first_seq:020d}")
+        self.data_path = base + ".jsonl"
+        self.index_path = base + ".idx"
+        # 活跃段为内存列表，封存段按需映射索引文件
+        self.index = None
+
+    def open_index(self):
+        if self.index is None:
+            if os.path.exists(self.index_path) and os.path.getsize(self.index_path):
+                self.index = SegmentIndex(self.index_path)
+            else:
+                self.index = []
+        return self.index
+
+    def close(self):
+        if isinstance(self.index, SegmentIndex):
+            self.index.close()
+        self.index = None
+
+    def remove(self):
+        self.close()
+        for path in (self.data_path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+_index_seq_key = operator.itemgetter(0)
+_index_epoch_key = operator.itemgetter(1)
+
+
+class LogStore:
+    """
+    磁盘日志存储：按大小轮转的 JSONL 段文件 + 稀疏索引
+
+    日志在内存中攒批，由后台任务在线程中写盘，事件循环不做磁盘 IO；
+    每 LOG_INDEX_INTERVAL 条日志记录一个 (序号, 时间, 偏移) 索引点，
+    查询历史时二分索引定位数据块，只读取需要的块。
+    多 worker 时每个进程通过文件锁占用一个 worker-N 子目录
+    """
+
+    def __init__(self, root: str, segment_size: int = LOG_SEGMENT_SIZE,
+                 retention_days: float = LOG_RETENTION_DAYS, index_interval: int = LOG_INDEX_INTERVAL):
+        self.root = root
+        self.directory = None
+        self.segment_size = segment_size
+        self.retention = retention_days * 86400
+        self.index_interval = index_interval
+        self.segments: list = []
+        self.pending: list = []
+        self.dropped = 0
+        self.last_seq = 0
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._data_file = None
+        self._index_file = None
+        self._active_size = 0
+        self._since_index = 0
+        self._last_retention = 0.0
+        self._task = None
+
+    # ---------- 打开与恢复 ----------
+
+    def open(self):
+        """占用存储目录并从最后一个段恢复写入位置"""
+        os.makedirs(self.root, exist_ok=True)
+        for slot in range(LOG_STORE_MAX_SLOTS):
+            directory = os.path.join(self.root, f"worker-{slot}")
+            os.makedirs(directory, exist_ok=True)
+            lock_file = open(os.path.join(directory, ".lock"), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue
+            self._lock_file = lock_file
+            self.directory = directory
+            break
+        else:
+            raise RuntimeError(f"日志存储目录均被占用: {self.root}")
+
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".jsonl"))
+        self.segments = [LogSegment(self.directory, int(name[:-len(".jsonl")])) for name in names]
+        if self.segments:
+            self._recover(self.segments[-1])
+
+    def _recover(self, segment: LogSegment):
+        """恢复活跃段：截掉未写完的尾部，重建内存索引和最大序号"""
+        record_size = SegmentIndex.RECORD.size
+        with open(segment.data_path, "rb") as f:
+            data_size = f.seek(0, os.SEEK_END)
+            index = []
+            if os.path.exists(segment.index_path):
+                with open(segment.index_path, "rb") as idx:
+                    raw = idx.read()
+                for offset in range(0, len(raw) - record_size + 1, record_size):
+                    point = SegmentIndex.RECORD.unpack_from(raw, offset)
+                    if point[2] < data_size:
+                        index.append(point)
+            tail_offset = index[-1][2] if index else 0
+            f.seek(tail_offset)
+            tail = f.read()
+
+        # 崩溃时可能留下半行
+        complete = tail.rfind(b"\n") + 1
+        if tail_offset + complete < data_size:
+            os.truncate(segment.data_path, tail_offset + complete)
+        lines = tail[:complete].splitlines()
+        with open(segment.index_path, "wb") as idx:
+            idx.write(b"".join(SegmentIndex.RECORD.pack(*point) for point in index))
+
+        segment.index = index
+        self._active_size = tail_offset + complete
+        self._since_index = len(lines)
+        for line in reversed(lines):
+            try:
+                self.last_seq = json.loads(line)["seq"]
+                break
+            except (ValueError, KeyError):
+                continue
+        else:
+            if index:
+                self.last_seq = index[-1][0] - 1
+        self._data_file = open(segment.data_path, "ab")
+        self._index_file = open(segment.index_path, "ab")
+
+    # ---------- 写入 ----------
+
+    def append(self, entry: LogEntry):
+        """在事件循环中调用，只放入待写盘列表"""
+        self.pending.append(entry)
+        if len(self.pending) > LOG_STORE_MAX_PENDING:
+            del self.pending[:len(self.pending) - LOG_STORE_MAX_PENDING]
+            self.dropped += 1
+
+    async def flush(self):
+        """把待写盘日志交给线程写入"""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        await asyncio.to_thread(self._write, batch)
+
+    def _write(self, batch: list):
+        with self._lock:
+            data, points = [], []
+            for entry in batch:
+                if self._data_file is None or self._active_size >= self.segment_size:
+                    self._write_buffers(data, points)
+                    data, points = [], []
+                    self._rotate(entry.seq)
+                if not self.segments[-1].index or self._since_index >= self.index_interval:
+                    point = (entry.seq, entry.epoch, self._active_size)
+                    self.segments[-1].index.append(point)
+                    points.append(SegmentIndex.RECORD.pack(*point))
+                    self._since_index = 0
+                line = json.dumps(entry.to_dict(), ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+                data.append(line)
+                self._active_size += len(line)
+                self._since_index += 1
+            self._write_buffers(data, points)
+            self.last_seq = batch[-1].seq
+            self._apply_retention()
+
+    def _write_buffers(self, data: list, points: list):
+        # 先写数据再写索引，索引点总是指向已落盘的数据
+        if data:
+            self._data_file.write(b"".join(data))
+            self._data_file.flush()
+        if points:
+            self._index_file.write(b"".join(points))
+            self._index_file.flush()
+
+    def _rotate(self, first_seq: int):
+        """封存当前段并开始新段"""
+        if self._data_file is not None:
+            self._data_file.close()
+            self._index_file.close()
+            self.segments[-1].close()
+        segment = LogSegment(self.directory, first_seq)
+        segment.index = []
+        self.segments.append(segment)
+        self._data_file = open(segment.data_path, "ab")
+        self._index_file = open(segment.index_path, "ab")
+        self._active_size = 0
+        self._since_index = 0
+
+    def _apply_retention(self):
+        """删除超过保留期的封存段（按文件最后修改时间，每分钟最多检查一次）"""
+        now = time.time()
+        if now - self._last_retention < 60:
+            return
+        self._last_retention = now
+        while len(self.segments) > 1:
+            try:
+                expired = os.path.getmtime(self.segments[0].data_path) < now - self.retention
+            except FileNotFoundError:
+                expired = True
+            if not expired:
+                break
+            self.segments.pop(0).remove()
+
+    async def run(self):
+        """后台定时写盘"""
+        while True:
+            await asyncio.sleep(LOG_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"日志写盘失败: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        with self._lock:
+            if self._data_file is not None:
+                self._data_file.close()
+                self._index_file.close()
+                self._data_file = None
+            for segment in self.segments:
+                segment.close()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "segments": len(self.segments),
+            "last_seq": self.last_seq,
+            "pending": len(self.pending),
+            "dropped": self.dropped
+        }
+
+    # ---------- 查询 ----------
+
+    def query(self, before_seq: int, level: str = None, category: str = None, limit: int = 100) -> list:
+        """按序号从新到旧读取 seq < before_seq 的日志（在线程中调用）"""
+        # 紧凑 JSON 下可以先按原始字节粗筛，命中后再解析
+        needles = []
+        if level:
+            needles.append(json.dumps({"level": level}, ensure_ascii=False, separators=(",", ":"))[1:-1].encode("utf-8"))
+        if category:
+            needles.append(json.dumps({"category": category}, ensure_ascii=False, separators=(",", ":"))[1:-1].encode("utf-8"))
+
+        result = []
+        with self._lock:
+            for segment in reversed(self.segments):
+                if segment.first_seq >= before_seq:
+                    continue
+                index = segment.open_index()
+                if not len(index) or index[0][2] != 0:
+                    # 索引文件缺失或不完整时，把段开头当作第一个块
+                    index = [(segment.first_seq, 0.0, 0)] + list(index)
+                # 第一个序号 >= before_seq 的索引点之前的块才可能命中
+                block = bisect.bisect_left(index, before_seq, key=_index_seq_key)
+                with open(segment.data_path, "rb") as f:
+                    block_end = index[block][2] if block < len(index) else f.seek(0, os.SEEK_END)
+                    for i in range(block - 1, -1, -1):
+                        block_start = index[i][2]
+                        f.seek(block_start)
+                        lines = f.read(block_end - block_start).splitlines()
+                        block_end = block_start
+                        for line in reversed(lines):
+                            if any(needle not in line for needle in needles):
+                                continue
+                            try:
+                                log = json.loads(line)
+                            except ValueError:
+                                continue
+                            if log["seq"] >= before_seq:
+                                continue
+                            if (level and log["level"] != level) or (category and log["category"] != category):
+                                continue
+                            result.append(log)
+                            if len(result) >= limit:
+                                return result
+        return result
+
+    def seq_at_time(self, epoch: float) -> Optional[int]:
+        """借助索引定位第一条晚于指定时间的日志序号（在线程中调用）"""
+        with self._lock:
+            for segment in self.segments:
+                index = segment.open_index()
+                if not len(index) or index[0][2] != 0:
+                    index = [(segment.first_seq, 0.0, 0)] + list(index)
+                block = bisect.bisect_right(index, epoch, key=_index_epoch_key)
+                if block == 0:
+                    return index[0][0]
+                # 目标位于 block - 1 块内，逐行比较时间；最后一个索引点之后的块读到段尾
+                with open(segment.data_path, "rb") as f:
+                    f.seek(index[block - 1][2])
+                    if block < len(index):
+                        lines = f.read(index[block][2] - index[block - 1][2]).splitlines()
+                    else:
+                        lines = f.read().splitlines()
+                for line in lines:
+                    try:
+                        log = json.loads(line)
+                    except ValueError:
+                        continue
+                    if parse_log_time(log["timestamp"]) > epoch:
+                        return log["seq"]
+                if block < len(index):
+                    return index[block][0]
+        return None
+
+
+log_store = LogStore(LOG_STORE_DIR) if LOG_STORE_DIR else None
+
+
+async def open_log_store():
+    """打开磁盘日志存储并挂载到日志队列，失败时仅使用内存缓冲区"""
+    global log_store
+    if log_store is None:
+        return
+    try:
+        await asyncio.to_thread(log_store.open)
+    except Exception as e:
+        log_store = None
+        log_event("ERROR", "SYSTEM", f"磁盘日志存储不可用: {e}")
+        return
+    log_queue.attach_store(log_store)
+    log_store.start()
+    log_event("INFO", "SYSTEM", f"💾 磁盘日志存储已启用: {log_store.directory}（{len(log_store.segments)} 个段）")
+
+
+async def query_log_history(level: str = None, category: str = None, before: str = None,
+                            before_seq: int = None, limit: int = 100) -> list:
+    """向前翻页查询日志：先查内存缓冲区，不足时从磁盘日志存储读取"""
+    if before:
+        epoch = parse_log_time(before)
+        seq = log_queue.seq_at_time(epoch)
+        if seq is None and log_store is not None:
+            await log_store.flush()
+            seq = await asyncio.to_thread(log_store.seq_at_time, epoch)
+        if seq is None:
+            seq = log_queue.last_seq + 1
+        before_seq = seq if before_seq is None else min(before_seq, seq)
+    
+    logs = log_queue.get(level=level, category=category, before_seq=before_seq, limit=limit)
+    if len(logs) < limit and log_store is not None:
+        # 缓冲区之前的日志从磁盘读取
+        floor = before_seq
+        if len(log_queue.logs):
+            floor = min(floor, log_queue.logs[0].seq)
+        await log_store.flush()
+        logs += await asyncio.to_thread(log_store.query, floor, level, category, limit - len(logs))
+    return logs
+
+
 def format_size(size_bytes: int) -> str:
     """将字节转换为易读的单位（MB）"""
     if size_bytes < 1024:
@@ -305,8 +2269,8 @@ def log_event(level: str, category: str, message: str, transfer_id: str = ""):
     else:
         logger.info(f"[{category}] {message}")
     
-    # 添加到日志队列
-    asyncio.create_task(log_queue.add(level, category, message, transfer_id))
+    # 添加到日志队列（同步追加，不创建任务）
+    log_queue.add(level, category, message, transfer_id)
 
 # 请求体模型
 
@@ -317,6 +2281,22 @@ class Message(BaseModel):
     title: str = "通知"
 
 
+class BatchItem(BaseModel):
+    token: str
+    message: str
+    priority: int = 2
+    title: str = "通知"
+
+
+class BatchMessage(BaseModel):
+    """批量推送：items 逐条指定 (token, 消息)；或 tokens + message 把同一条消息推送给多个 token"""
+    items: List[BatchItem] = []
+    tokens: List[str] = []
+    message: Optional[str] = None
+    priority: int = 2
+    title: str = "通知"
+
+
 class LoginRequest(BaseModel):
     password: str
 
@@ -337,6 +2317,61 @@ def verify_session(session_token: Optional[str]) -> bool:
     return True
 
 
+SESSION_KEY_PREFIX = "session:"  # 集群共享会话 session:{token}，随会话过期自动删除
+LEGACY_SESSIONS_KEY = "sessions"  # 旧版共享会话哈希（不会过期，加载时迁移后删除）
+
+
+async def load_shared_sessions():
+    """集群模式下从 Redis 加载其他 worker 创建的会话"""
+    if not manager.cluster or not redis_client:
+        return
+    now = now_china()
+    try:
+        legacy = await redis_client.hgetall(LEGACY_SESSIONS_KEY)
+        if legacy:
+            pipe = redis_client.pipeline(transaction=False)
+            for token, expiry in legacy.items():
+                ttl = int((datetime.fromisoformat(expiry) - now).total_seconds())
+                if ttl > 0:
+                    pipe.set(f"{SESSION_KEY_PREFIX}{token}", expiry, ex=ttl, nx=True)
+            pipe.delete(LEGACY_SESSIONS_KEY)
+            await pipe.execute()
+        keys = [key async for key in redis_client.scan_iter(match=f"{SESSION_KEY_PREFIX}*", count=SCAN_COUNT)]
+        expiries = await redis_client.mget(keys) if keys else []
+    except Exception as e:
+        logger.error(f"加载共享会话失败: {e}")
+        return
+    for key, expiry in zip(keys, expiries):
+        if expiry is None:
+            continue
+        expiry_dt = datetime.fromisoformat(expiry)
+        if expiry_dt > now:
+            active_sessions[key[len(SESSION_KEY_PREFIX):]] = expiry_dt
+
+
+async def share_session(session_token: str, expiry: datetime):
+    """集群模式下把会话同步到 Redis 和其他 worker"""
+    if not manager.cluster or not redis_client:
+        return
+    ttl = max(int((expiry - now_china()).total_seconds()), 1)
+    try:
+        await redis_client.set(f"{SESSION_KEY_PREFIX}{session_token}", expiry.isoformat(), ex=ttl)
+    except Exception as e:
+        logger.error(f"保存共享会话失败: {e}")
+    await manager.broadcast({"kind": "session", "session": session_token, "expiry": expiry.isoformat()})
+
+
+async def revoke_session(session_token: str):
+    """集群模式下在所有 worker 上注销会话"""
+    if not manager.cluster or not redis_client:
+        return
+    try:
+        await redis_client.delete(f"{SESSION_KEY_PREFIX}{session_token}")
+    except Exception as e:
+        logger.error(f"删除共享会话失败: {e}")
+    await manager.broadcast({"kind": "session_revoke", "session": session_token})
+
+
 async def get_current_user(session_token: Optional[str] = Cookie(None, alias="session_token")):
     """获取当前用户（依赖注入）"""
     if not verify_session(session_token):
@@ -346,7 +2381,7 @@ async def get_current_user(session_token: Optional[str] = Cookie(None, alias="se
 
 @app.on_event("startup")
 async def startup_event():
-    global redis_client
+    global redis_client, handshake_script, presence_script, migrate_record_script, mailbox_release_script, mailbox_push_script
     
     # 构建 Redis 连接 URL
     redis_url = os.getenv("REDIS_URI", "")
@@ -363,6 +2398,11 @@ async def startup_event():
     
     try:
         redis_client = await redis.from_url(redis_url, decode_responses=True)
+        handshake_script = redis_client.register_script(HANDSHAKE_LUA)
+        presence_script = redis_client.register_script(PRESENCE_LUA)
+        mailbox_release_script = redis_client.register_script(MAILBOX_RELEASE_LUA)
+        mailbox_push_script = redis_client.register_script(MAILBOX_PUSH_LUA)
+        migrate_record_script = redis_client.register_script(MIGRATE_RECORD_LUA)
         await redis_client.ping()
         # 隐藏密码显示
         safe_url = redis_url.replace(f":{redis_password}@", ":***@") if redis_password else redis_url
@@ -375,12 +2415,35 @@ async def startup_event():
         else:
             raise
 
+    # 打开磁盘日志存储（LOG_STORE_DIR 配置时生效）
+    await open_log_store()
+
+    # 加载离线地理位置库（GEOIP_DB_PATH 配置时生效）
+    await load_geoip_db()
+
+    # 启动后台地理位置补全
+    geo_worker.start()
+
+    # 启动集群分发（FANOUT_MODE=redis 时生效）
+    await manager.start_fanout()
+    await load_shared_sessions()
+
     # 启动定时清理任务
     asyncio.create_task(weekly_cleanup())
+    asyncio.create_task(maintain_fingerprint_indexes())
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await manager.stop_fanout()
+    if _transcode_pool is not None:
+        _transcode_pool.shutdown(wait=False, cancel_futures=True)
+    if log_store is not None and log_store.directory:
+        await log_store.close()
+    await geo_worker.stop()
+    if geoip_db is not None:
+        geoip_db.close()
+    await remote_geo.aclose()
     if redis_client:
         await redis_client.close()
 
@@ -400,6 +2463,7 @@ async def weekly_cleanup():
                     logger.warning("Redis connection lost in cleanup task")
                     continue
                 await redis_client.flushdb()
+                await invalidate_app_token()
                 logger.info("Weekly cleanup completed")
         except Exception as e:
             logger.error(f"Cleanup error: {e}")
@@ -425,7 +2489,6 @@ async def get_client_ip(request: Request) -> str:
 
 def is_private_ip(ip: str) -> bool:
     """检测是否为私有IP地址"""
-    import ipaddress
     try:
         addr = ipaddress.ip_address(ip)
         return addr.is_private
@@ -433,58 +2496,717 @@ def is_private_ip(ip: str) -> bool:
         return False
 
 
-async def get_ip_geolocation(ip: str) -> dict:
-    """获取IP对应的地理位置信息"""
+# ==================== 进程内缓存 ====================
+
+
+class TTLCache:
+    """有界 LRU + TTL 缓存，值为 None 时作为负缓存条目"""
+    MISS = object()
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """命中返回缓存值（可能为 None），未命中或已过期返回 TTLCache.MISS"""
+        item = self._data.get(key)
+        if item is None or item[0] <= time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return TTLCache.MISS
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttl if value is not None else self.negative_ttl
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+
+class ImageCache:
+    """
+    按 sha256 寻址的图片缓存，按总字节数做 LRU 淘汰
+
+    每张图片记录上传或推送过它的 client_token，只有这些 token 能按哈希取回，
+    其他客户端即使知道哈希也拿不到内容
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # sha256 -> (图片数据, content_type)
+        self._owners: Dict[str, Set[str]] = {}  # sha256 -> client_token 集合
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.refs_sent = 0
+        self.bytes_saved = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+    def get(self, key: str, owner: str) -> Optional[tuple]:
+        """owner 引用过该图片且命中时返回 (图片数据, content_type)，否则返回 None"""
+        item = self._data.get(key)
+        if item is None or owner not in self._owners.get(key, ()):
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item
+
+    def put(self, key: str, data: bytes, content_type: str, owner: str):
+        if len(data) > self.max_bytes:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old[0])
+        self._data[key] = (data, content_type)
+        self._owners.setdefault(key, set()).add(owner)
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            evicted_key, (evicted, _) = self._data.popitem(last=False)
+            self._owners.pop(evicted_key, None)
+            self.bytes -= len(evicted)
+
+    def record_ref(self, size: int):
+        """记录一次以引用代替完整数据的发送"""
+        self.refs_sent += 1
+        self.bytes_saved += size
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refs_sent": self.refs_sent,
+            "bytes_saved": self.bytes_saved
+        }
+
+
+# 图片内容缓存（0 表示不缓存，仅影响 cache_miss 补发和按哈希推送；每个 worker 各自缓存）
+image_cache = ImageCache(int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+
+
+# ==================== 图片转码 ====================
+
+IMAGE_TRANSCODE_WORKERS = int(os.getenv("IMAGE_TRANSCODE_WORKERS", "2"))  # 转码进程数，0 表示不转码
+IMAGE_TRANSCODE_MIN_BYTES = int(os.getenv("IMAGE_TRANSCODE_MIN_BYTES", str(256 * 1024)))  # 小于该大小的图片不转码
+IMAGE_TRANSCODE_FORMATS = {"jpeg": "JPEG", "jpg": "JPEG", "png": "PNG", "webp": "WEBP"}
+
+_transcode_pool: Optional[ProcessPoolExecutor] = None
+
+
+def transcode_image(data: bytes, max_dim: int, target: Optional[str], quality: int) -> Optional[tuple]:
+    """
+    缩放 / 重新编码图片（在转码进程中执行）
+
+    返回 (图片数据, content_type, 宽, 高)；尺寸和格式都无需改变，
+    或只改格式但结果更大时返回 None，调用方继续使用原图
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        source = (img.format or "").upper()
+        target = target or source or "PNG"
+        resize = bool(max_dim) and max(img.size) > max_dim
+        if not resize and target == source:
+            return None
+        if resize:
+            img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        if target == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        options = {"optimize": True}
+        if target in ("JPEG", "WEBP"):
+            options["quality"] = quality
+        out = io.BytesIO()
+        img.save(out, format=target, **options)
+        width, height = img.size
+    result = out.getvalue()
+    if not resize and len(result) >= len(data):
+        return None
+    return result, f"image/{target.lower()}", width, height
+
+
+def get_transcode_pool() -> Optional[ProcessPoolExecutor]:
+    global _transcode_pool
+    if Image is None or IMAGE_TRANSCODE_WORKERS <= 0:
+        return None
+    if _transcode_pool is None:
+        # spawn 启动：事件循环进程中已有线程，fork 出的子进程可能继承被占用的锁
+        _transcode_pool = ProcessPoolExecutor(
+            max_workers=IMAGE_TRANSCODE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _transcode_pool
+
+
+async def maybe_transcode_image(
+    data: bytes,
+    content_type: str,
+    filename: str,
+    max_dim: int,
+    image_format: Optional[str],
+    quality: int,
+    transfer_id: str = ""
+) -> tuple:
+    """
+    按请求参数转码图片，返回 (图片数据, content_type, 文件名, 转码信息)
+
+    未请求转码时转码信息为 None；转码失败或被跳过时原样返回图片
+    """
+    if not max_dim and not image_format:
+        return data, content_type, filename, None
+    info = {"original_size": len(data), "size": len(data), "saved": 0, "elapsed": 0.0, "skipped": None}
+    target = IMAGE_TRANSCODE_FORMATS.get((image_format or "").lower()) if image_format else None
+    if image_format and target is None:
+        raise HTTPException(status_code=400, detail=f"不支持的图片格式: {image_format}")
+    pool = get_transcode_pool()
+    if pool is None:
+        info["skipped"] = "未启用（需要安装 Pillow 且 IMAGE_TRANSCODE_WORKERS > 0）"
+        return data, content_type, filename, info
+    if len(data) < IMAGE_TRANSCODE_MIN_BYTES:
+        info["skipped"] = "图片已足够小"
+        return data, content_type, filename, info
+
+    start = time.perf_counter()
+    try:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(pool, transcode_image, data, max_dim, target, min(max(quality, 1), 100))
+    except Exception as e:
+        log_event("WARNING", "BINARY", f"⚠️ 图片转码失败, 发送原图: {e}", transfer_id)
+        info["skipped"] = f"转码失败: {e}"
+        return data, content_type, filename, info
+    info["elapsed"] = round(time.perf_counter() - start, 3)
+    if result is None:
+        info["skipped"] = "无需转码"
+        return data, content_type, filename, info
+
+    data, content_type, width, height = result
+    if target:
+        filename = os.path.splitext(filename)[0] + (mimetypes.guess_extension(content_type) or f".{target.lower()}")
+    info.update(size=len(data), saved=info["original_size"] - len(data), width=width, height=height)
+    log_event(
+        "INFO", "BINARY",
+        f"🗜️ 图片转码完成: {format_size(info['original_size'])} → {format_size(len(data))}, "
+        f"节省 {format_size(max(info['saved'], 0))}, {width}x{height}, 耗时: {info['elapsed']:.3f}秒",
+        transfer_id
+    )
+    return data, content_type, filename, info
+
+
+# ==================== 离线 IP 地理位置库 ====================
+
+# 离线库文件路径（CSV 或编译后的 .bin），为空则不启用
+GEOIP_DB_PATH = os.getenv("GEOIP_DB_PATH", "")
+# 远程 API 兜底: auto（仅在未加载离线库时使用）/ true / false
+GEOIP_REMOTE_LOOKUP = os.getenv("GEOIP_REMOTE_LOOKUP", "auto").lower()
+
+
+class GeoIPDatabase:
+    """
+    基于内存映射的离线 IP 地理位置库
+
+    文件格式（小端序头部）:
+        header:    magic(8s) | 记录数(u32) | 地点数(u32) | 地点表偏移(u64)
+        records:   起始IP(16字节大端) | 结束IP(16字节大端) | 地点索引(u32)，按起始IP排序
+        locations: JSON 数组 [[country, region, city], ...]
+    IPv4 地址统一映射为 ::ffff:a.b.c.d 存储，与 IPv6 共用一张表
+    """
+    MAGIC = b"ZNGEOIP1"
+    HEADER = struct.Struct("<8sIIQ")
+    RECORD = struct.Struct("<16s16sI")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, location_count, locations_offset = self.HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError(f"不是有效的离线地理位置库: {path}")
+        self.locations = json.loads(self._mm[locations_offset:].decode("utf-8"))
+        if len(self.locations) != location_count:
+            self.close()
+            raise ValueError(f"离线地理位置库已损坏: {path}")
+
+    @staticmethod
+    def _ip_key(ip) -> bytes:
+        """把 IP 转换为 16 字节大端序键"""
+        if isinstance(ip, str):
+            ip = ipaddress.ip_address(ip)
+        if ip.version == 4:
+            ip = ipaddress.IPv6Address(b"\x00" * 10 + b"\xff\xff" + ip.packed)
+        return ip.packed
+
+    def lookup(self, ip: str) -> Optional[dict]:
+        """二分查找 IP 所在区间，未命中返回 None"""
+        try:
+            key = self._ip_key(ip)
+        except ValueError:
+            return None
+        mm = self._mm
+        size = self.RECORD.size
+        base = self.HEADER.size
+        lo, hi = 0, self.count
+        # 找到最后一个 起始IP <= key 的记录
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = base + mid * size
+            if mm[offset:offset + 16] <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        start, end, location_index = self.RECORD.unpack_from(mm, base + (lo - 1) * size)
+        if key > end:
+            return None
+        country, region, city = self.locations[location_index]
+        return {"country": country, "region": region, "city": city}
+
+    def close(self):
+        try:
+            self._mm.close()
+        finally:
+            self._file.close()
+
+    @classmethod
+    def compile_csv(cls, csv_path: str, out_path: str) -> int:
+        """
+        把 CSV 编译为二进制库，返回记录数
+
+        支持两种行格式（取最后三列为 国家/地区/城市，无法解析的行视为表头跳过）:
+            network(CIDR),...,country,region,city
+            start_ip,end_ip,...,country,region,city   （IP 也可以是整数形式）
+        """
+        def parse_ip(value: str):
+            value = value.strip()
+            return ipaddress.ip_address(int(value) if value.isdigit() else value)
+
+        ranges = []
+        location_index: Dict[tuple, int] = {}
+        with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+            for row in csv.reader(f):
+                if len(row) < 4:
+                    continue
+                try:
+                    if "/" in row[0]:
+                        network = ipaddress.ip_network(row[0].strip(), strict=False)
+                        start, end = network[0], network[-1]
+                    else:
+                        start, end = parse_ip(row[0]), parse_ip(row[1])
+                except ValueError:
+                    continue
+                location = tuple(col.strip() for col in row[-3:])
+                index = location_index.setdefault(location, len(location_index))
+                ranges.append((cls._ip_key(start), cls._ip_key(end), index))
+
+        ranges.sort()
+        locations = json.dumps([list(loc) for loc in location_index], ensure_ascii=False).encode("utf-8")
+        tmp_path = f"{out_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            locations_offset = cls.HEADER.size + cls.RECORD.size * len(ranges)
+            f.write(cls.HEADER.pack(cls.MAGIC, len(ranges), len(location_index), locations_offset))
+            for record in ranges:
+                f.write(cls.RECORD.pack(*record))
+            f.write(locations)
+        os.replace(tmp_path, out_path)
+        return len(ranges)
+
+    @classmethod
+    def open(cls, path: str) -> "GeoIPDatabase":
+        """打开离线库；传入 CSV 时自动编译为同名 .bin（CSV 更新后重新编译）"""
+        if not path.lower().endswith(".csv"):
+            return cls(path)
+        bin_path = f"{path}.bin"
+        if not os.path.exists(bin_path) or os.path.getmtime(bin_path) < os.path.getmtime(path):
+            count = cls.compile_csv(path, bin_path)
+            logger.info(f"离线地理位置库已编译: {bin_path}, 记录数: {count}")
+        return cls(bin_path)
+
+
+geoip_db: Optional[GeoIPDatabase] = None
+
+
+async def load_geoip_db():
+    """启动时加载离线地理位置库"""
+    global geoip_db
+    if not GEOIP_DB_PATH:
+        return
+    try:
+        geoip_db = await asyncio.to_thread(GeoIPDatabase.open, GEOIP_DB_PATH)
+        log_event("INFO", "SYSTEM", f"🗺️ 离线地理位置库已加载: {geoip_db.path}, 记录数: {geoip_db.count}")
+    except Exception as e:
+        logger.error(f"加载离线地理位置库失败: {e}")
+
+
+def remote_geolocation_enabled() -> bool:
+    """是否允许使用远程 API 查询地理位置"""
+    if GEOIP_REMOTE_LOOKUP in ("true", "1", "yes"):
+        return True
+    if GEOIP_REMOTE_LOOKUP in ("false", "0", "no"):
+        return False
+    return geoip_db is None
+
+
+# ==================== 远程 IP 地理位置查询 ====================
+
+
+def _parse_ip_api(data: dict) -> Optional[dict]:
+    if data.get("status") == "success":
+        return {
+            "country": data.get("country", ""),
+            "region": data.get("regionName", ""),
+            "city": data.get("city", "")
+        }
+    return None
+
+
+def _parse_ipinfo(data: dict) -> Optional[dict]:
+    # ipinfo.io 返回格式不同
+    if "country" in data or "region" in data or "city" in data:
+        return {
+            "country": data.get("country", ""),
+            "region": data.get("region", ""),
+            "city": data.get("city", "")
+        }
+    return None
+
+
+class RemoteGeoClient:
+    """
+    远程地理位置查询客户端
+
+    - 共享一个 keep-alive 的 httpx.AsyncClient
+    - 按 IP 缓存结果，查询失败也会缓存一段时间
+    - 同一 IP 的并发查询合并为一次请求
+    - 对冲请求：首个服务商在 hedge_delay 内未返回时并发请求下一个，先成功者胜出
+    """
+    PROVIDERS = [
+        ("ip-api.com", "http://ip-api.com/json/{ip}?lang=zh-CN", _parse_ip_api),
+        ("ipinfo.io", "https://ipinfo.io/{ip}/json", _parse_ipinfo),
+    ]
+
+    def __init__(self, deadline: float, hedge_delay: float, cache: TTLCache):
+        self.deadline = deadline
+        self.hedge_delay = hedge_delay
+        self.cache = cache
+        self._client: Optional[httpx.AsyncClient] = None
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.deadline),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60)
+            )
+        return self._client
+
+    async def lookup(self, ip: str) -> Optional[dict]:
+        """查询 IP 地理位置，全部失败返回 None"""
+        cached = self.cache.get(ip)
+        if cached is not TTLCache.MISS:
+            return cached
+        task = self._inflight.get(ip)
+        if task is None:
+            task = asyncio.create_task(self._resolve(ip))
+            self._inflight[ip] = task
+            task.add_done_callback(lambda _: self._inflight.pop(ip, None))
+        # shield: 单个调用方被取消时不影响其他等待同一 IP 的调用方
+        return await asyncio.shield(task)
+
+    async def _query(self, name: str, url: str, parser, ip: str) -> dict:
+        response = await self.client.get(url.replace("{ip}", ip))
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        geo = parser(response.json())
+        if geo is None:
+            raise RuntimeError("响应中没有地理位置")
+        return geo
+
+    async def _resolve(self, ip: str) -> Optional[dict]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        providers = iter(self.PROVIDERS)
+        pending: Dict[asyncio.Task, str] = {}
+
+        def launch() -> bool:
+            provider = next(providers, None)
+            if provider is None:
+                return False
+            name, url, parser = provider
+            pending[asyncio.create_task(self._query(name, url, parser, ip))] = name
+            return True
+
+        launch()
+        result = None
+        try:
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                done, _ = await asyncio.wait(
+                    pending, timeout=min(self.hedge_delay, remaining), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # 对冲：当前请求迟迟未返回，并发请求下一个服务商
+                    launch()
+                    continue
+                for task in done:
+                    name = pending.pop(task)
+                    if task.exception() is None:
+                        result = task.result()
+                        break
+                    logger.warning(f"从 {name} 获取IP地理位置失败: {task.exception()}")
+                if result is not None:
+                    break
+                if not pending:
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if result is None:
+            logger.error(f"所有API获取IP地理位置失败: {ip}")
+        self.cache.set(ip, result)
+        return result
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+remote_geo = RemoteGeoClient(
+    deadline=float(os.getenv("GEOIP_REMOTE_DEADLINE", "1.5")),
+    hedge_delay=float(os.getenv("GEOIP_HEDGE_DELAY", "0.3")),
+    cache=TTLCache(
+        max_size=int(os.getenv("GEOIP_CACHE_SIZE", "10000")),
+        ttl=float(os.getenv("GEOIP_CACHE_TTL", str(24*60*60))),
+        negative_ttl=float(os.getenv("GEOIP_NEGATIVE_TTL", "300"))
+    )
+)
+
+
+def lookup_geolocation_nowait(ip: str) -> Optional[dict]:
+    """
+    不发起网络请求的地理位置查询（本地地址、离线库、远程查询缓存）
+    需要远程查询才能确定时返回 None
+    """
     if ip == "unknown" or is_private_ip(ip):
         return {"country": "本地", "region": "本地", "city": "本地"}
-    
-    # 多个备用API
-    apis = [
-        ("http://ip-api.com/json/{ip}?lang=zh-CN", "ip-api.com"),
-        ("https://ipinfo.io/{ip}/json", "ipinfo.io"),
-    ]
-    
-    for api_url, api_name in apis:
+
+    # 优先查询离线库
+    if geoip_db is not None:
+        geo = geoip_db.lookup(ip)
+        if geo is not None:
+            return geo
+
+    if not remote_geolocation_enabled():
+        return {"country": "未知", "region": "未知", "city": "未知"}
+
+    cached = remote_geo.cache.get(ip)
+    if cached is TTLCache.MISS:
+        return None
+    return cached or {"country": "未知", "region": "未知", "city": "未知"}
+
+
+async def get_ip_geolocation(ip: str) -> dict:
+    """获取IP对应的地理位置信息"""
+    geo = lookup_geolocation_nowait(ip)
+    if geo is not None:
+        return geo
+
+    geo = await remote_geo.lookup(ip)
+    if geo is None:
+        return {"country": "未知", "region": "未知", "city": "未知"}
+    return geo
+
+
+def format_location(geo: dict) -> str:
+    """拼接 国家 地区 城市（忽略空字段）"""
+    return " ".join(part for part in (geo.get("country", ""), geo.get("region", ""), geo.get("city", "")) if part)
+
+
+# ==================== 后台地理位置补全 ====================
+
+# ip-api.com 批量查询接口（测试时可指向本地桩服务）
+GEOIP_BATCH_URL = os.getenv("GEOIP_BATCH_URL", "http://ip-api.com/batch?lang=zh-CN")
+GEOIP_BATCH_SIZE = 100  # ip-api.com 单次批量查询上限
+GEOIP_BATCH_WAIT = float(os.getenv("GEOIP_BATCH_WAIT", "0.5"))  # 攒批等待时间（秒）
+
+
+class GeoEnrichmentWorker:
+    """
+    后台地理位置补全
+
+    WebSocket 握手时只记录 IP，需要远程查询的 IP 放入队列，
+    由后台任务攒批查询后回写 fingerprint: 和 client: 记录
+    """
+
+    def __init__(self, batch_url: str, batch_size: int, batch_wait: float, max_pending: int = 10000):
+        self.batch_url = batch_url
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, fingerprint: str, client_token: str, ip: str):
+        """提交待补全的记录（队列满时丢弃）"""
         try:
-            url = api_url.replace("{ip}", ip)
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(url)
-                if response.status_code == 200:
-                    data = response.json()
-                    
-                    if api_name == "ip-api.com":
-                        if data.get("status") == "success":
-                            return {
-                                "country": data.get("country", ""),
-                                "region": data.get("regionName", ""),
-                                "city": data.get("city", "")
-                            }
-                    elif api_name == "ipinfo.io":
-                        # ipinfo.io 返回格式不同
-                        if "country" in data or "region" in data or "city" in data:
-                            return {
-                                "country": data.get("country", ""),
-                                "region": data.get("region", ""),
-                                "city": data.get("city", "")
-                            }
+            self.queue.put_nowait((fingerprint, client_token, ip))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._process(batch)
+            except Exception as e:
+                logger.error(f"地理位置补全失败: {e}")
+
+    async def _process(self, batch: list):
+        results: Dict[str, dict] = {}
+        pending = []
+        for ip in {ip for _, _, ip in batch}:
+            geo = lookup_geolocation_nowait(ip)
+            if geo is not None:
+                results[ip] = geo
+            else:
+                pending.append(ip)
+
+        if pending:
+            results.update(await self._batch_lookup(pending))
+            # 批量接口失败的 IP 逐个查询（带缓存、合并与对冲）
+            missing = [ip for ip in pending if ip not in results]
+            if missing:
+                geos = await asyncio.gather(*(get_ip_geolocation(ip) for ip in missing))
+                results.update(zip(missing, geos))
+
+        for fingerprint, client_token, ip in batch:
+            await patch_geolocation(fingerprint, client_token, ip, results[ip])
+        log_event("DEBUG", "SYSTEM", f"🗺️ 地理位置补全完成: {len(batch)} 条记录, 远程查询 {len(pending)} 个IP")
+
+    async def _batch_lookup(self, ips: list) -> Dict[str, dict]:
+        """调用批量查询接口，返回成功解析的结果"""
+        results = {}
+        payload = [{"query": ip, "fields": "status,country,regionName,city,query"} for ip in ips]
+        try:
+            response = await remote_geo.client.post(self.batch_url, json=payload, timeout=remote_geo.deadline * 2)
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}")
+            for ip, item in zip(ips, response.json()):
+                geo = _parse_ip_api(item)
+                if geo is not None:
+                    results[ip] = geo
+                    remote_geo.cache.set(ip, geo)
         except Exception as e:
-            logger.warning(f"从 {api_name} 获取IP地理位置失败: {e}")
-            continue
-    
-    logger.error(f"所有API获取IP地理位置失败: {ip}")
-    return {"country": "未知", "region": "未知", "city": "未知"}
+            logger.warning(f"批量获取IP地理位置失败: {e}")
+        return results
+
+
+geo_worker = GeoEnrichmentWorker(GEOIP_BATCH_URL, GEOIP_BATCH_SIZE, GEOIP_BATCH_WAIT)
+
+
+async def patch_geolocation(fingerprint: str, client_token: str, ip: str, geo: dict):
+    """把地理位置回写到 fingerprint: 和 client: 记录（IP 已变化的记录不覆盖）"""
+    if not redis_client:
+        return
+    fp_key = f"fingerprint:{fingerprint}"
+    client_key = f"client:{client_token}"
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hget(fp_key, "ip")
+    pipe.hget(client_key, "ip")
+    fp_ip, client_ip = await pipe.execute(raise_on_error=False)
+    pipe = redis_client.pipeline(transaction=False)
+    if fp_ip == ip:
+        pipe.hset(fp_key, "location", format_location(geo))
+    if client_ip == ip:
+        pipe.hset(client_key, mapping={
+            "country": geo.get("country", ""),
+            "region": geo.get("region", ""),
+            "city": geo.get("city", "")
+        })
+    await pipe.execute()
 
 
 async def get_geo_info(request: Request) -> dict:
     """获取客户端IP和地理位置信息"""
-    ip = get_client_ip(request)
+    ip = await get_client_ip(request)
     geo = await get_ip_geolocation(ip)
     return {"ip": ip, **geo}
 
 
+# appToken -> clientToken 解析缓存
+app_token_cache = TTLCache(
+    max_size=int(os.getenv("APP_TOKEN_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("APP_TOKEN_CACHE_TTL", "60")),
+    negative_ttl=float(os.getenv("APP_TOKEN_NEGATIVE_TTL", "5"))
+)
+
+
+async def invalidate_app_token(app_token: str = None):
+    """使 appToken 缓存失效（不传参数时清空），集群模式下同步到其他 worker"""
+    if app_token is None:
+        app_token_cache.clear()
+    else:
+        app_token_cache.invalidate(app_token)
+    await manager.broadcast({"kind": "invalidate", "app_token": app_token})
+
+
 # 通过 appToken 获取 clientToken（用于消息推送）
 async def get_client_token(app_token: str, trace_id: str = "") -> str:
     """通过 appToken 获取 clientToken"""
+    cached = app_token_cache.get(app_token)
+    if cached is not TTLCache.MISS:
+        return cached
     if redis_client:
         redis_start = now_china()
         try:
@@ -495,6 +3217,7 @@ async def get_client_token(app_token: str, trace_id: str = "") -> str:
             elapsed = (now_china() - redis_start).total_seconds()
             if elapsed > 0.1:  # 超过100ms记录警告
                 log_event("WARNING", "REDIS", f"⚠️ Redis读取慢: {elapsed:.3f}秒, trace: {trace_id[:20]}", trace_id)
+            app_token_cache.set(app_token, client_token or None)
             if client_token:
                 return client_token
         except asyncio.TimeoutError:
@@ -504,6 +3227,37 @@ async def get_client_token(app_token: str, trace_id: str = "") -> str:
     return None
 
 
+async def get_client_tokens(app_tokens: list, trace_id: str = "") -> Dict[str, Optional[str]]:
+    """批量解析 appToken，缓存未命中的部分用一次 MGET 读取"""
+    result: Dict[str, Optional[str]] = {}
+    missing = []
+    for app_token in dict.fromkeys(app_tokens):
+        cached = app_token_cache.get(app_token)
+        if cached is TTLCache.MISS:
+            missing.append(app_token)
+            result[app_token] = None
+        else:
+            result[app_token] = cached
+    if missing and redis_client:
+        redis_start = now_china()
+        try:
+            values = await asyncio.wait_for(
+                redis_client.mget([f"app:{app_token}" for app_token in missing]),
+                timeout=2.0
+            )
+            elapsed = (now_china() - redis_start).total_seconds()
+            if elapsed > 0.1:
+                log_event("WARNING", "REDIS", f"⚠️ Redis批量读取慢: {elapsed:.3f}秒, {len(missing)} 个token", trace_id)
+            for app_token, client_token in zip(missing, values):
+                app_token_cache.set(app_token, client_token or None)
+                result[app_token] = client_token or None
+        except asyncio.TimeoutError:
+            log_event("ERROR", "REDIS", f"❌ Redis批量读取超时: {len(missing)} 个token", trace_id)
+        except Exception as e:
+            log_event("ERROR", "REDIS", f"❌ Redis批量读取错误: {e}", trace_id)
+    return result
+
+
 # 挂载静态文件目录
 app.mount("/static", StaticFiles(directory="static"), "static")
 
@@ -529,19 +3283,359 @@ async def admin_page(request: Request, session_token: Optional[str] = Cookie(Non
     return templates.TemplateResponse("admin.html", {"request": request})
 
 
+# ==================== 记录存储（Redis 哈希） ====================
+#
+# fingerprint:{fp}   HASH  fingerprint, created_at, last_seen, ip, location
+# client:{token}     HASH  app_token, created_at, ip, country, region, city
+# 旧版本以 JSON 字符串存储，启动后在后台迁移，读取时兼容两种格式
+
+RECORD_LAYOUT_KEY = "records:layout"
+RECORD_LAYOUT = "hash"
+
+# 把 JSON 字符串记录原地转换为哈希（保留 TTL），嵌套对象（client 的 location）展开为字段；
+# 无法解析的记录改名隔离到 KEYS[2]，避免每次读取、迁移都失败
+# KEYS: 记录键, 隔离键    ARGV: 隔离键 TTL（秒，原键没有 TTL 时使用）
+# 返回: 1 已迁移, 0 无需迁移, -1 已隔离
+MIGRATE_RECORD_LUA = """
+if redis.call('TYPE', KEYS[1])['ok'] ~= 'string' then
+    return 0
+end
+local ttl = redis.call('PTTL', KEYS[1])
+local ok, data = pcall(cjson.decode, redis.call('GET', KEYS[1]))
+if ok and type(data) == 'table' then
+    -- JSON 数组也解码为 table，只接受字符串键
+    for k in pairs(data) do
+        if type(k) ~= 'string' then
+            ok = false
+            break
+        end
+    end
+end
+if not ok or type(data) ~= 'table' then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+    if ttl < 0 then
+        redis.call('EXPIRE', KEYS[2], ARGV[1])
+    end
+    return -1
+end
+redis.call('DEL', KEYS[1])
+for k, v in pairs(data) do
+    if type(v) == 'table' then
+        for k2, v2 in pairs(v) do
+            if type(v2) == 'string' or type(v2) == 'number' then
+                redis.call('HSET', KEYS[1], k2, v2)
+            end
+        end
+    elseif type(v) == 'string' or type(v) == 'number' then
+        redis.call('HSET', KEYS[1], k, v)
+    end
+end
+if ttl > 0 then
+    redis.call('PEXPIRE', KEYS[1], ttl)
+end
+return 1
+"""
+
+migrate_record_script = None
+
+QUARANTINE_PREFIX = "quarantine:"  # 无法解析的旧版记录改名为 quarantine:{原键}
+QUARANTINE_TTL = 7*24*60*60
+
+
+def quarantine_key(key: str) -> str:
+    return f"{QUARANTINE_PREFIX}{key}"
+
+
+async def migrate_record(key: str, client=None):
+    """迁移单条旧版记录（client 为管道时只排队）"""
+    return await migrate_record_script(keys=[key, quarantine_key(key)], args=[QUARANTINE_TTL], client=client)
+
+
+def flatten_record(data: dict) -> dict:
+    """把旧版 JSON 记录转换为哈希字段格式"""
+    record = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            record.update({k: str(v) for k, v in value.items()})
+        elif value is not None:
+            record[key] = str(value)
+    return record
+
+
+def client_record_view(client_token: str, record: dict) -> dict:
+    """client: 哈希记录转换为 API 输出格式"""
+    return {
+        "client_token": client_token,
+        "app_token": record.get("app_token", ""),
+        "created_at": record.get("created_at", ""),
+        "ip": record.get("ip", ""),
+        "location": {
+            "country": record.get("country", ""),
+            "region": record.get("region", ""),
+            "city": record.get("city", "")
+        }
+    }
+
+
+async def read_records(keys: list) -> list:
+    """批量读取哈希记录，不存在的返回 None；遇到旧版 JSON 字符串时兼容读取并触发迁移"""
+    if not keys:
+        return []
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    results = await pipe.execute(raise_on_error=False)
+    records = [None if isinstance(r, Exception) or not r else r for r in results]
+    legacy = [key for key, r in zip(keys, results) if isinstance(r, redis.ResponseError)]
+    if legacy:
+        values = dict(zip(legacy, await redis_client.mget(legacy)))
+        for i, key in enumerate(keys):
+            if not values.get(key):
+                continue
+            try:
+                data = json.loads(values[key])
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                records[i] = flatten_record(data)
+            else:
+                # 迁移脚本会把它隔离到 quarantine:{key}
+                log_event("WARNING", "REDIS", f"⚠️ 记录无法解析，已隔离: {key}")
+        pipe = redis_client.pipeline(transaction=False)
+        for key in legacy:
+            await migrate_record(key, client=pipe)
+        await pipe.execute(raise_on_error=False)
+    return records
+
+
+async def migrate_records_to_hashes():
+    """后台把所有 JSON 字符串格式的 fingerprint: / client: 记录迁移为哈希"""
+    if await redis_client.get(RECORD_LAYOUT_KEY) == RECORD_LAYOUT:
+        return
+    migrated = quarantined = 0
+    for match in ("fingerprint:*", "client:*"):
+        cursor = 0
+        while True:
+            cursor, keys = await redis_client.scan(cursor=cursor, match=match, count=SCAN_COUNT, _type="string")
+            keys = [k for k in keys if not is_blocked_key(k)]
+            if keys:
+                pipe = redis_client.pipeline(transaction=False)
+                for key in keys:
+                    await migrate_record(key, client=pipe)
+                results = await pipe.execute(raise_on_error=False)
+                migrated += sum(1 for r in results if r == 1)
+                quarantined += sum(1 for r in results if r == -1)
+            if cursor == 0:
+                break
+    await redis_client.set(RECORD_LAYOUT_KEY, RECORD_LAYOUT)
+    if migrated:
+        log_event("INFO", "REDIS", f"🔄 已将 {migrated} 条记录迁移为哈希格式")
+    if quarantined:
+        log_event("WARNING", "REDIS", f"⚠️ {quarantined} 条记录无法解析，已隔离到 {QUARANTINE_PREFIX}*")
+
+
+# ==================== WebSocket 握手 ====================
+
+FINGERPRINT_TTL = 30*24*60*60  # fingerprint:* 30天过期
+CLIENT_TOKEN_TTL = 30*24*60*60  # client:* 30天过期
+APP_TOKEN_TTL = 7*24*60*60  # app:* 7天过期
+BLOCKED_TTL = 365*24*60*60  # fingerprint:blocked:* 1年过期
+
+# 指纹二级索引
+FINGERPRINT_INDEX = "fingerprints:last_seen"  # ZSET: 指纹 -> 最后活跃时间戳
+BLOCKED_INDEX = "fingerprints:blocked"  # SET: 已封禁指纹
+ONLINE_INDEX = "fingerprints:online"  # SET: 当前在线指纹
+INDEX_VERSION_KEY = "fingerprints:index:version"
+INDEX_VERSION = "1"
+INDEX_MAINTENANCE_INTERVAL = 60*60  # 索引清理间隔（秒）
+
+
+async def rebuild_fingerprint_indexes():
+    """从现有 fingerprint:* 键回填索引（仅在索引版本不匹配时执行一次）"""
+    if await redis_client.get(INDEX_VERSION_KEY) == INDEX_VERSION:
+        return
+    indexed = blocked = 0
+    cursor = 0
+    while True:
+        cursor, keys = await redis_client.scan(cursor=cursor, match="fingerprint:*", count=SCAN_COUNT)
+        blocked_keys = [k for k in keys if is_blocked_key(k)]
+        record_keys = [k for k in keys if not is_blocked_key(k)]
+        pipe = redis_client.pipeline(transaction=False)
+        for key in blocked_keys:
+            pipe.sadd(BLOCKED_INDEX, key.replace("fingerprint:blocked:", "", 1))
+        for key, data in zip(record_keys, await read_records(record_keys)):
+            if data is None:
+                continue
+            try:
+                score = datetime.fromisoformat(data.get("last_seen", "")).timestamp()
+            except ValueError:
+                score = time.time()
+            pipe.zadd(FINGERPRINT_INDEX, {key.replace("fingerprint:", "", 1): score})
+        await pipe.execute()
+        indexed += len(record_keys)
+        blocked += len(blocked_keys)
+        if cursor == 0:
+            break
+    await redis_client.set(INDEX_VERSION_KEY, INDEX_VERSION)
+    log_event("INFO", "REDIS", f"🗂️ 指纹索引已重建: {indexed} 个指纹, {blocked} 个封禁")
+
+
+async def prune_fingerprint_indexes():
+    """清理已因 TTL 过期的索引条目"""
+    # 指纹记录的 TTL 在每次连接时按 last_seen 刷新，超过 TTL 的条目对应的键必然已过期
+    removed = await redis_client.zremrangebyscore(FINGERPRINT_INDEX, "-inf", time.time() - FINGERPRINT_TTL)
+    for index, key_of in (
+        (BLOCKED_INDEX, lambda fp: f"fingerprint:blocked:{fp}"),
+        (ONLINE_INDEX, lambda fp: f"fingerprint:{fp}"),
+    ):
+        cursor = 0
+        while True:
+            cursor, members = await redis_client.sscan(index, cursor=cursor, count=SCAN_COUNT)
+            if members:
+                pipe = redis_client.pipeline(transaction=False)
+                for fp in members:
+                    pipe.exists(key_of(fp))
+                stale = [fp for fp, exists in zip(members, await pipe.execute()) if not exists]
+                if index == ONLINE_INDEX:
+                    # 在线索引还需剔除已没有任何连接的指纹（如 worker 异常退出），
+                    # 由脚本按连接计数原子地判断并移除
+                    pipe = redis_client.pipeline(transaction=False)
+                    since = time.time() - WORKER_HEARTBEAT_TTL
+                    for fp in members:
+                        if fp not in stale:
+                            await presence_script(
+                                keys=[f"connections:{fp}", "cluster:workers", ONLINE_INDEX],
+                                args=[manager.worker_id, 0, fp, since, CONNECTIONS_TTL],
+                                client=pipe
+                            )
+                    removed += sum(1 for total in await pipe.execute() if total == 0)
+                if stale:
+                    removed += await redis_client.srem(index, *stale)
+            if cursor == 0:
+                break
+    if removed:
+        log_event("INFO", "REDIS", f"🧹 已清理 {removed} 条过期索引")
+
+
+async def maintain_fingerprint_indexes():
+    """启动时回填索引，之后定期清理过期条目"""
+    while True:
+        try:
+            if redis_client is not None:
+                await migrate_records_to_hashes()
+                await rebuild_fingerprint_indexes()
+                await prune_fingerprint_indexes()
+        except Exception as e:
+            logger.error(f"维护指纹索引失败: {e}")
+        await asyncio.sleep(INDEX_MAINTENANCE_INTERVAL)
+
+# 握手脚本：黑名单检查、指纹注册/更新、token 存储在 Redis 端一次完成
+# KEYS: fingerprint:blocked:{fp}, fingerprint:{fp}, client:{token}, app:{app_token},
+#       最后活跃索引, 在线索引, connections:{token}, mailbox:{token}, mailbox_claim:{token}
+# ARGV: fingerprint, now, ip, location, 是否更新位置, client_token,
+#       指纹TTL, client TTL, app TTL, 分发频道, 缓存失效消息（为空则不发布）, now 时间戳,
+#       worker_id, 连接计数TTL, 信箱游标 MINID（为空则不确认）, 信箱占用标识（为空则不补发）,
+#       占用TTL, 最多补发条数, client 记录字段（field, value, ...）
+# 返回: {'blocked', 原因} 或 {'ok', 是否新设备, 待补发的 XRANGE 结果, 游标确认删除的条数, 是否取得信箱占用}
+HANDSHAKE_LUA = """
+local reason = redis.call('GET', KEYS[1])
+if reason then
+    return {'blocked', reason}
+end
+local kind = redis.call('TYPE', KEYS[2])['ok']
+if kind == 'string' then
+    -- 旧版 JSON 记录，先转换为哈希；无法解析的按新记录处理
+    local ok, data = pcall(cjson.decode, redis.call('GET', KEYS[2]))
+    redis.call('DEL', KEYS[2])
+    if ok and type(data) == 'table' then
+        for k, v in pairs(data) do
+            if type(v) == 'string' then
+                redis.call('HSET', KEYS[2], k, v)
+            end
+        end
+    else
+        kind = 'none'
+    end
+end
+local is_new = 0
+if kind == 'none' then
+    is_new = 1
+    redis.call('HSET', KEYS[2], 'fingerprint', ARGV[1], 'created_at', ARGV[2], 'location', ARGV[4])
+elseif ARGV[5] == '1' then
+    redis.call('HSET', KEYS[2], 'location', ARGV[4])
+end
+redis.call('HSET', KEYS[2], 'last_seen', ARGV[2], 'ip', ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[7])
+redis.call('DEL', KEYS[3])
+redis.call('HSET', KEYS[3], unpack(ARGV, 19))
+redis.call('EXPIRE', KEYS[3], ARGV[8])
+redis.call('SET', KEYS[4], ARGV[6], 'EX', ARGV[9])
+redis.call('ZADD', KEYS[5], ARGV[12], ARGV[1])
+redis.call('SADD', KEYS[6], ARGV[1])
+redis.call('HINCRBY', KEYS[7], ARGV[13], 1)
+redis.call('EXPIRE', KEYS[7], ARGV[14])
+if ARGV[11] ~= '' then
+    redis.call('PUBLISH', ARGV[10], ARGV[11])
+end
+local trimmed = 0
+if ARGV[15] ~= '' then
+    trimmed = redis.call('XTRIM', KEYS[8], 'MINID', ARGV[15])
+end
+local replay = {}
+local claimed = 0
+if ARGV[16] ~= '' and redis.call('EXISTS', KEYS[8]) == 1
+        and redis.call('SET', KEYS[9], ARGV[16], 'NX', 'EX', ARGV[17]) then
+    claimed = 1
+    replay = redis.call('XRANGE', KEYS[8], '-', '+', 'COUNT', ARGV[18])
+end
+return {'ok', is_new, replay, trimmed, claimed}
+"""
+
+handshake_script = None
+
+# 断开连接脚本：减少当前 worker 的连接计数，所有存活 worker 的连接数为 0 时移出在线索引
+# （增量为 0 时只做检查，用于定期清理在线索引）
+# KEYS: connections:{token}, cluster:workers, 在线索引
+# ARGV: worker_id, 增量, fingerprint, 存活 worker 的最早心跳时间, 连接计数TTL
+PRESENCE_LUA = """
+if ARGV[2] ~= '0' then
+    local count = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+    if count <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+    else
+        redis.call('EXPIRE', KEYS[1], ARGV[5])
+    end
+end
+local alive = {[ARGV[1]] = true}
+for _, worker in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], ARGV[4], '+inf')) do
+    alive[worker] = true
+end
+local total = 0
+local counts = redis.call('HGETALL', KEYS[1])
+for i = 1, #counts, 2 do
+    if alive[counts[i]] then
+        total = total + tonumber(counts[i + 1])
+    end
+end
+if total <= 0 then
+    redis.call('SREM', KEYS[3], ARGV[3])
+end
+return total
+"""
+
+presence_script = None
+
+
 @app.websocket("/stream")
-async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
+async def websocket_endpoint(
+    websocket: WebSocket,
+    token: str = Query(...),
+    proto: int = Query(1),
+    mailbox_cursor: str = Query("")
+):
     """WebSocket 连接端点 - 指纹验证"""
     fingerprint = token  # webhookToken直接作为指纹
     
-    # 检查是否在黑名单中
-    if redis_client:
-        blocked = await redis_client.get(f"fingerprint:blocked:{fingerprint}")
-        if blocked:
-            logger.warning(f"拒绝封禁设备的连接: {fingerprint[:20]}...")
-            await websocket.close(code=4000, reason="设备已被封禁")
-            return
-    
     # 获取IP和地理位置信息
     geo_info = None
     try:
@@ -564,68 +3658,87 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
                 # 兜底使用websocket.client.host
                 client_host = websocket.client.host if websocket.client else "unknown"
         
-        geo_info = await get_ip_geolocation(client_host)
-        geo_info["ip"] = client_host
+        # 握手时不等待远程查询，未命中本地数据的 IP 交给后台补全
+        geo = lookup_geolocation_nowait(client_host)
+        geo_pending = geo is None
+        geo_info = {"ip": client_host, **(geo or {"country": "查询中", "region": "", "city": ""})}
     except Exception as e:
         logger.error(f"获取IP地理位置失败: {e}")
         geo_info = {"ip": "unknown", "country": "未知", "region": "未知", "city": "未知"}
-    
-    # 指纹注册/更新
-    if redis_client:
-        fp_data = await redis_client.get(f"fingerprint:{fingerprint}")
-        if not fp_data:
-            # 新设备，注册指纹
-            fp_data_new = {
-                "fingerprint": fingerprint,
-                "created_at": now_china().isoformat(),
-                "last_seen": now_china().isoformat(),
-                "ip": geo_info.get("ip", ""),
-                "location": f"{geo_info.get('country', '')} {geo_info.get('region', '')} {geo_info.get('city', '')}"
-            }
-            await redis_client.set(
-                f"fingerprint:{fingerprint}",
-                json.dumps(fp_data_new, ensure_ascii=False),
-                ex=30*24*60*60  # 30天过期
-            )
-            logger.info(f"新设备指纹已注册: {fingerprint[:20]}...")
-        else:
-            # 更新最后活跃时间
-            data = json.loads(fp_data)
-            data["last_seen"] = now_china().isoformat()
-            data["ip"] = geo_info.get("ip", "")
-            await redis_client.set(
-                f"fingerprint:{fingerprint}",
-                json.dumps(data, ensure_ascii=False),
-                ex=30*24*60*60  # 保持30天过期时间
-            )
-    
+        geo_pending = False
+
     # 生成app_token
     client_token = fingerprint
     app_token = base64.b64encode(client_token.encode()).decode()
-    
-    # 存储到Redis
-    if redis_client:
-        token_data = {
-            "app_token": app_token,
-            "created_at": now_china().isoformat(),
-            "ip": geo_info.get("ip", ""),
-            "location": {
-                "country": geo_info.get("country", ""),
-                "region": geo_info.get("region", ""),
-                "city": geo_info.get("city", "")
-            }
-        }
-        # client:token 30天过期，app:token 7天过期
-        await redis_client.set(f"client:{client_token}", json.dumps(token_data, ensure_ascii=False), ex=30*24*60*60)
-        await redis_client.set(f"app:{app_token}", client_token, ex=7*24*60*60)
 
-    await manager.connect(client_token, websocket)
+    # 黑名单检查 + 指纹注册/更新 + token 存储 + 离线信箱读取，一次往返完成
+    replay = None
+    mailbox_claim = ""
+    if redis_client:
+        now = now_china().isoformat()
+        token_fields = [
+            "app_token", app_token,
+            "created_at", now,
+            "ip", geo_info.get("ip", ""),
+            "country", geo_info.get("country", ""),
+            "region", geo_info.get("region", ""),
+            "city", geo_info.get("city", ""),
+        ]
+        invalidation = ""
+        if manager.cluster:
+            invalidation = json.dumps({"kind": "invalidate", "app_token": app_token, "origin": manager.worker_id})
+        if MAILBOX_ENABLED:
+            mailbox_claim = secrets.token_hex(8)
+        result = await handshake_script(
+            keys=[
+                f"fingerprint:blocked:{fingerprint}",
+                f"fingerprint:{fingerprint}",
+                f"client:{client_token}",
+                f"app:{app_token}",
+                FINGERPRINT_INDEX,
+                ONLINE_INDEX,
+                f"connections:{client_token}",
+                Mailbox.key(client_token),
+                Mailbox.claim_key(client_token),
+            ],
+            args=[
+                fingerprint, now, geo_info.get("ip", ""), format_location(geo_info),
+                "0" if geo_pending else "1",
+                client_token,
+                FINGERPRINT_TTL, CLIENT_TOKEN_TTL, APP_TOKEN_TTL,
+                FANOUT_CHANNEL, invalidation, time.time(),
+                manager.worker_id, CONNECTIONS_TTL,
+                Mailbox.cursor_min_id(mailbox_cursor) if mailbox_claim and mailbox_cursor else "",
+                mailbox_claim, MAILBOX_CLAIM_TTL, mailbox.max_len,
+                *token_fields,
+            ]
+        )
+        status, detail = result[0], result[1]
+        if status == "blocked":
+            logger.warning(f"拒绝封禁设备的连接: {fingerprint[:20]}...")
+            await websocket.close(code=4000, reason="设备已被封禁")
+            return
+        if detail == 1:
+            logger.info(f"新设备指纹已注册: {fingerprint[:20]}...")
+        replay = mailbox.replay_entries(result[2])
+        mailbox.acked += result[3]
+        if not result[4]:
+            # 信箱为空或正由同一 token 的其他连接补发
+            mailbox_claim = ""
+        app_token_cache.invalidate(app_token)
+        if geo_pending:
+            geo_worker.submit(fingerprint, client_token, geo_info["ip"])
+
+    await manager.connect(client_token, websocket, proto=min(max(proto, 1), WS_PROTOCOL_VERSION))
+    # 补发离线期间暂存的消息（没有 Redis 时不会暂存）
+    if replay is not None:
+        await manager.deliver_mailbox(websocket, replay, mailbox_claim)
 
     try:
         # 保持连接
         while True:
             data = await websocket.receive_text()
-            logger.info(f"已接收来自 {client_token[:20]}... 的消息: {data}")
+            await manager.handle_client_message(websocket, data)
 
     except WebSocketDisconnect:
         manager.disconnect(client_token, websocket)
@@ -880,8 +3993,23 @@ async def send_message(message: Message, token: str = Query(...)):
         "timestamp": now_china().isoformat()
     }
 
-    # 检查是否有活跃的连接
-    if client_token not in manager.active_connections or not manager.active_connections[client_token]:
+    # 发送到对应的 WebSocket 连接（集群模式下汇总所有 worker）
+    connections = await manager.publish_message(client_token, msg_data)
+
+    if connections == 0:
+        mailbox_id = await mailbox.push(client_token, "message", msg_data) if MAILBOX_ENABLED else None
+        if mailbox_id:
+            logger.info(f"客户端 {client_token} 不在线, 消息已存入离线信箱: {mailbox_id}")
+            return JSONResponse(
+                status_code=200,
+                content={
+                    "status": "queued",
+                    "message": "没有活跃的 WebSocket 连接，消息已暂存，客户端连接后补发",
+                    "client_token": client_token,
+                    "mailbox_id": mailbox_id,
+                    "connections": 0
+                }
+            )
         logger.warning(
             f"没有活跃的 WebSocket 连接 for client {client_token}, 消息未发送")
         return JSONResponse(
@@ -894,9 +4022,6 @@ async def send_message(message: Message, token: str = Query(...)):
             }
         )
 
-    # 发送到对应的 WebSocket 连接
-    await manager.send_message(client_token, msg_data)
-
     logger.info(f"消息已发送到客户端 {client_token}: {message.title}")
 
     return JSONResponse(
@@ -905,7 +4030,84 @@ async def send_message(message: Message, token: str = Query(...)):
             "status": "success",
             "message": "信息已发送",
             "client_token": client_token,
-            "connections": len(manager.active_connections.get(client_token, []))
+            "connections": connections
+        }
+    )
+
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))  # 单次批量推送的最大条数
+
+
+@app.post("/message/batch")
+async def send_message_batch(batch: BatchMessage):
+    """
+    批量推送文本消息，返回每个 token 的投递状态
+
+    所有 appToken 用一次 MGET 解析，连接数用一次 Redis 往返获取，消息放入各连接的发送队列并发发送；
+    不在线的 token 与 /message 一样存入离线信箱
+    """
+    timestamp = now_china().isoformat()
+    deliveries = []  # [(appToken, 消息)]
+    for item in batch.items:
+        deliveries.append((item.token, {
+            "type": "message",
+            "title": item.title,
+            "message": item.message,
+            "priority": item.priority,
+            "timestamp": timestamp
+        }))
+    if batch.tokens:
+        if batch.message is None:
+            raise HTTPException(status_code=400, detail="tokens 需要同时提供 message")
+        shared = {
+            "type": "message",
+            "title": batch.title,
+            "message": batch.message,
+            "priority": batch.priority,
+            "timestamp": timestamp
+        }
+        deliveries.extend((token, shared) for token in batch.tokens)
+    if not deliveries:
+        raise HTTPException(status_code=400, detail="items 和 tokens 不能同时为空")
+    if len(deliveries) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"单次最多推送 {BATCH_MAX_ITEMS} 条")
+
+    start = time.perf_counter()
+    resolved = await get_client_tokens([app_token for app_token, _ in deliveries], "send_message_batch")
+    valid = [(resolved[app_token], message) for app_token, message in deliveries if resolved[app_token]]
+    counts = await manager.publish_messages(valid)
+
+    results = []
+    offline = []
+    for app_token, message in deliveries:
+        client_token = resolved[app_token]
+        if not client_token:
+            results.append({"token": app_token, "status": "invalid_token", "connections": 0})
+            continue
+        connections = counts[client_token]
+        result = {"token": app_token, "status": "success" if connections else "no_connection", "connections": connections}
+        if not connections and MAILBOX_ENABLED:
+            offline.append((result, client_token, message))
+        results.append(result)
+    if offline:
+        mailbox_ids = await mailbox.push_many([(client_token, "message", message) for _, client_token, message in offline])
+        for (result, _, _), mailbox_id in zip(offline, mailbox_ids):
+            if mailbox_id:
+                result.update(status="queued", mailbox_id=mailbox_id)
+
+    summary: Dict[str, int] = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    elapsed = time.perf_counter() - start
+    log_event("INFO", "MESSAGE", f"📦 批量推送 {len(results)} 条: {summary}, 耗时: {elapsed:.3f}秒", "")
+
+    return JSONResponse(
+        status_code=200,
+        content={
+            "status": "success",
+            "total": len(results),
+            "summary": summary,
+            "results": results
         }
     )
 
@@ -916,16 +4118,24 @@ async def send_image(
     title: str = Query("图片消息"),
     priority: int = Query(2),
     message: str = Query(""),
-    file: UploadFile = File(...)
+    sha256: str = Query(None),
+    filename: str = Query(None),
+    max_dim: int = Query(0, ge=0),
+    image_format: str = Query(None, alias="format"),
+    quality: int = Query(85),
+    file: UploadFile = File(None)
 ):
     """
     接收图片二进制数据并通过 WebSocket 推送给客户端
     使用 multipart/form-data 上传图片，性能更好
+
+    重复推送同一张图片时可以不上传文件，只传 sha256（需仍在本 worker 的图片缓存中）；
+    max_dim / format / quality 用于在转码进程中缩放和重新编码上传的图片（需要 Pillow）
     """
     request_start = now_china()
     # 添加分割线
     log_event("INFO", "BINARY", "=" * 50, "")
-    log_event("INFO", "BINARY", f"📨 HTTP请求开始: {file.filename if file else 'unknown'}", "")
+    log_event("INFO", "BINARY", f"📨 HTTP请求开始: {file.filename if file else (filename or sha256 or 'unknown')}", "")
     
     app_token = token
 
@@ -935,23 +4145,75 @@ async def send_image(
     if not client_token:
         raise HTTPException(status_code=400, detail="Invalid app token format")
 
-    # 读取图片二进制数据
-    read_start = now_china()
-    image_data = await file.read()
-    read_elapsed = (now_china() - read_start).total_seconds()
-    
-    filename = file.filename or "image.jpg"
-    content_type = file.content_type or "image/jpeg"
+    if file is None:
+        # 按哈希推送：从图片缓存取数据，不在缓存中时要求重新上传
+        if not sha256:
+            raise HTTPException(status_code=400, detail="缺少图片文件或 sha256")
+        # 缓存在各 worker 进程内且按 token 隔离：其他 worker 或其他 token 推送的图片都视为未命中
+        cached = image_cache.get(sha256.lower(), client_token)
+        if cached is None:
+            raise HTTPException(status_code=404, detail="图片不在缓存中，请上传完整图片")
+        image_data, content_type = cached
+        sha256 = sha256.lower()
+        transcode = None
+        filename = filename or f"image{mimetypes.guess_extension(content_type) or '.jpg'}"
+        read_elapsed = 0.0
+    else:
+        # 读取图片二进制数据
+        read_start = now_china()
+        image_data = await file.read()
+        read_elapsed = (now_china() - read_start).total_seconds()
+
+        filename = file.filename or filename or "image.jpg"
+        content_type = file.content_type or "image/jpeg"
+        image_data, content_type, filename, transcode = await maybe_transcode_image(
+            image_data, content_type, filename, max_dim, image_format, quality
+        )
+        sha256 = hashlib.sha256(image_data).hexdigest()
+        image_cache.put(sha256, image_data, content_type, client_token)
 
     
-    log_event("INFO", "BINARY", f"📥 收到图片: {filename}, 大小: {format_size(len(image_data))}", "")
+    log_event("INFO", "BINARY", f"📥 收到图片: {filename}, 大小: {format_size(len(image_data))}, sha256: {sha256[:12]}", "")
     log_event("DEBUG", "BINARY", f"   图片读取耗时: {read_elapsed:.3f}秒, HTTP请求总耗时: {(now_china() - request_start).total_seconds():.3f}秒", "")
 
     # 生成传输 ID 用于追踪
     transfer_id = f"{now_china().strftime('%Y%m%d%H%M%S')}_{secrets.token_hex(8)}"
 
-    # 检查是否有活跃的连接
-    if client_token not in manager.active_connections or not manager.active_connections[client_token]:
+    metadata = {
+        "data_type": "image",
+        "filename": filename,
+        "content_type": content_type,
+        "transfer_id": transfer_id,
+        "sha256": sha256,
+        "title": title,
+        "message": message,
+        "priority": priority
+    }
+
+    # 检查是否有活跃的连接（集群模式下汇总所有 worker）
+    connections = await manager.connection_count(client_token)
+    if connections == 0:
+        mailbox_id = None
+        if MAILBOX_ENABLED and len(image_data) <= MAILBOX_MAX_IMAGE_BYTES:
+            mailbox_id = await mailbox.push(client_token, "binary", {
+                "metadata": metadata,
+                "data": base64.b64encode(image_data).decode()
+            })
+        if mailbox_id:
+            log_event("INFO", "BINARY", f"📪 没有活跃连接, 图片已存入离线信箱: {filename}, {mailbox_id}", transfer_id)
+            return JSONResponse(
+                status_code=200,
+                content={
+                    "status": "queued",
+                    "message": "没有活跃的 WebSocket 连接，图片已暂存，客户端连接后补发",
+                    "client_token": client_token,
+                    "filename": filename,
+                    "size": len(image_data),
+                    "sha256": sha256,
+                    "transfer_id": transfer_id,
+                    "mailbox_id": mailbox_id
+                }
+            )
         log_event("WARNING", "BINARY", f"⚠️ 没有活跃连接, 图片未发送: {filename}", transfer_id)
         return JSONResponse(
             status_code=200,
@@ -960,7 +4222,8 @@ async def send_image(
                 "message": "图片已接收，但没有活跃的 WebSocket 连接",
                 "client_token": client_token,
                 "filename": filename,
-                "size": len(image_data)
+                "size": len(image_data),
+                "sha256": sha256
             }
         )
 
@@ -971,21 +4234,9 @@ async def send_image(
         try:
             # 不再等待，立即发送
             ws_start = now_china()
-            await manager.send_binary(
-                client_token,
-                image_data,
-                {
-                    "data_type": "image",
-                    "filename": filename,
-                    "content_type": content_type,
-                    "transfer_id": transfer_id,
-                    "title": title,
-                    "message": message,
-                    "priority": priority
-                }
-            )
+            await manager.publish_binary(client_token, image_data, metadata)
             elapsed = (now_china() - ws_start).total_seconds()
-            log_event("INFO", "BINARY", f"✅ WebSocket发送完成, 耗时: {elapsed:.3f}秒", transfer_id)
+            log_event("INFO", "BINARY", f"✅ 已加入发送队列, 耗时: {elapsed:.3f}秒", transfer_id)
         except Exception as e:
             log_event("ERROR", "BINARY", f"异步发送图片失败: {e}", transfer_id)
 
@@ -1004,8 +4255,146 @@ async def send_image(
             "client_token": client_token,
             "filename": filename,
             "size": len(image_data),
+            "sha256": sha256,
+            "transfer_id": transfer_id,
+            "connections": connections,
+            "transcode": transcode
+        }
+    )
+
+
+@app.post("/message/image/stream")
+async def send_image_stream(
+    request: Request,
+    token: str = Query(...),
+    filename: str = Query("image.jpg"),
+    content_type: str = Query(None),
+    title: str = Query("图片消息"),
+    priority: int = Query(2),
+    message: str = Query("")
+):
+    """
+    流式转发图片：请求体直接是图片数据（application/octet-stream 或 image/*）
+    
+    边接收边推送给客户端，首个数据块不必等待整个上传完成；
+    每个传输只缓存 STREAM_RELAY_WINDOW 个块，客户端跟不上时暂停读取请求体
+    """
+    request_start = now_china()
+    log_event("INFO", "BINARY", "=" * 50, "")
+    log_event("INFO", "BINARY", f"📨 HTTP请求开始 (流式): {filename}", "")
+
+    client_token = await get_client_token(token, "send_image_stream")
+    if not client_token:
+        raise HTTPException(status_code=400, detail="Invalid app token format")
+
+    if not content_type:
+        header_type = request.headers.get("content-type", "").split(";")[0].strip()
+        if header_type.startswith("image/"):
+            content_type = header_type
+        else:
+            content_type = mimetypes.guess_type(filename)[0] or "image/jpeg"
+    try:
+        declared_size = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        declared_size = -1
+    if declared_size < 0:
+        raise HTTPException(status_code=400, detail="Content-Length 无效")
+    transfer_id = f"{now_china().strftime('%Y%m%d%H%M%S')}_{secrets.token_hex(8)}"
+
+    # 检查是否有活跃的连接（集群模式下汇总所有 worker）
+    connections = await manager.connection_count(client_token)
+    if connections == 0:
+        log_event("WARNING", "BINARY", f"⚠️ 没有活跃连接, 图片未发送: {filename}", transfer_id)
+        return JSONResponse(
+            status_code=200,
+            content={
+                "status": "no_connection",
+                "message": "没有活跃的 WebSocket 连接，图片未接收",
+                "client_token": client_token,
+                "filename": filename
+            }
+        )
+
+    metadata = {
+        "data_type": "image",
+        "filename": filename,
+        "content_type": content_type,
+        "transfer_id": transfer_id,
+        "title": title,
+        "message": message,
+        "priority": priority
+    }
+    local = manager.local_count(client_token)
+    # 其他 worker 上的连接无法流式转发，收齐后整体发布（最多缓存 STREAM_REMOTE_MAX_BYTES）
+    remote = connections > local
+    if remote and declared_size > STREAM_REMOTE_MAX_BYTES:
+        if not local:
+            raise HTTPException(status_code=413, detail=f"图片超过 {format_size(STREAM_REMOTE_MAX_BYTES)}，无法转发给其他 worker 上的连接")
+        log_event("WARNING", "BINARY", f"⚠️ 图片超过 {format_size(STREAM_REMOTE_MAX_BYTES)}，只转发给本地连接: {filename}", transfer_id)
+        remote = False
+    remote_chunks = [] if remote else None
+    relay = manager.open_stream(client_token, metadata, declared_size) if local else None
+    log_event("INFO", "BINARY", f"📤 开始流式转发: {filename}, 声明大小: {format_size(declared_size)}, 本地连接: {local}", transfer_id)
+
+    received = 0
+    first_chunk_elapsed = None
+    buffer = bytearray()
+    aborted = True  # 只有请求体完整读完才算正常结束，其余任何异常都中止转发
+    try:
+        async for piece in request.stream():
+            if not piece:
+                continue
+            received += len(piece)
+            if remote_chunks is not None:
+                if received > STREAM_REMOTE_MAX_BYTES:
+                    remote_chunks = None
+                    if relay is None:
+                        raise HTTPException(status_code=413, detail=f"图片超过 {format_size(STREAM_REMOTE_MAX_BYTES)}，无法转发给其他 worker 上的连接")
+                    log_event("WARNING", "BINARY", f"⚠️ 图片超过 {format_size(STREAM_REMOTE_MAX_BYTES)}，只转发给本地连接: {filename}", transfer_id)
+                else:
+                    remote_chunks.append(piece)
+            if relay is None:
+                continue
+            if not buffer and len(piece) >= BINARY_CHUNK_SIZE:
+                await relay.feed(piece)
+            else:
+                buffer += piece
+                if len(buffer) < BINARY_CHUNK_SIZE:
+                    continue
+                await relay.feed(bytes(buffer))
+                buffer.clear()
+            if first_chunk_elapsed is None:
+                first_chunk_elapsed = (now_china() - request_start).total_seconds()
+        if relay is not None and buffer:
+            await relay.feed(bytes(buffer))
+        aborted = False
+    except ClientDisconnect:
+        pass
+    finally:
+        if relay is not None:
+            await relay.finish(aborted)
+
+    if aborted:
+        log_event("ERROR", "BINARY", f"❌ 上传中断: {filename}, 已接收 {format_size(received)}", transfer_id)
+        raise HTTPException(status_code=400, detail="上传中断")
+
+    if remote_chunks is not None:
+        await manager.broadcast_binary(client_token, b"".join(remote_chunks), metadata)
+
+    elapsed = (now_china() - request_start).total_seconds()
+    first = f"{first_chunk_elapsed:.3f}秒" if first_chunk_elapsed is not None else "-"
+    log_event("INFO", "BINARY", f"✅ 上传接收完成: {filename}, 大小: {format_size(received)}, 首块转发: {first}, 总耗时: {elapsed:.3f}秒", transfer_id)
+
+    return JSONResponse(
+        status_code=200,
+        content={
+            "status": "success",
+            "message": "图片已流式转发",
+            "client_token": client_token,
+            "filename": filename,
+            "size": received,
             "transfer_id": transfer_id,
-            "connections": len(manager.active_connections.get(client_token, []))
+            "connections": connections
         }
     )
 
@@ -1024,7 +4413,15 @@ async def health_check():
         "status": "healthy",
         "redis": redis_status,
         "active_clients": len(manager.active_connections),
-        "total_connections": sum(len(conns) for conns in manager.active_connections.values())
+        "total_connections": sum(len(conns) for conns in manager.active_connections.values()),
+        "fanout_mode": "redis" if manager.cluster else "local",
+        "app_token_cache": app_token_cache.stats(),
+        "image_cache": image_cache.stats(),
+        "mailbox": mailbox.stats(),
+        "ws_compression": ws_compression_stats.snapshot(),
+        "delivery_latency": delivery_latency.snapshot(),
+        "outbound_queued_bytes": sum(conn.queued_bytes for conn in manager.clients.values()),
+        "worker_id": manager.worker_id
     }
 
 
@@ -1033,8 +4430,7 @@ async def token_exists(client_token: str) -> bool:
     """检查 token 是否存在"""
     if not redis_client:
         return False
-    data = await redis_client.get(f"client:{client_token}")
-    return data is not None
+    return await redis_client.exists(f"client:{client_token}") > 0
 
 
 @app.get("/tokens/{client_token}")
@@ -1044,27 +4440,18 @@ async def get_token_info(client_token: str, request: Request = None):
         raise HTTPException(status_code=404, detail="Token not found")
 
     if redis_client:
-        data = await redis_client.get(f"client:{client_token}")
-        token_data = json.loads(data)
+        token_data = (await read_records([f"client:{client_token}"]))[0] or {}
         
         # 如果没有IP信息，尝试更新
         if "ip" not in token_data and request:
             geo_info = await get_geo_info(request)
-            token_data["ip"] = geo_info.get("ip", "")
-            token_data["location"] = {
-                "country": geo_info.get("country", ""),
-                "region": geo_info.get("region", ""),
-                "city": geo_info.get("city", "")
-            }
-            # 更新Redis中的数据
-            await redis_client.set(f"client:{client_token}", json.dumps(token_data, ensure_ascii=False))
+            fields = {key: geo_info.get(key, "") for key in ("ip", "country", "region", "city")}
+            token_data.update(fields)
+            # 只更新缺失的字段
+            await redis_client.hset(f"client:{client_token}", mapping=fields)
         
         return {
-            "client_token": client_token,
-            "app_token": token_data["app_token"],
-            "created_at": token_data["created_at"],
-            "ip": token_data.get("ip", ""),
-            "location": token_data.get("location", {}),
+            **client_record_view(client_token, token_data),
             "has_connection": client_token in manager.active_connections
         }
 
@@ -1078,6 +4465,7 @@ async def api_login(login_request: LoginRequest):
         session_token = create_session_token()
         # 会话有效期24小时
         active_sessions[session_token] = now_china() + timedelta(hours=24)
+        await share_session(session_token, active_sessions[session_token])
         response = JSONResponse(content={"success": True, "message": "登录成功"})
         response.set_cookie(
             key="session_token",
@@ -1109,6 +4497,7 @@ async def api_logout(session_token: Optional[str] = Cookie(None)):
     """登出API"""
     if session_token and session_token in active_sessions:
         del active_sessions[session_token]
+        await revoke_session(session_token)
     response = JSONResponse(content={"success": True, "message": "已登出"})
     response.delete_cookie("session_token")
     return response
@@ -1116,6 +4505,99 @@ async def api_logout(session_token: Optional[str] = Cookie(None)):
 
 # ==================== Redis 查询 API ====================
 
+ADMIN_PAGE_SIZE = 50  # 管理接口默认分页大小
+ADMIN_MAX_PAGE_SIZE = 500  # 管理接口最大分页大小
+SCAN_COUNT = 1000  # 单次 SCAN 的 COUNT 提示
+
+# Redis 统计结果缓存（全库 SCAN 计数代价较高）
+redis_stats_cache = TTLCache(max_size=1, ttl=float(os.getenv("REDIS_STATS_CACHE_TTL", "30")))
+
+
+def encode_cursor(cursor: int, kind: str = "scan") -> Optional[str]:
+    """把 SCAN 游标或偏移量编码为不透明字符串，遍历结束（为 0）返回 None"""
+    if not cursor:
+        return None
+    return base64.urlsafe_b64encode(f"{kind}:{cursor}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], kind: str = "scan") -> int:
+    """解析 encode_cursor 生成的游标"""
+    if not cursor:
+        return 0
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, value = raw.split(":", 1)
+        if prefix != kind:
+            raise ValueError(raw)
+        return int(value)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="无效的游标")
+
+
+async def scan_page(match: str, cursor: int, page_size: int, skip=None):
+    """
+    按 SCAN 游标读取一页键，返回 (keys, next_cursor)
+    SCAN 的 COUNT 只是提示，返回的键数可能略多于 page_size
+    """
+    keys = []
+    count = page_size
+    while True:
+        cursor, batch = await redis_client.scan(cursor=cursor, match=match, count=count)
+        keys.extend(k for k in batch if skip is None or not skip(k))
+        if cursor == 0 or len(keys) >= page_size:
+            return keys, cursor
+        # 匹配稀疏时逐步放大 COUNT，减少往返次数
+        count = min(count * 2, max(SCAN_COUNT, page_size))
+
+
+async def fetch_values(keys: list) -> list:
+    """批量读取键值：字符串返回原值，哈希返回字段字典，其他类型返回类型和大小摘要"""
+    if not keys:
+        return []
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+    types = await pipe.execute()
+    size_commands = {"list": "llen", "set": "scard", "zset": "zcard", "stream": "xlen"}
+    pipe = redis_client.pipeline(transaction=False)
+    for key, key_type in zip(keys, types):
+        if key_type == "string":
+            pipe.get(key)
+        elif key_type == "hash":
+            pipe.hgetall(key)
+        elif key_type in size_commands:
+            getattr(pipe, size_commands[key_type])(key)
+        else:
+            pipe.exists(key)
+    values = await pipe.execute(raise_on_error=False)
+    return [
+        value if key_type in ("string", "hash") else (None if key_type == "none" else f"<{key_type}: {value}>")
+        for key_type, value in zip(types, values)
+    ]
+
+
+def is_blocked_key(key: str) -> bool:
+    return ":blocked:" in key
+
+
+@app.get("/api/admin/connections")
+async def get_connections(session_token: Optional[str] = Cookie(None)):
+    """获取当前 worker 上各连接的发送队列状态（按积压字节数倒序）"""
+    if not verify_session(session_token):
+        raise HTTPException(status_code=401, detail="未授权")
+    
+    connections = sorted(manager.queue_stats(), key=lambda c: c["queue_bytes"], reverse=True)
+    return {
+        "worker_id": manager.worker_id,
+        "policy": OUTBOUND_OVERFLOW_POLICY,
+        "max_items": OUTBOUND_QUEUE_MAX_ITEMS,
+        "max_bytes": OUTBOUND_QUEUE_MAX_BYTES,
+        "total": len(connections),
+        "queued_bytes": sum(c["queue_bytes"] for c in connections),
+        "connections": connections
+    }
+
+
 @app.get("/api/admin/redis/stats")
 async def api_redis_stats(session_token: Optional[str] = Cookie(None)):
     """获取Redis统计信息"""
@@ -1126,15 +4608,37 @@ async def api_redis_stats(session_token: Optional[str] = Cookie(None)):
         return {"error": "Redis未连接"}
     
     try:
-        # 获取所有键
-        all_keys = await redis_client.keys("*")
-        client_keys = [k for k in all_keys if k.startswith("client:")]
-        app_keys = [k for k in all_keys if k.startswith("app:")]
-        
+        counts = redis_stats_cache.get("counts")
+        if counts is TTLCache.MISS:
+            # 增量 SCAN 计数，不阻塞 Redis
+            client_keys = app_keys = 0
+            cursor = 0
+            while True:
+                cursor, batch = await redis_client.scan(cursor=cursor, count=SCAN_COUNT)
+                for key in batch:
+                    if key.startswith("client:"):
+                        client_keys += 1
+                    elif key.startswith("app:"):
+                        app_keys += 1
+                if cursor == 0:
+                    break
+            counts = {"client_keys": client_keys, "app_keys": app_keys}
+            redis_stats_cache.set("counts", counts)
+
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.dbsize()
+        pipe.zcard(FINGERPRINT_INDEX)
+        pipe.scard(ONLINE_INDEX)
+        pipe.scard(BLOCKED_INDEX)
+        total_keys, fingerprint_count, online_count, blocked_count = await pipe.execute()
+
         return {
-            "total_keys": len(all_keys),
-            "client_keys": len(client_keys),
-            "app_keys": len(app_keys),
+            "total_keys": total_keys,
+            "client_keys": counts["client_keys"],
+            "app_keys": counts["app_keys"],
+            "fingerprints": fingerprint_count,
+            "online_fingerprints": online_count,
+            "blocked_fingerprints": blocked_count,
             "active_connections": sum(len(conns) for conns in manager.active_connections.values())
         }
     except Exception as e:
@@ -1143,29 +4647,22 @@ async def api_redis_stats(session_token: Optional[str] = Cookie(None)):
 
 
 @app.get("/api/admin/redis/all")
-async def api_redis_all(session_token: Optional[str] = Cookie(None)):
-    """获取所有Redis数据"""
-    if not verify_session(session_token):
-        raise HTTPException(status_code=401, detail="未授权")
-    
-    if not redis_client:
-        return {"error": "Redis未连接", "data": []}
-    
-    try:
-        keys = await redis_client.keys("*")
-        data = []
-        for key in keys[:100]:  # 限制最多100条
-            value = await redis_client.get(key)
-            data.append({"key": key, "value": value})
-        return {"data": data, "total": len(keys)}
-    except Exception as e:
-        logger.error(f"获取Redis数据失败: {e}")
-        return {"error": str(e), "data": []}
+async def api_redis_all(
+    cursor: Optional[str] = Query(None),
+    page_size: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    session_token: Optional[str] = Cookie(None)
+):
+    """分页获取所有Redis数据"""
+    return await api_redis_keys("*", cursor, page_size, session_token)
 
 
 @app.get("/api/admin/redis/tokens")
-async def api_redis_tokens(session_token: Optional[str] = Cookie(None)):
-    """获取整合后的 token 列表"""
+async def api_redis_tokens(
+    cursor: Optional[str] = Query(None),
+    page_size: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    session_token: Optional[str] = Cookie(None)
+):
+    """分页获取整合后的 token 列表"""
     if not verify_session(session_token):
         raise HTTPException(status_code=401, detail="未授权")
     
@@ -1173,37 +4670,40 @@ async def api_redis_tokens(session_token: Optional[str] = Cookie(None)):
         return {"error": "Redis未连接", "data": []}
     
     try:
-        # 获取所有 client:* 键
-        client_keys = await redis_client.keys("client:*")
+        # 获取一页 client:* 键
+        client_keys, next_cursor = await scan_page("client:*", decode_cursor(cursor), page_size)
+        records = await read_records(client_keys)
         tokens = []
+        repair = redis_client.pipeline(transaction=False)
         
-        for key in client_keys:
+        for key, token_data in zip(client_keys, records):
+            if token_data is None:
+                continue
             client_token = key.replace("client:", "")
-            value = await redis_client.get(key)
-            token_data = json.loads(value)
-            app_token = token_data.get("app_token", "")
             
             # 如果缺少IP信息或IP为空，尝试获取并更新
             current_ip = token_data.get("ip", "")
             if not current_ip or current_ip in ["unknown", "未知", ""]:
                 # 不再尝试获取地理位置，直接标记为未知
-                token_data["ip"] = "未知"
-                token_data["location"] = {
-                    "country": "未知",
-                    "region": "未知",
-                    "city": "未知"
-                }
-                await redis_client.set(key, json.dumps(token_data, ensure_ascii=False))
+                fields = {"ip": "未知", "country": "未知", "region": "未知", "city": "未知"}
+                token_data.update(fields)
+                repair.hset(key, mapping=fields)
             
+            view = client_record_view(client_token, token_data)
             tokens.append({
-                "app_token": app_token,
+                "app_token": view["app_token"],
                 "client_token": client_token,
-                "created_at": token_data.get("created_at", ""),
-                "ip": token_data.get("ip", ""),
-                "location": token_data.get("location", {})
+                "created_at": view["created_at"],
+                "ip": view["ip"],
+                "location": view["location"]
             })
+
+        if len(repair):
+            await repair.execute()
         
-        return {"data": tokens, "total": len(tokens)}
+        return {"data": tokens, "total": len(tokens), "next_cursor": encode_cursor(next_cursor)}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"获取整合Token数据失败: {e}")
         return {"error": str(e), "data": []}
@@ -1212,9 +4712,11 @@ async def api_redis_tokens(session_token: Optional[str] = Cookie(None)):
 @app.get("/api/admin/redis/keys")
 async def api_redis_keys(
     pattern: str = "*",
+    cursor: Optional[str] = Query(None),
+    page_size: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
     session_token: Optional[str] = Cookie(None)
 ):
-    """按模式查询Redis键"""
+    """按模式分页查询Redis键"""
     if not verify_session(session_token):
         raise HTTPException(status_code=401, detail="未授权")
     
@@ -1222,12 +4724,12 @@ async def api_redis_keys(
         return {"error": "Redis未连接", "data": []}
     
     try:
-        keys = await redis_client.keys(pattern)
-        data = []
-        for key in keys[:100]:  # 限制最多100条
-            value = await redis_client.get(key)
-            data.append({"key": key, "value": value})
-        return {"data": data, "total": len(keys)}
+        keys, next_cursor = await scan_page(pattern, decode_cursor(cursor), page_size)
+        values = await fetch_values(keys)
+        data = [{"key": key, "value": value} for key, value in zip(keys, values)]
+        return {"data": data, "total": len(data), "next_cursor": encode_cursor(next_cursor)}
+    except HTTPException:
+        raise
     except Exception as e:
        logger.error(f"查询Redis失败: {e}")
        return {"error": str(e), "data": []}
@@ -1244,6 +4746,8 @@ async def api_redis_clear(session_token: Optional[str] = Cookie(None)):
     
     try:
         await redis_client.flushdb()
+        await invalidate_app_token()
+        redis_stats_cache.clear()
         logger.info("数据库已手动清空")
         return {"success": True, "message": "数据库已清空"}
     except Exception as e:
@@ -1254,8 +4758,16 @@ async def api_redis_clear(session_token: Optional[str] = Cookie(None)):
 # ==================== 指纹管理 API ====================
 
 @app.get("/api/fingerprint/list")
-async def list_fingerprints(session_token: Optional[str] = Cookie(None)):
-    """获取所有已注册的设备指纹"""
+async def list_fingerprints(
+    status: str = Query("all", pattern="^(all|online|blocked)$"),
+    cursor: Optional[str] = Query(None),
+    page_size: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    session_token: Optional[str] = Cookie(None)
+):
+    """
+    分页获取已注册的设备指纹
+    status=all 按最后活跃时间倒序；online / blocked 只返回在线 / 已封禁的设备
+    """
     if not verify_session(session_token):
         raise HTTPException(status_code=401, detail="未授权")
     
@@ -1263,27 +4775,58 @@ async def list_fingerprints(session_token: Optional[str] = Cookie(None)):
         return {"error": "Redis未连接", "data": []}
     
     try:
-        # 获取所有 fingerprint:* 键
-        keys = await redis_client.keys("fingerprint:*")
+        if status == "all":
+            # 按最后活跃时间倒序，游标为偏移量
+            offset = decode_cursor(cursor, "offset")
+            members = await redis_client.zrevrange(FINGERPRINT_INDEX, offset, offset + page_size - 1)
+            next_cursor = encode_cursor(offset + len(members), "offset") if len(members) == page_size else None
+        else:
+            index = ONLINE_INDEX if status == "online" else BLOCKED_INDEX
+            scan_cursor, members = await redis_client.sscan(index, cursor=decode_cursor(cursor), count=page_size)
+            next_cursor = encode_cursor(scan_cursor)
+
         fingerprints = []
-        
-        for key in keys:
-            # 跳过黑名单键
-            if ":blocked:" in key:
-                continue
-            
-            value = await redis_client.get(key)
-            data = json.loads(value)
-            fingerprints.append({
-                "fingerprint": data.get("fingerprint", ""),
-                "created_at": data.get("created_at", ""),
-                "last_seen": data.get("last_seen", ""),
-                "ip": data.get("ip", ""),
-                "location": data.get("location", ""),
-                "has_connection": data.get("fingerprint", "") in manager.active_connections
-            })
-        
-        return {"data": fingerprints, "total": len(fingerprints)}
+        if members:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.smismember(ONLINE_INDEX, members)
+            pipe.smismember(BLOCKED_INDEX, members)
+            online, blocked = await pipe.execute()
+            records = await read_records([f"fingerprint:{fp}" for fp in members])
+            expired = []
+            for fp, data, is_online, is_blocked in zip(members, records, online, blocked):
+                if data is None:
+                    # 记录已过期（封禁设备的记录可能先于封禁过期）
+                    if status == "all":
+                        expired.append(fp)
+                    if status != "blocked":
+                        continue
+                    data = {}
+                fingerprints.append({
+                    "fingerprint": fp,
+                    "created_at": data.get("created_at", ""),
+                    "last_seen": data.get("last_seen", ""),
+                    "ip": data.get("ip", ""),
+                    "location": data.get("location", ""),
+                    "has_connection": bool(is_online),
+                    "blocked": bool(is_blocked)
+                })
+            if expired:
+                await redis_client.zrem(FINGERPRINT_INDEX, *expired)
+
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zcard(FINGERPRINT_INDEX)
+        pipe.scard(ONLINE_INDEX)
+        pipe.scard(BLOCKED_INDEX)
+        total, online_count, blocked_count = await pipe.execute()
+
+        return {
+            "data": fingerprints,
+            "total": {"all": total, "online": online_count, "blocked": blocked_count}[status],
+            "counts": {"all": total, "online": online_count, "blocked": blocked_count},
+            "next_cursor": next_cursor
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"获取指纹列表失败: {e}")
         return {"error": str(e), "data": []}
@@ -1303,20 +4846,15 @@ async def block_fingerprint(
         raise HTTPException(status_code=500, detail="Redis未连接")
     
     # 封禁指纹
-    await redis_client.set(
-        f"fingerprint:blocked:{fingerprint}",
-        reason,
-        ex=365*24*60*60  # 1年过期
-    )
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.set(f"fingerprint:blocked:{fingerprint}", reason, ex=BLOCKED_TTL)  # 1年过期
+    pipe.sadd(BLOCKED_INDEX, fingerprint)
+    await pipe.execute()
     
-    # 关闭该设备的现有连接
-    if fingerprint in manager.active_connections:
-        for conn in list(manager.active_connections[fingerprint]):
-            try:
-                await conn.close(code=4001, reason="设备已被封禁")
-            except Exception:
-                pass
-        del manager.active_connections[fingerprint]
+    # 关闭该设备的现有连接（集群模式下通知其他 worker 一并关闭）
+    await manager.close_local(fingerprint, code=4001, reason="设备已被封禁")
+    await manager.broadcast({"kind": "close", "client_token": fingerprint, "code": 4001, "reason": "设备已被封禁"})
+    await invalidate_app_token(base64.b64encode(fingerprint.encode()).decode())
     
     logger.info(f"设备已被封禁: {fingerprint[:20]}...")
     
@@ -1335,7 +4873,10 @@ async def unblock_fingerprint(
     if not redis_client:
         raise HTTPException(status_code=500, detail="Redis未连接")
     
-    await redis_client.delete(f"fingerprint:blocked:{fingerprint}")
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.delete(f"fingerprint:blocked:{fingerprint}")
+    pipe.srem(BLOCKED_INDEX, fingerprint)
+    await pipe.execute()
     
     logger.info(f"设备已解封: {fingerprint[:20]}...")
     
@@ -1349,28 +4890,136 @@ async def get_logs(
     level: str = Query(None),
     category: str = Query(None),
     since: str = Query(None),
+    since_seq: int = Query(None),
+    before: str = Query(None),
+    before_seq: int = Query(None),
+    worker: str = Query(None),
     limit: int = Query(100, le=500),
     session_token: Optional[str] = Cookie(None)
 ):
-    """获取日志列表"""
+    """
+    获取日志列表
+    
+    默认返回内存缓冲区中的最新日志；指定 before_seq 或 before（时间）时向前翻页，
+    启用磁盘日志存储后可以一直翻到保留期内最早的日志。
+    日志序号只在单个 worker 内有效，翻页时带上响应中的 worker，
+    请求落到其他 worker 时返回 409，需要重新加载最新日志
+    """
     if not verify_session(session_token):
         raise HTTPException(status_code=401, detail="未授权")
+    if before_seq is not None and worker and worker != manager.worker_id:
+        raise HTTPException(status_code=409, detail="翻页游标来自其他 worker，请重新加载日志")
     
-    logs = await log_queue.get(level=level, category=category, since=since, limit=limit)
+    try:
+        if before_seq is not None or before:
+            logs = await query_log_history(level=level, category=category, before=before,
+                                           before_seq=before_seq, limit=limit)
+        else:
+            logs = log_queue.get(level=level, category=category, since=since, since_seq=since_seq, limit=limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="时间格式无效")
     return {
         "logs": logs,
         "total": len(logs),
-        "has_more": len(logs) == limit
+        "has_more": len(logs) == limit,
+        "next_before_seq": logs[-1]["seq"] if logs else None,
+        "worker": manager.worker_id,
+        "history": log_store is not None
     }
 
 
+def format_sse(data, event: str = None, event_id: int = None) -> str:
+    """格式化一条 Server-Sent Events 消息"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+    return "\n".join(lines) + "\n\n"
+
+
+@app.get("/api/admin/logs/stream")
+async def stream_logs(
+    request: Request,
+    level: str = Query(None),
+    category: str = Query(None),
+    since_seq: int = Query(None),
+    session_token: Optional[str] = Cookie(None)
+):
+    """
+    实时推送日志（Server-Sent Events）
+    
+    - log 事件：新日志，id 为日志序号，断线重连时浏览器通过 Last-Event-ID 续传
+    - stats 事件：日志统计，随每批新日志推送
+    - clear 事件：日志已被清空，或续传的序号超出当前最大序号（服务重启后序号从头开始），客户端从 seq 重新同步
+    """
+    if not verify_session(session_token):
+        raise HTTPException(status_code=401, detail="未授权")
+    
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        since_seq = int(last_event_id)
+    if since_seq is None:
+        since_seq = log_queue.last_seq
+    
+    async def event_stream():
+        cursor = since_seq
+        generation = log_queue.generation
+        yield "retry: 3000\n\n"
+        if cursor > log_queue.last_seq:
+            # 未配置 LOG_STORE_DIR 时重启后序号从头开始，旧的 Last-Event-ID 会让实时推送一直停住
+            cursor = 0
+            yield format_sse({"seq": 0}, event="clear")
+        yield format_sse(log_queue.get_stats(), event="stats")
+        while True:
+            if await request.is_disconnected() or not verify_session(session_token):
+                break
+            
+            sent = False
+            if log_queue.generation != generation:
+                generation = log_queue.generation
+                yield format_sse({"seq": log_queue.cleared_seq}, event="clear")
+                sent = True
+            
+            if log_queue.last_seq > cursor:
+                logs = log_queue.get(level=level, category=category, since_seq=cursor, limit=log_queue.max_size)
+                # 过滤掉的日志也推进游标，避免重复扫描
+                cursor = log_queue.last_seq
+                if logs:
+                    yield "".join(format_sse(log, event="log", event_id=log["seq"]) for log in reversed(logs))
+                    sent = True
+            
+            if sent:
+                yield format_sse(log_queue.get_stats(), event="stats")
+            
+            # 挂起在 yield 期间产生的日志不会唤醒随后才注册的等待者，先检查再等待
+            if log_queue.last_seq > cursor or log_queue.generation != generation:
+                continue
+            if not await log_queue.wait(LOG_STREAM_KEEPALIVE):
+                yield ": keepalive\n\n"
+                continue
+            await asyncio.sleep(LOG_STREAM_BATCH_DELAY)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.get("/api/admin/logs/stats")
-async def get_logs_stats(session_token: Optional[str] = Cookie(None)):
-    """获取日志统计"""
+async def get_logs_stats(
+    series: bool = Query(False),
+    session_token: Optional[str] = Cookie(None)
+):
+    """获取日志统计（series=true 时附带每分钟计数）"""
     if not verify_session(session_token):
         raise HTTPException(status_code=401, detail="未授权")
     
-    stats = await log_queue.get_stats()
+    stats = log_queue.get_stats(with_series=series)
+    if log_store is not None:
+        stats["store"] = log_store.stats()
     return stats
 
 
@@ -1380,6 +5029,6 @@ async def clear_logs(session_token: Optional[str] = Cookie(None)):
     if not verify_session(session_token):
         raise HTTPException(status_code=401, detail="未授权")
     
-    await log_queue.clear()
+    log_queue.clear()
     log_event("INFO", "SYSTEM", "🧹 日志已清空", "")
     return {"success": True, "message": "日志已清空"}
@@ -11,6 +11,11 @@ else
     echo "⚠️  未检测到 Redis，请确保 Zeabur Redis Addon 已配置"
 fi
 
+if [ "${WEB_CONCURRENCY:-1}" -gt 1 ] && [ "${FANOUT_MODE:-local}" != "redis" ]; then
+    echo "⚠️  WEB_CONCURRENCY=${WEB_CONCURRENCY} 但未启用 FANOUT_MODE=redis，消息可能无法送达其他 worker 上的连接"
+fi
+
 echo "========================================="
 
-exec uvicorn main:app --host 0.0.0.0 --port 8080
+# 多 worker 需配合 FANOUT_MODE=redis，否则消息只能送达接收请求的 worker
+exec uvicorn main:app --host 0.0.0.0 --port 8080 --workers "${WEB_CONCURRENCY:-1}"
@@ -0,0 +1,126 @@
+"""测试公共夹具
+
+默认使用 fakeredis；设置 TEST_REDIS_URL 后改为连接真实的 redis-server，例如：
+
+    TEST_REDIS_URL=redis://localhost:6379/15 python -m pytest -q
+
+注意：使用真实 Redis 时每个测试开始前会清空该库，请指定专用的库号。
+"""
+import asyncio
+import json
+import os
+import sys
+
+import fakeredis
+import pytest
+import redis.asyncio as redis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+TEST_REDIS_URL = os.getenv("TEST_REDIS_URL", "")
+
+# WebSocket 握手按来源 IP 查询位置，测试统一使用内网地址
+HEADERS = {"X-Forwarded-For": "192.168.1.10"}
+
+
+class FakeWebSocket:
+    """记录文本帧（已解析为 JSON）的假连接，二进制帧直接丢弃"""
+
+    def __init__(self):
+        self.texts = []
+        self.client = None
+
+    async def accept(self, *args, **kwargs):
+        pass
+
+    async def send_text(self, text):
+        self.texts.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        pass
+
+    async def close(self, code=1000, reason=""):
+        pass
+
+
+class SlowWebSocket(FakeWebSocket):
+    """按固定速率（字节/秒）写出二进制帧的假连接"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    async def send_bytes(self, data):
+        await asyncio.sleep(len(data) / self.rate)
+
+
+class GatedWebSocket(FakeWebSocket):
+    """收到放行信号前不写出任何帧的假连接"""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = asyncio.Event()
+
+    async def send_text(self, text):
+        await self.gate.wait()
+        await super().send_text(text)
+
+    async def send_bytes(self, data):
+        await self.gate.wait()
+
+
+async def settle(predicate, timeout=2.0):
+    """轮询直到 predicate() 为真或超时"""
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def redis_factory(monkeypatch):
+    """返回创建 Redis 客户端的协程函数，并替换 main 中的 redis.from_url"""
+    server = fakeredis.FakeServer()
+    flushed = []
+
+    async def from_url(url=None, **kwargs):
+        kwargs.setdefault("decode_responses", True)
+        if not TEST_REDIS_URL:
+            return fakeredis.FakeAsyncRedis(server=server, **kwargs)
+        client = redis.Redis.from_url(TEST_REDIS_URL, **kwargs)
+        if not flushed:
+            await client.flushdb()
+            flushed.append(True)
+        return client
+
+    monkeypatch.setattr(main.redis, "from_url", from_url)
+    return from_url
+
+
+# startup_event 注册的 Lua 脚本（run_with_redis 不经过启动流程，需自行注册）
+SCRIPTS = {
+    "handshake_script": main.HANDSHAKE_LUA,
+    "presence_script": main.PRESENCE_LUA,
+    "migrate_record_script": main.MIGRATE_RECORD_LUA,
+    "mailbox_release_script": main.MAILBOX_RELEASE_LUA,
+    "mailbox_push_script": main.MAILBOX_PUSH_LUA,
+}
+
+
+@pytest.fixture
+def run_with_redis(redis_factory, monkeypatch):
+    """在新的事件循环中运行 coro_fn(client)，期间 main.redis_client 指向测试 Redis 并已注册 Lua 脚本"""
+    def run(coro_fn):
+        async def runner():
+            client = await redis_factory()
+            monkeypatch.setattr(main, "redis_client", client)
+            for name, lua in SCRIPTS.items():
+                monkeypatch.setattr(main, name, client.register_script(lua))
+            try:
+                return await coro_fn(client)
+            finally:
+                await client.aclose()
+        return asyncio.run(runner())
+    return run
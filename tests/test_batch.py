@@ -0,0 +1,50 @@
+import json
+
+from fastapi.testclient import TestClient
+
+import main
+from conftest import HEADERS
+
+
+def app_token(fingerprint: str) -> str:
+    return main.base64.b64encode(fingerprint.encode()).decode()
+
+
+def test_batch_reports_partial_success(redis_factory):
+    online, offline = app_token("batch-online"), app_token("batch-offline")
+    with TestClient(main.app) as client:
+        with client.websocket_connect("/stream?token=batch-offline", headers=HEADERS):
+            pass
+        with client.websocket_connect("/stream?token=batch-online", headers=HEADERS) as websocket:
+            response = client.post("/message/batch", json={"items": [
+                {"token": online, "message": "first"},
+                {"token": "dW5rbm93bg==", "message": "lost"},
+                {"token": offline, "message": "later"},
+                {"token": online, "message": "second", "priority": 5},
+            ]})
+            received = [websocket.receive_json()["message"] for _ in range(2)]
+        stored = client.portal.call(main.redis_client.xrange, main.Mailbox.key("batch-offline"))
+
+    body = response.json()
+    assert response.status_code == 200 and body["total"] == 4
+    assert body["summary"] == {"success": 2, "invalid_token": 1, "queued": 1}
+    results = body["results"]
+    # 结果按请求顺序返回，重复的 token 各自有一条结果
+    assert [r["token"] for r in results] == [online, "dW5rbm93bg==", offline, online]
+    assert [r["status"] for r in results] == ["success", "invalid_token", "queued", "success"]
+    assert results[0]["connections"] == results[3]["connections"] == 1
+    assert sorted(received) == ["first", "second"]
+    assert [entry_id for entry_id, _ in stored] == [results[2]["mailbox_id"]]
+    assert json.loads(stored[0][1]["data"])["message"] == "later"
+
+
+def test_batch_shared_message_and_validation(redis_factory):
+    with TestClient(main.app) as client:
+        with client.websocket_connect("/stream?token=batch-shared", headers=HEADERS) as websocket:
+            response = client.post("/message/batch", json={"tokens": [app_token("batch-shared")], "message": "hello"})
+            assert websocket.receive_json()["message"] == "hello"
+        missing_message = client.post("/message/batch", json={"tokens": [app_token("batch-shared")]})
+        empty = client.post("/message/batch", json={})
+    assert response.json()["summary"] == {"success": 1}
+    assert missing_message.status_code == 400
+    assert empty.status_code == 400
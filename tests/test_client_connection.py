@@ -0,0 +1,57 @@
+import asyncio
+
+import main
+from conftest import SlowWebSocket
+
+
+def test_v1_text_not_blocked_by_queued_transfer(monkeypatch):
+    monkeypatch.setattr(main, "PRIORITY_AGING_SECONDS", 60)
+    monkeypatch.setattr(main, "BINARY_CHUNK_ADAPTIVE", False)
+
+    async def scenario():
+        manager = main.ConnectionManager()
+        websocket = SlowWebSocket(rate=4 * 1024 * 1024)
+        await manager.connect("prio-tok", websocket)
+        # v1 连接同时只发送一个传输：bulk 发送中，queued 排在传输堆顶等待名额
+        await manager.send_binary("prio-tok", b"x" * (1024 * 1024), {"filename": "bulk.jpg", "transfer_id": "bulk", "priority": 1})
+        await asyncio.sleep(0.02)
+        await manager.send_binary("prio-tok", b"y" * (1024 * 1024), {"filename": "queued.jpg", "transfer_id": "queued", "priority": 5})
+        await manager.send_message("prio-tok", {"type": "message", "message": "urgent", "priority": 3})
+        for _ in range(300):
+            if sum(t.get("type") == "binary_end" for t in websocket.texts) == 2:
+                break
+            await asyncio.sleep(0.01)
+        manager.disconnect("prio-tok", websocket)
+        return websocket.texts
+
+    texts = asyncio.run(scenario())
+    order = [
+        t.get("message") if t.get("type") == "message" else t.get("transfer_id")
+        for t in texts if t.get("type") in ("message", "binary_end")
+    ]
+    # 文本比发送中的传输紧急，不必等排队中的更高优先级传输取得名额
+    assert order == ["urgent", "bulk", "queued"]
+
+
+def test_drop_oldest_never_evicts_higher_priority(monkeypatch):
+    monkeypatch.setattr(main, "OUTBOUND_QUEUE_MAX_ITEMS", 3)
+    monkeypatch.setattr(main, "OUTBOUND_OVERFLOW_POLICY", "drop-oldest")
+    conn = main.ClientConnection(main.ConnectionManager(), "drop-tok", None)
+    for name, priority in (("high-1", 5), ("low", 1), ("high-2", 5)):
+        assert conn.enqueue(main.OutboundText(name, priority))
+
+    def queued():
+        return sorted(entry[3].text for entry in conn.texts)
+
+    # 新消息优先级高于 low，丢弃 low
+    assert conn.enqueue(main.OutboundText("mid", 3))
+    assert queued() == ["high-1", "high-2", "mid"]
+    # 队列中没有优先级不高于新消息的条目，拒绝新消息而不是丢弃更紧急的消息
+    assert not conn.enqueue(main.OutboundText("bulk", 1))
+    assert queued() == ["high-1", "high-2", "mid"]
+    # 先丢弃最低优先级，同优先级时丢弃最早入队的
+    assert conn.enqueue(main.OutboundText("high-3", 5))
+    assert queued() == ["high-1", "high-2", "high-3"]
+    assert conn.enqueue(main.OutboundText("high-4", 5))
+    assert queued() == ["high-2", "high-3", "high-4"]
+    assert conn.dropped == 4
@@ -0,0 +1,78 @@
+import os
+import shutil
+
+import pytest
+
+import main
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "geoip.csv")
+
+
+@pytest.fixture
+def geoip_db(tmp_path):
+    db = main.GeoIPDatabase.open(str(shutil.copy(FIXTURE, tmp_path / "geoip.csv")))
+    yield db
+    db.close()
+
+
+def test_compile_csv_skips_header_and_malformed_rows(tmp_path):
+    # 表头、无法解析的 IP、列数不足的行都被跳过
+    assert main.GeoIPDatabase.compile_csv(FIXTURE, str(tmp_path / "geoip.bin")) == 5
+
+
+@pytest.mark.parametrize("ip, expected", [
+    # CIDR 行，取最后三列（中间的 geoname_id 被忽略）
+    ("1.0.0.0", ("澳大利亚", "昆士兰", "布里斯班")),
+    ("1.0.0.255", ("澳大利亚", "昆士兰", "布里斯班")),
+    ("8.8.8.8", ("美国", "加利福尼亚", "山景城")),
+    # 起止 IP 行，多出的列同样忽略
+    ("1.0.1.0", ("中国", "福建", "福州")),
+    ("1.0.2.17", ("中国", "福建", "福州")),
+    ("1.0.3.255", ("中国", "福建", "福州")),
+    # 整数形式的起止 IP
+    ("1.2.3.4", ("中国", "北京", "北京")),
+    # IPv4 映射的 IPv6 地址与 IPv4 共用同一区间
+    ("::ffff:8.8.8.8", ("美国", "加利福尼亚", "山景城")),
+    ("::ffff:1.2.3.4", ("中国", "北京", "北京")),
+    # IPv6
+    ("2001:db8::1", ("文档", "保留", "示例")),
+    ("2001:db8:ffff:ffff:ffff:ffff:ffff:ffff", ("文档", "保留", "示例")),
+    # 未命中：第一条记录之前、区间之间的空隙、最后一条之后、非法地址
+    ("0.255.255.255", None),
+    ("1.0.4.0", None),
+    ("8.8.9.0", None),
+    ("2001:db9::", None),
+    ("::1", None),
+    ("not-an-ip", None),
+])
+def test_lookup(geoip_db, ip, expected):
+    result = geoip_db.lookup(ip)
+    if expected is None:
+        assert result is None
+    else:
+        assert (result["country"], result["region"], result["city"]) == expected
+
+
+def test_open_recompiles_when_csv_is_newer(tmp_path):
+    csv_path = str(shutil.copy(FIXTURE, tmp_path / "geoip.csv"))
+    main.GeoIPDatabase.open(csv_path).close()
+    bin_path = csv_path + ".bin"
+    assert os.path.exists(bin_path)
+
+    with open(csv_path, "a", encoding="utf-8") as f:
+        f.write("9.9.9.0/24,5001,瑞士,苏黎世,苏黎世\n")
+    stale = os.path.getmtime(bin_path) - 10
+    os.utime(bin_path, (stale, stale))
+    db = main.GeoIPDatabase.open(csv_path)
+    try:
+        assert db.count == 6
+        assert db.lookup("9.9.9.9")["country"] == "瑞士"
+    finally:
+        db.close()
+
+
+def test_rejects_file_without_magic(tmp_path):
+    path = tmp_path / "broken.bin"
+    path.write_bytes(b"\x00" * 64)
+    with pytest.raises(ValueError):
+        main.GeoIPDatabase(str(path))
@@ -0,0 +1,30 @@
+from fastapi.testclient import TestClient
+
+import main
+from conftest import HEADERS
+
+
+def test_handshake_replaces_corrupt_legacy_record(redis_factory):
+    fingerprint = "corrupt-legacy-device"
+    with TestClient(main.app) as client:
+        client.portal.call(main.redis_client.set, f"fingerprint:{fingerprint}", "{not json")
+        with client.websocket_connect(f"/stream?token={fingerprint}", headers=HEADERS):
+            pass
+        record = client.portal.call(main.redis_client.hgetall, f"fingerprint:{fingerprint}")
+    assert record["fingerprint"] == fingerprint
+    assert record["created_at"] == record["last_seen"]
+    assert record["ip"] == "192.168.1.10"
+
+
+def test_handshake_registers_tokens_with_ttls(redis_factory):
+    fingerprint = "handshake-ttl-device"
+    app_token = main.base64.b64encode(fingerprint.encode()).decode()
+    with TestClient(main.app) as client:
+        with client.websocket_connect(f"/stream?token={fingerprint}", headers=HEADERS):
+            pass
+        call = client.portal.call
+        assert call(main.redis_client.get, f"app:{app_token}") == fingerprint
+        assert call(main.redis_client.hget, f"client:{fingerprint}", "app_token") == app_token
+        assert 0 < call(main.redis_client.ttl, f"app:{app_token}") <= main.APP_TOKEN_TTL
+        assert main.APP_TOKEN_TTL < call(main.redis_client.ttl, f"client:{fingerprint}") <= main.CLIENT_TOKEN_TTL
+        assert main.APP_TOKEN_TTL < call(main.redis_client.ttl, f"fingerprint:{fingerprint}") <= main.FINGERPRINT_TTL
@@ -0,0 +1,57 @@
+import asyncio
+import json
+
+from fastapi.testclient import TestClient
+
+import main
+from conftest import FakeWebSocket, settle
+
+
+def test_image_cache_only_serves_referencing_tokens():
+    cache = main.ImageCache(1024)
+    cache.put("abc", b"image", "image/png", "tok-a")
+    assert cache.get("abc", "tok-a") == (b"image", "image/png")
+    assert cache.get("abc", "tok-b") is None
+    cache.put("abc", b"image", "image/png", "tok-b")
+    assert cache.get("abc", "tok-b") == (b"image", "image/png")
+    # 淘汰后引用关系一起清除
+    cache.put("big", b"x" * 1024, "image/png", "tok-c")
+    assert "abc" not in cache
+    cache.put("abc", b"image", "image/png", "tok-c")
+    assert cache.get("abc", "tok-a") is None
+
+
+def test_cache_miss_for_foreign_image_is_refused(monkeypatch):
+    monkeypatch.setattr(main, "image_cache", main.ImageCache(1024 * 1024))
+
+    async def scenario():
+        manager = main.ConnectionManager()
+        main.image_cache.put("s" * 64, b"secret", "image/png", "tok-a")
+        websocket = FakeWebSocket()
+        await manager.connect("tok-b", websocket, proto=2)
+        await manager.handle_client_message(websocket, json.dumps({"type": "cache_miss", "sha256": "s" * 64, "transfer_id": "t1"}))
+        await settle(lambda: any(t.get("transfer_id") == "t1" for t in websocket.texts))
+        manager.disconnect("tok-b", websocket)
+        return websocket.texts
+
+    texts = [t for t in asyncio.run(scenario()) if t.get("transfer_id") == "t1"]
+    assert [t["type"] for t in texts] == ["binary_error"]
+
+
+def test_push_by_hash_requires_reference_from_same_token(redis_factory, monkeypatch):
+    monkeypatch.setattr(main, "image_cache", main.ImageCache(1024 * 1024))
+    main.image_cache.put("d" * 64, b"secret", "image/png", "tok-a")
+
+    async def get_client_token(app_token, *args):
+        return f"tok-{app_token}"
+
+    async def connection_count(client_token):
+        return 1
+
+    monkeypatch.setattr(main, "get_client_token", get_client_token)
+    monkeypatch.setattr(main.manager, "connection_count", connection_count)
+    with TestClient(main.app) as client:
+        foreign = client.post(f"/message/image?token=b&sha256={'d' * 64}")
+        own = client.post(f"/message/image?token=a&sha256={'d' * 64}")
+    assert foreign.status_code == 404
+    assert own.status_code == 200
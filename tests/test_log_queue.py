@@ -0,0 +1,109 @@
+from datetime import datetime
+
+import pytest
+
+import main
+
+START = 1_700_000_000.0  # 整分钟
+
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(START)
+    monkeypatch.setattr(main.time, "time", clock)
+    return clock
+
+
+def iso(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, main.CHINA_TZ).isoformat()
+
+
+def test_log_ring_evicts_oldest_and_bisects():
+    ring = main.LogRing(3)
+    assert [ring.append(i) for i in range(5)] == [None, None, None, 0, 1]
+    assert len(ring) == 3 and [ring[i] for i in range(3)] == [2, 3, 4]
+    assert ring.bisect_right(2, int) == 1
+    assert ring.bisect_right(1, int) == 0
+    assert ring.bisect_right(9, int) == 3
+    assert ring.popleft() == 2 and [ring[i] for i in range(len(ring))] == [3, 4]
+    ring.clear()
+    assert len(ring) == 0 and ring.append(7) is None and ring[0] == 7
+
+
+def test_eviction_keeps_indexes_and_counts_consistent(clock):
+    queue = main.LogQueue(max_size=4)
+    for i, level in enumerate(["INFO", "ERROR", "INFO", "WARNING", "INFO", "ERROR"]):
+        queue.add(level, "SYSTEM" if i % 2 else "BINARY", f"log {i + 1}")
+    # 1、2 已淘汰，索引环中也不再保留
+    assert [log["seq"] for log in queue.get(limit=10)] == [6, 5, 4, 3]
+    assert [log["seq"] for log in queue.get(level="ERROR")] == [6]
+    assert [log["seq"] for log in queue.get(level="INFO")] == [5, 3]
+    assert [log["seq"] for log in queue.get(category="BINARY")] == [5, 3]
+    assert [log["seq"] for log in queue.get(level="INFO", category="SYSTEM")] == []
+    assert queue.level_counts == {"INFO": 2, "WARNING": 1, "ERROR": 1}
+    assert queue.category_counts == {"BINARY": 2, "SYSTEM": 2}
+    stats = queue.get_stats()
+    assert stats["total"] == 4 and stats["total_appended"] == 6
+
+
+def test_get_filters_by_level_since_and_seq_bounds(clock):
+    queue = main.LogQueue(max_size=100)
+    for i in range(10):
+        clock.now = START + i * 10
+        queue.add("ERROR" if i % 3 == 0 else "INFO", "SYSTEM", f"log {i + 1}")
+    # seq 1..10，ERROR 为 1、4、7、10，时间为 START + (seq - 1) * 10
+    assert [log["seq"] for log in queue.get(level="ERROR", since=iso(START + 30))] == [10, 7]
+    assert [log["seq"] for log in queue.get(level="ERROR", since=iso(START + 29))] == [10, 7, 4]
+    assert [log["seq"] for log in queue.get(level="INFO", since_seq=5, before_seq=9)] == [8, 6]
+    assert [log["seq"] for log in queue.get(since=iso(START + 15), since_seq=6, limit=2)] == [10, 9]
+    assert [log["seq"] for log in queue.get(level="DEBUG")] == []
+    assert queue.get(limit=1)[0]["timestamp"] == iso(START + 90)
+
+
+def test_seq_at_time(clock):
+    queue = main.LogQueue(max_size=3)
+    assert queue.seq_at_time(START) is None
+    for i in range(5):
+        clock.now = START + i * 10
+        queue.add("INFO", "SYSTEM", f"log {i + 1}")
+    # 缓冲区中只剩 3、4、5（时间 START+20 ~ START+40）
+    assert queue.seq_at_time(START + 10) is None
+    assert queue.seq_at_time(START + 20) == 4
+    assert queue.seq_at_time(START + 25) == 4
+    assert queue.seq_at_time(START + 40) == 6
+
+
+def test_rate_window_buckets_per_minute_and_expires_stale_buckets():
+    window = main.RateWindow(size=5)
+    window.add(100)
+    window.add(100)
+    window.add(102, count=3)
+    assert window.series(102) == [0, 0, 2, 0, 3]
+    assert window.series(104) == [2, 0, 3, 0, 0]
+    # 分钟 105 与 100 落在同一个桶，写入时先清零旧计数
+    window.add(105)
+    assert window.series(105) == [0, 3, 0, 0, 1]
+    assert window.series(200) == [0, 0, 0, 0, 0]
+
+
+def test_get_rates_counts_per_level_and_minute(clock):
+    queue = main.LogQueue(max_size=100)
+    for minute, level, count in ((0, "INFO", 4), (3, "INFO", 2), (5, "ERROR", 1), (7, "INFO", 1)):
+        clock.now = START + minute * 60 + 30
+        for _ in range(count):
+            queue.add(level, "SYSTEM", "x")
+    rates = queue.get_rates(with_series=True)
+    assert rates["window_minutes"] == main.LOG_RATE_WINDOW_MINUTES
+    info, error = rates["by_level"]["INFO"], rates["by_level"]["ERROR"]
+    assert (info["last_minute"], info["last_5_minutes"], info["window"]) == (1, 3, 7)
+    assert len(info["per_minute"]) == main.LOG_RATE_WINDOW_MINUTES
+    assert info["per_minute"][-8:] == [4, 0, 0, 2, 0, 0, 0, 1]
+    assert (error["last_minute"], error["last_5_minutes"], error["window"]) == (0, 1, 1)
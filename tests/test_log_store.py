@@ -0,0 +1,52 @@
+from datetime import timedelta
+
+import main
+
+
+def make_entry(seq: int, epoch: float) -> main.LogEntry:
+    entry = main.LogEntry(seq, "INFO", "SYSTEM", f"log {seq}")
+    entry.epoch = epoch
+    return entry
+
+
+def test_seq_at_time_scans_tail_after_last_index_point(tmp_path):
+    store = main.LogStore(str(tmp_path), segment_size=1 << 20, index_interval=4)
+    store.open()
+    start = 1_700_000_000.0
+    # 第一段 1..10，索引点位于 1、5、9；10 在最后一个索引点之后的尾块中
+    store._write([make_entry(seq, start + seq) for seq in range(1, 11)])
+    # 强制轮转出第二段 11..12
+    store.segment_size = 0
+    store._write([make_entry(11, start + 100)])
+    store.segment_size = 1 << 20
+    store._write([make_entry(12, start + 101)])
+    assert len(store.segments) == 2
+    assert [point[0] for point in store.segments[0].open_index()] == [1, 5, 9]
+
+    assert store.seq_at_time(start + 9.5) == 10
+    assert store.seq_at_time(start + 4.5) == 5
+    assert store.seq_at_time(start + 10.5) == 11
+    assert store.seq_at_time(start + 100.5) == 12
+    assert store.seq_at_time(start + 200) is None
+    assert store.seq_at_time(start) == 1
+    main.asyncio.run(store.close())
+
+
+def test_history_cursor_is_scoped_to_worker(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(main, "active_sessions", {"s": main.now_china() + timedelta(hours=1)})
+    monkeypatch.setattr(main, "log_queue", main.LogQueue(max_size=100))
+    for i in range(5):
+        main.log_queue.add("INFO", "SYSTEM", f"log {i}")
+
+    client = TestClient(main.app)
+    client.cookies.set("session_token", "s")
+    first = client.get("/api/admin/logs?limit=2").json()
+    assert first["worker"] == main.manager.worker_id
+    params = {"before_seq": first["next_before_seq"], "limit": 2}
+    older = client.get("/api/admin/logs", params={**params, "worker": first["worker"]})
+    assert [log["message"] for log in older.json()["logs"]] == ["log 2", "log 1"]
+    # 其他 worker 发出的游标不能在本 worker 上使用
+    foreign = client.get("/api/admin/logs", params={**params, "worker": "other-host:1:abcd"})
+    assert foreign.status_code == 409
@@ -0,0 +1,54 @@
+import asyncio
+from datetime import timedelta
+
+import main
+
+
+class FakeRequest:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+    async def is_disconnected(self):
+        return False
+
+
+def test_log_added_during_yield_is_delivered_without_waiting(monkeypatch):
+    monkeypatch.setattr(main, "active_sessions", {"s": main.now_china() + timedelta(hours=1)})
+    monkeypatch.setattr(main, "LOG_STREAM_KEEPALIVE", 5)
+
+    async def scenario():
+        response = await main.stream_logs(FakeRequest(), level=None, category=None, since_seq=None, session_token="s")
+        stream = response.body_iterator
+        assert (await stream.__anext__()).startswith("retry")
+        assert "event: stats" in await stream.__anext__()
+        main.log_queue.add("INFO", "SYSTEM", "first")
+        assert "first" in await asyncio.wait_for(stream.__anext__(), 1)
+        # 生成器挂起在 yield 时写入日志，此时没有等待者可唤醒
+        main.log_queue.add("INFO", "SYSTEM", "written while suspended")
+        assert "event: stats" in await stream.__anext__()
+        chunk = await asyncio.wait_for(stream.__anext__(), 1)
+        await stream.aclose()
+        return chunk
+
+    assert "written while suspended" in asyncio.run(scenario())
+
+
+def test_stale_last_event_id_resyncs_from_start(monkeypatch):
+    monkeypatch.setattr(main, "active_sessions", {"s": main.now_china() + timedelta(hours=1)})
+    monkeypatch.setattr(main, "LOG_STREAM_KEEPALIVE", 5)
+    monkeypatch.setattr(main, "log_queue", main.LogQueue(max_size=100))
+
+    async def scenario():
+        main.log_queue.add("INFO", "SYSTEM", "after restart")
+        # 重启前浏览器收到的最后序号远大于当前序号
+        request = FakeRequest({"last-event-id": "5000"})
+        response = await main.stream_logs(request, level=None, category=None, since_seq=None, session_token="s")
+        stream = response.body_iterator
+        chunks = [await asyncio.wait_for(stream.__anext__(), 1) for _ in range(4)]
+        await stream.aclose()
+        return chunks
+
+    chunks = asyncio.run(scenario())
+    assert chunks[1].startswith("event: clear")
+    assert '"seq":0' in chunks[1]
+    assert "after restart" in chunks[3]
@@ -0,0 +1,118 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import main
+from conftest import HEADERS, FakeWebSocket, GatedWebSocket, settle
+
+
+def test_v1_auto_ack_keeps_replayed_entries_dropped_by_overflow(run_with_redis, monkeypatch):
+    monkeypatch.setattr(main, "OUTBOUND_QUEUE_MAX_ITEMS", 4)
+
+    async def scenario(client):
+        token = "mailbox-overflow"
+        payloads = [{"message": f"offline {i}"} for i in range(3)]
+        ids = await main.mailbox.push_many([(token, "message", payload) for payload in payloads])
+        entries = [(entry_id, "message", payload) for entry_id, payload in zip(ids, payloads)]
+        manager = main.ConnectionManager()
+        websocket = GatedWebSocket()
+        await manager.connect(token, websocket)
+        # 写任务卡在第一条实时消息上，补发消息留在队列中，随后的实时消息挤掉最早的补发消息
+        await manager.send_message(token, {"message": "live 0"})
+        await asyncio.sleep(0.05)
+        await manager.deliver_mailbox(websocket, entries=entries)
+        for i in range(1, 3):
+            await manager.send_message(token, {"message": f"live {i}"})
+        websocket.gate.set()
+        await settle(lambda: len(websocket.texts) >= 5)
+        await asyncio.sleep(0.05)
+        remaining = [entry_id for entry_id, _ in await client.xrange(main.Mailbox.key(token))]
+        written = [t["mailbox_id"] for t in websocket.texts if "mailbox_id" in t]
+        manager.disconnect(token, websocket)
+        return ids, written, remaining
+
+    ids, written, remaining = run_with_redis(scenario)
+    assert written and len(written) < len(ids)
+    assert sorted(written + remaining) == sorted(ids)
+
+
+def test_concurrent_connects_replay_mailbox_once(redis_factory, monkeypatch):
+    fingerprint = "mailbox-claim-device"
+    app_token = main.base64.b64encode(fingerprint.encode()).decode()
+    replays = []
+    deliver_mailbox = main.ConnectionManager.deliver_mailbox
+
+    async def recording_deliver(self, websocket, entries, claim=""):
+        replays.append((entries, claim))
+        if len(replays) > 1:
+            # 第二个连接结束后再让第一个连接完成补发并释放占用
+            await deliver_mailbox(self, websocket, entries, claim)
+
+    with TestClient(main.app) as client:
+        with client.websocket_connect(f"/stream?token={fingerprint}", headers=HEADERS):
+            pass
+        client.post(f"/message?token={app_token}", json={"message": "offline"})
+        monkeypatch.setattr(main.ConnectionManager, "deliver_mailbox", recording_deliver)
+        # 第一个连接占用信箱但尚未补发完成时，第二个连接不应再读到同一批消息
+        with client.websocket_connect(f"/stream?token={fingerprint}", headers=HEADERS):
+            with client.websocket_connect(f"/stream?token={fingerprint}", headers=HEADERS):
+                pass
+        claim_key = main.Mailbox.claim_key(fingerprint)
+        claimed = client.portal.call(main.redis_client.get, claim_key)
+
+    (first, first_claim), (second, second_claim) = replays
+    assert [payload["message"] for _, _, payload in first] == ["offline"]
+    assert second == []
+    assert claimed == first_claim
+
+
+class BrokenWebSocket(FakeWebSocket):
+    async def send_bytes(self, data):
+        raise RuntimeError("connection reset")
+
+
+def test_failed_replay_transfer_settles_once(run_with_redis, monkeypatch):
+    acks = []
+
+    class RecordingAck(main.MailboxAck):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            acks.append(self)
+
+    monkeypatch.setattr(main, "MailboxAck", RecordingAck)
+
+    async def scenario(client):
+        token = "mailbox-broken"
+        payload = {"metadata": {"filename": "a.png"}, "data": main.base64.b64encode(b"x" * 1024).decode()}
+        ids = await main.mailbox.push_many([(token, "binary", payload)])
+        manager = main.ConnectionManager()
+        websocket = BrokenWebSocket()
+        await manager.connect(token, websocket)
+        await manager.deliver_mailbox(websocket, entries=[(ids[0], "binary", payload)])
+        await settle(lambda: token not in manager.active_connections)
+        await asyncio.sleep(0.05)
+        return ids, [entry_id for entry_id, _ in await client.xrange(main.Mailbox.key(token))]
+
+    ids, remaining = run_with_redis(scenario)
+    assert [ack.pending for ack in acks] == [0]
+    assert remaining == ids
+
+
+def test_mailbox_byte_budget_drops_oldest_and_rejects_oversized(run_with_redis, monkeypatch):
+    monkeypatch.setattr(main, "mailbox", main.Mailbox(max_len=100, max_bytes=1000, ttl=3600))
+
+    async def scenario(client):
+        token = "mailbox-budget"
+        key = main.Mailbox.key(token)
+        ids = [await main.mailbox.push(token, "message", {"message": "x" * 380}) for _ in range(3)]
+        assert all(ids)
+        # 三条约 1200 字节，超出预算时丢弃最早的一条
+        assert [entry_id for entry_id, _ in await client.xrange(key)] == ids[1:]
+        assert await main.mailbox.push(token, "message", {"message": "x" * 1000}) is None
+        # 确认后计数偏大，下一次写入重新统计，不误删仍在预算内的条目
+        await main.mailbox.remove(token, ids[1])
+        newest = await main.mailbox.push(token, "message", {"message": "x" * 380})
+        assert [entry_id for entry_id, _ in await client.xrange(key)] == [ids[2], newest]
+        assert 0 < await client.ttl(main.Mailbox.bytes_key(token)) <= 3600
+
+    run_with_redis(scenario)
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from fastapi.testclient import TestClient
+
+import main
+from conftest import HEADERS
+
+
+def is_online(client, fingerprint):
+    return client.portal.call(main.redis_client.sismember, main.ONLINE_INDEX, fingerprint)
+
+
+def test_disconnect_does_not_remove_concurrent_reconnect(redis_factory, monkeypatch):
+    fingerprint = "presence-race-device"
+    handshake_done = threading.Event()
+    resume_connect = threading.Event()
+    connect = main.ConnectionManager.connect
+
+    async def paused_connect(self, client_token, websocket, proto=1):
+        # 第二个连接已完成握手脚本（SADD），但尚未登记到本地连接表
+        if handshake_done.is_set() is False and self.local_count(client_token):
+            handshake_done.set()
+            await main.asyncio.to_thread(resume_connect.wait)
+        await connect(self, client_token, websocket, proto)
+
+    monkeypatch.setattr(main.ConnectionManager, "connect", paused_connect)
+
+    with TestClient(main.app) as client:
+        first = client.websocket_connect(f"/stream?token={fingerprint}", headers=HEADERS)
+        first.__enter__()
+
+        def reconnect():
+            with client.websocket_connect(f"/stream?token={fingerprint}", headers=HEADERS):
+                resumed.wait()
+
+        resumed = threading.Event()
+        thread = threading.Thread(target=reconnect)
+        thread.start()
+        try:
+            assert handshake_done.wait(5)
+
+            # 旧连接在新连接握手之后断开，其在线状态清理不应移除新连接
+            first.__exit__(None, None, None)
+            time.sleep(0.3)
+            resume_connect.set()
+            time.sleep(0.2)
+            assert is_online(client, fingerprint)
+        finally:
+            resume_connect.set()
+            resumed.set()
+            thread.join(5)
+        time.sleep(0.3)
+        assert not is_online(client, fingerprint)
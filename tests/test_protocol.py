@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+import main
+from conftest import FakeWebSocket, settle
+
+
+class RecordingWebSocket(FakeWebSocket):
+    """按发送顺序记录文本帧（解析为 JSON）和二进制帧"""
+
+    def __init__(self):
+        super().__init__()
+        self.frames = []
+
+    async def send_text(self, text):
+        await super().send_text(text)
+        self.frames.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        self.frames.append(bytes(data))
+
+
+def test_transfer_chunk_header():
+    v1 = main.ClientConnection(None, "t", None, proto=1)
+    v2 = main.ClientConnection(None, "t", None, proto=2)
+    assert main.transfer_chunk(v1, 7, 3, b"data", last=True) == b"data"
+    frame = main.transfer_chunk(v2, 0xFFFFFFFF, 3, b"data", last=True)
+    assert main.V2_CHUNK_HEADER.size == 12
+    assert main.V2_CHUNK_HEADER.unpack(frame[:12]) == (2, main.V2_FLAG_LAST, 0, 0xFFFFFFFF, 3)
+    assert frame[12:] == b"data"
+    assert main.V2_CHUNK_HEADER.unpack(main.transfer_chunk(v2, 1, 0, b"")[:12])[1] == 0
+    assert json.loads(main.transfer_text(v2, {"type": "binary_end"}, 9)) == {"type": "binary_end", "stream_id": 9}
+    assert "stream_id" not in json.loads(main.transfer_text(v1, {"type": "binary_end"}, 9))
+
+
+def test_v2_interleaved_transfers_reassemble_by_stream_id(monkeypatch):
+    monkeypatch.setattr(main, "BINARY_CHUNK_SIZE", 1000)
+    monkeypatch.setattr(main, "BINARY_CHUNK_ADAPTIVE", False)
+    images = {"big": bytes(range(256)) * 20, "small": b"s" * 2500}
+
+    async def scenario():
+        manager = main.ConnectionManager()
+        websocket = RecordingWebSocket()
+        await manager.connect("v2-tok", websocket, proto=2)
+        for name, data in images.items():
+            await manager.send_binary("v2-tok", data, {"filename": name, "transfer_id": name})
+        await settle(lambda: sum(isinstance(f, dict) and f.get("type") == "binary_end" for f in websocket.frames) == 2)
+        manager.disconnect("v2-tok", websocket)
+        return websocket.frames
+
+    frames = asyncio.run(scenario())
+    starts = {f["stream_id"]: f for f in frames if isinstance(f, dict) and f.get("type") == "binary_start"}
+    ends = {f["stream_id"]: f for f in frames if isinstance(f, dict) and f.get("type") == "binary_end"}
+    chunks = {stream_id: [] for stream_id in starts}
+    order = []
+    for frame in frames:
+        if isinstance(frame, bytes):
+            version, flags, reserved, stream_id, seq = main.V2_CHUNK_HEADER.unpack(frame[:12])
+            assert (version, reserved) == (2, 0)
+            assert seq == len(chunks[stream_id])
+            chunks[stream_id].append((flags, frame[12:]))
+            order.append(stream_id)
+    assert len(starts) == 2 and set(ends) == set(starts)
+    # 两个传输按块交错发送：第二个传输的首块早于第一个传输的末块
+    first, second = sorted(starts)
+    assert order.index(second) < max(i for i, stream_id in enumerate(order) if stream_id == first)
+    for stream_id, start in starts.items():
+        data = images[start["filename"]]
+        assert start["sha256"] == main.hashlib.sha256(data).hexdigest()
+        assert b"".join(chunk for _, chunk in chunks[stream_id]) == data
+        assert [flags for flags, _ in chunks[stream_id]] == [0] * (len(chunks[stream_id]) - 1) + [main.V2_FLAG_LAST]
+        assert ends[stream_id]["chunks"] == len(chunks[stream_id]) == (len(data) + 999) // 1000
+        assert ends[stream_id]["size"] == len(data)
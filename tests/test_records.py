@@ -0,0 +1,28 @@
+import json
+
+import main
+
+
+def test_corrupt_legacy_record_is_quarantined(run_with_redis):
+    async def scenario(client):
+        await client.set("fingerprint:bad", "{not json")
+        await client.set("fingerprint:list", "[1, 2]")
+        await client.set("fingerprint:good", json.dumps({"fingerprint": "good", "last_seen": "2026-10-16T12:00:00+08:00"}))
+
+        records = await main.read_records(["fingerprint:bad", "fingerprint:list", "fingerprint:good"])
+        assert records[0] is None and records[1] is None
+        assert records[2]["fingerprint"] == "good"
+        assert await client.exists("fingerprint:bad", "fingerprint:list") == 0
+        assert await client.get("quarantine:fingerprint:bad") == "{not json"
+        assert 0 < await client.ttl("quarantine:fingerprint:bad") <= main.QUARANTINE_TTL
+
+        # 迁移和索引重建都能越过隔离的记录完成
+        await client.set("fingerprint:bad2", "{still not json")
+        await main.migrate_records_to_hashes()
+        await main.rebuild_fingerprint_indexes()
+        assert await client.get(main.RECORD_LAYOUT_KEY) == main.RECORD_LAYOUT
+        assert await client.get(main.INDEX_VERSION_KEY) == main.INDEX_VERSION
+        assert await client.exists("quarantine:fingerprint:bad2") == 1
+        assert await client.zrange(main.FINGERPRINT_INDEX, 0, -1) == ["good"]
+
+    run_with_redis(scenario)
@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+import httpx
+
+import main
+
+IP_API = {"status": "success", "country": "中国", "regionName": "上海", "city": "上海"}
+IPINFO = {"country": "CN", "region": "Shanghai", "city": "Shanghai"}
+
+
+def make_client(delays=None, statuses=None, hedge_delay=0.05, deadline=1.0):
+    """按服务商主机名配置延迟和状态码，返回 (客户端, 每个主机的请求次数)"""
+    delays = delays or {}
+    statuses = statuses or {}
+    calls = {"ip-api.com": 0, "ipinfo.io": 0}
+
+    async def handler(request):
+        host = request.url.host
+        calls[host] += 1
+        await asyncio.sleep(delays.get(host, 0))
+        body = IP_API if host == "ip-api.com" else IPINFO
+        return httpx.Response(statuses.get(host, 200), json=body)
+
+    client = main.RemoteGeoClient(deadline, hedge_delay, main.TTLCache(max_size=100, ttl=60, negative_ttl=60))
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client, calls
+
+
+def test_concurrent_lookups_share_one_request():
+    async def scenario():
+        client, calls = make_client(delays={"ip-api.com": 0.02})
+        results = await asyncio.gather(*(client.lookup("1.2.3.4") for _ in range(5)))
+        await client.aclose()
+        return results, calls, client._inflight
+
+    results, calls, inflight = asyncio.run(scenario())
+    assert all(r == {"country": "中国", "region": "上海", "city": "上海"} for r in results)
+    assert calls == {"ip-api.com": 1, "ipinfo.io": 0}
+    assert inflight == {}
+
+
+def test_hedge_fires_when_first_provider_is_slow():
+    async def scenario():
+        client, calls = make_client(delays={"ip-api.com": 0.5})
+        started = time.perf_counter()
+        result = await client.lookup("1.2.3.4")
+        elapsed = time.perf_counter() - started
+        await client.aclose()
+        return result, elapsed, calls
+
+    result, elapsed, calls = asyncio.run(scenario())
+    # 首个服务商超过 hedge_delay 未返回，对冲请求先返回即胜出
+    assert result == {"country": "CN", "region": "Shanghai", "city": "Shanghai"}
+    assert calls == {"ip-api.com": 1, "ipinfo.io": 1}
+    assert elapsed < 0.3
+
+
+def test_no_hedge_when_first_provider_is_fast():
+    async def scenario():
+        client, calls = make_client(hedge_delay=0.2)
+        result = await client.lookup("1.2.3.4")
+        await client.aclose()
+        return result, calls
+
+    result, calls = asyncio.run(scenario())
+    assert result["country"] == "中国"
+    assert calls == {"ip-api.com": 1, "ipinfo.io": 0}
+
+
+def test_error_falls_through_to_next_provider():
+    async def scenario():
+        client, calls = make_client(statuses={"ip-api.com": 500}, hedge_delay=0.2)
+        result = await client.lookup("1.2.3.4")
+        await client.aclose()
+        return result, calls
+
+    result, calls = asyncio.run(scenario())
+    assert result["country"] == "CN"
+    assert calls == {"ip-api.com": 1, "ipinfo.io": 1}
+
+
+def test_failure_is_cached_negatively():
+    async def scenario():
+        client, calls = make_client(statuses={"ip-api.com": 500, "ipinfo.io": 429})
+        first = await client.lookup("1.2.3.4")
+        second = await client.lookup("1.2.3.4")
+        await client.aclose()
+        return first, second, dict(calls)
+
+    first, second, calls = asyncio.run(scenario())
+    assert first is None and second is None
+    # 第二次查询命中负缓存，不再请求服务商
+    assert calls == {"ip-api.com": 1, "ipinfo.io": 1}
+
+
+def test_deadline_bounds_lookup_when_all_providers_hang():
+    async def scenario():
+        client, calls = make_client(delays={"ip-api.com": 5, "ipinfo.io": 5}, deadline=0.2)
+        started = time.perf_counter()
+        result = await client.lookup("1.2.3.4")
+        elapsed = time.perf_counter() - started
+        await client.aclose()
+        return result, elapsed
+
+    result, elapsed = asyncio.run(scenario())
+    assert result is None
+    assert elapsed < 1.0
@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+import main
+
+
+def test_shared_session_expires_in_redis(run_with_redis, monkeypatch):
+    monkeypatch.setattr(main.manager, "cluster", True)
+
+    async def scenario(client):
+        expiry = main.now_china() + timedelta(hours=1)
+        await main.share_session("tok-a", expiry)
+        ttl = await client.ttl("session:tok-a")
+        assert 3500 < ttl <= 3600
+        assert await client.exists(main.LEGACY_SESSIONS_KEY) == 0
+
+        await main.revoke_session("tok-a")
+        assert await client.exists("session:tok-a") == 0
+
+    run_with_redis(scenario)
+
+
+def test_load_shared_sessions_migrates_legacy_hash(run_with_redis, monkeypatch):
+    monkeypatch.setattr(main.manager, "cluster", True)
+    monkeypatch.setattr(main, "active_sessions", {})
+
+    async def scenario(client):
+        now = main.now_china()
+        await client.hset(main.LEGACY_SESSIONS_KEY, mapping={
+            "live": (now + timedelta(hours=2)).isoformat(),
+            "stale": (now - timedelta(hours=2)).isoformat(),
+        })
+        await main.load_shared_sessions()
+
+        assert set(main.active_sessions) == {"live"}
+        assert await client.exists(main.LEGACY_SESSIONS_KEY) == 0
+        assert await client.exists("session:stale") == 0
+        assert 7000 < await client.ttl("session:live") <= 7200
+
+    run_with_redis(scenario)
@@ -0,0 +1,115 @@
+import asyncio
+
+import main
+from conftest import SlowWebSocket
+
+
+def test_relay_queued_behind_inflight_transfer_is_not_a_laggard(monkeypatch):
+    monkeypatch.setattr(main, "WS_SEND_TIMEOUT", 0.2)
+    monkeypatch.setattr(main, "BINARY_CHUNK_ADAPTIVE", False)
+
+    async def scenario():
+        manager = main.ConnectionManager()
+        websocket = SlowWebSocket(rate=2 * 1024 * 1024)
+        await manager.connect("relay-tok", websocket)
+        # 2 MB/s 下约 0.5 秒，超过 WS_SEND_TIMEOUT；v1 连接上中继只能排在其后
+        await manager.send_binary("relay-tok", b"x" * (1024 * 1024), {"filename": "big.jpg"})
+        relay = manager.open_stream("relay-tok", {"filename": "stream.jpg", "transfer_id": "s1"})
+        for _ in range(main.STREAM_RELAY_WINDOW * 3):
+            await relay.feed(b"y" * 16 * 1024)
+        await relay.finish()
+        for _ in range(200):
+            if any(t.get("type") == "binary_end" and t.get("transfer_id") == "s1" for t in websocket.texts):
+                break
+            await asyncio.sleep(0.01)
+        connected = "relay-tok" in manager.active_connections
+        manager.disconnect("relay-tok", websocket)
+        return connected, websocket.texts
+
+    connected, texts = asyncio.run(scenario())
+    assert connected
+    end = [t for t in texts if t.get("type") == "binary_end" and t.get("transfer_id") == "s1"]
+    assert end and end[0]["chunks"] == main.STREAM_RELAY_WINDOW * 3
+
+
+def test_stream_upload_rejects_malformed_content_length(redis_factory, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    async def get_client_token(app_token, *args):
+        return "stream-tok"
+
+    monkeypatch.setattr(main, "get_client_token", get_client_token)
+    with TestClient(main.app) as client:
+        response = client.post(
+            "/message/image/stream?token=x",
+            content=b"abc",
+            headers={"content-type": "image/png", "content-length": "abc"}
+        )
+    assert response.status_code == 400
+
+
+def test_stream_upload_bounds_remote_only_buffer(redis_factory, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    async def get_client_token(app_token, *args):
+        return "stream-remote-tok"
+
+    async def connection_count(client_token):
+        return 1
+
+    published = []
+
+    async def broadcast_binary(client_token, data, metadata=None):
+        published.append(len(data))
+
+    monkeypatch.setattr(main, "get_client_token", get_client_token)
+    monkeypatch.setattr(main.manager, "connection_count", connection_count)
+    monkeypatch.setattr(main.manager, "broadcast_binary", broadcast_binary)
+    monkeypatch.setattr(main, "STREAM_REMOTE_MAX_BYTES", 1024)
+
+    def chunks():
+        for _ in range(8):
+            yield b"z" * 512
+
+    with TestClient(main.app) as client:
+        small = client.post("/message/image/stream?token=x", content=b"z" * 1000, headers={"content-type": "image/png"})
+        declared = client.post("/message/image/stream?token=x", content=b"z" * 4096, headers={"content-type": "image/png"})
+        chunked = client.post("/message/image/stream?token=x", content=chunks(), headers={"content-type": "image/png"})
+    assert small.status_code == 200
+    assert declared.status_code == 413
+    assert chunked.status_code == 413
+    assert published == [1000]
+
+
+def test_stream_upload_aborts_relay_on_read_error(redis_factory, monkeypatch):
+    import pytest
+    from fastapi.testclient import TestClient
+
+    async def get_client_token(app_token, *args):
+        return "stream-error-tok"
+
+    async def connection_count(client_token):
+        return 1
+
+    relays = []
+
+    def open_stream(client_token, metadata, size=0):
+        relay = main.StreamRelay(metadata, size)
+        relays.append(relay)
+        return relay
+
+    async def broken_stream(self):
+        yield b"y" * main.BINARY_CHUNK_SIZE
+        raise RuntimeError("读取请求体失败")
+
+    monkeypatch.setattr(main, "get_client_token", get_client_token)
+    monkeypatch.setattr(main.manager, "connection_count", connection_count)
+    monkeypatch.setattr(main.manager, "local_count", lambda client_token: 1)
+    monkeypatch.setattr(main.manager, "open_stream", open_stream)
+    monkeypatch.setattr(main.Request, "stream", broken_stream)
+
+    with TestClient(main.app) as client:
+        with pytest.raises(RuntimeError):
+            client.post("/message/image/stream?token=x", content=b"y", headers={"content-type": "image/png"})
+    # 非客户端断开的读取错误也不能让已收到的部分当作完整图片发出
+    assert relays and relays[0].finished and relays[0].aborted
@@ -0,0 +1,89 @@
+import asyncio
+import io
+import random
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def make_image(size, fmt):
+    """生成填充随机像素的测试图片（压缩率低，转码前后的大小差异稳定）"""
+    img = Image.new("RGB", size)
+    rng = random.Random(0)
+    img.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(size[0] * size[1])])
+    out = io.BytesIO()
+    img.save(out, format=fmt)
+    return out.getvalue()
+
+
+def decode(data):
+    with Image.open(io.BytesIO(data)) as img:
+        return img.format, img.size
+
+
+@pytest.mark.parametrize("size, max_dim, target, expected", [
+    ((800, 400), 200, None, ("PNG", (200, 100))),     # 只缩放，保持原格式
+    ((400, 800), 200, "JPEG", ("JPEG", (100, 200))),  # 缩放并转格式
+    ((300, 300), 0, "WEBP", ("WEBP", (300, 300))),    # 只转格式，结果更小
+])
+def test_transcode_image_resizes_and_picks_format(size, max_dim, target, expected):
+    result = main.transcode_image(make_image(size, "PNG"), max_dim, target, 80)
+    assert result is not None
+    data, content_type, width, height = result
+    assert decode(data) == expected
+    assert content_type == f"image/{expected[0].lower()}"
+    assert (width, height) == expected[1]
+
+
+@pytest.mark.parametrize("max_dim, target", [
+    (0, "JPEG"),     # 格式相同且无需缩放
+    (1000, None),    # 已小于 max_dim，保持原格式
+    (0, "PNG"),      # 只转格式但结果更大
+])
+def test_transcode_image_skips_when_unchanged_or_larger(max_dim, target):
+    assert main.transcode_image(make_image((64, 64), "JPEG"), max_dim, target, 80) is None
+
+
+def test_transcode_image_converts_alpha_for_jpeg():
+    img = Image.new("RGBA", (600, 600), (0, 0, 255, 128))
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    data, content_type, _, _ = main.transcode_image(out.getvalue(), 100, "JPEG", 80)
+    assert content_type == "image/jpeg"
+    assert decode(data) == ("JPEG", (100, 100))
+
+
+def test_maybe_transcode_image(monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_TRANSCODE_WORKERS", 1)
+    monkeypatch.setattr(main, "IMAGE_TRANSCODE_MIN_BYTES", 1024)
+    monkeypatch.setattr(main, "_transcode_pool", None)
+    large = make_image((400, 400), "PNG")
+    small = make_image((8, 8), "PNG")
+
+    async def scenario():
+        try:
+            untouched = await main.maybe_transcode_image(large, "image/png", "a.png", 0, None, 85)
+            converted = await main.maybe_transcode_image(large, "image/png", "shot.png", 100, "jpg", 80)
+            tiny = await main.maybe_transcode_image(small, "image/png", "b.png", 100, "jpeg", 80)
+            with pytest.raises(HTTPException) as excinfo:
+                await main.maybe_transcode_image(large, "image/png", "c.png", 0, "gif", 80)
+            return untouched, converted, tiny, excinfo.value.status_code
+        finally:
+            main._transcode_pool.shutdown()
+
+    untouched, converted, tiny, status = asyncio.run(scenario())
+    assert untouched == (large, "image/png", "a.png", None)
+
+    data, content_type, filename, info = converted
+    assert decode(data) == ("JPEG", (100, 100))
+    assert (content_type, filename) == ("image/jpeg", "shot.jpg")
+    assert info["original_size"] == len(large) and info["size"] == len(data)
+    assert info["saved"] == len(large) - len(data) and info["skipped"] is None
+
+    assert tiny[:3] == (small, "image/png", "b.png")
+    assert tiny[3]["skipped"] == "图片已足够小"
+    assert status == 400
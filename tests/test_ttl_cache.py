@@ -0,0 +1,48 @@
+import main
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_negative_entries_expire_sooner(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    cache = main.TTLCache(max_size=10, ttl=60, negative_ttl=5)
+    cache.set("found", "client-token")
+    cache.set("missing", None)
+    # 负缓存条目命中时返回 None，而不是 MISS
+    assert cache.get("missing") is None
+    clock.now += 5
+    assert cache.get("missing") is main.TTLCache.MISS
+    assert cache.get("found") == "client-token"
+    clock.now += 55
+    assert cache.get("found") is main.TTLCache.MISS
+    assert cache.stats()["size"] == 0
+
+
+def test_explicit_ttl_overrides_default(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    cache = main.TTLCache(max_size=10, ttl=60, negative_ttl=5)
+    cache.set("missing", None, ttl=30)
+    clock.now += 29
+    assert cache.get("missing") is None
+    clock.now += 1
+    assert cache.get("missing") is main.TTLCache.MISS
+
+
+def test_lru_eviction_and_stats():
+    cache = main.TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # a 刚被访问过，淘汰最久未用的 b
+    cache.set("c", 3)
+    assert cache.get("b") is main.TTLCache.MISS
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "max_size": 2, "hits": 3, "misses": 1, "hit_rate": 0.75}
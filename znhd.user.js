@@ -1467,6 +1467,74 @@ async function copyBase64ImageToClipboard(text) {
     }
 }
 
+// v2 二进制块头部长度（与服务端 V2_CHUNK_HEADER 一致）
+const V2_CHUNK_HEADER_SIZE = 12;
+
+// 已接收图片缓存（sha256 -> Blob），服务端对重复图片只发送 binary_ref
+const IMAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024;
+const imageCache = new Map();
+let imageCacheBytes = 0;
+
+function cacheImageBlob(sha256, blob) {
+    if (!sha256 || blob.size > IMAGE_CACHE_MAX_BYTES) return;
+    const old = imageCache.get(sha256);
+    if (old) {
+        imageCache.delete(sha256);
+        imageCacheBytes -= old.size;
+    }
+    imageCache.set(sha256, blob);
+    imageCacheBytes += blob.size;
+    // Map 按插入顺序迭代，最早插入的即最久未使用
+    for (const [key, value] of imageCache) {
+        if (imageCacheBytes <= IMAGE_CACHE_MAX_BYTES) break;
+        imageCache.delete(key);
+        imageCacheBytes -= value.size;
+    }
+}
+
+function getCachedImageBlob(sha256) {
+    const blob = imageCache.get(sha256);
+    if (blob) {
+        imageCache.delete(sha256);
+        imageCache.set(sha256, blob);
+    }
+    return blob;
+}
+
+// 合并已接收的二进制块并复制到剪贴板
+async function deliverBinaryImage(transfer) {
+    const elapsed = Date.now() - transfer.startTime;
+    console.log(`[webhook] 二进制图片接收完成, 耗时: ${elapsed}ms, 共 ${transfer.dataChunks.length} 个数据块, 实际接收 ${formatSize(transfer.receivedSize)}/${formatSize(transfer.totalSize)}`);
+
+    // 检查数据完整性
+    if (transfer.receivedSize !== transfer.totalSize) {
+        console.log(`[webhook] ⚠️ 数据不完整: 期望 ${formatSize(transfer.totalSize)}, 实际收到 ${formatSize(transfer.receivedSize)}, 丢失 ${formatSize(transfer.totalSize - transfer.receivedSize)}`);
+    }
+
+    // 合并所有数据块
+    if (transfer.dataChunks.length > 0) {
+        const blob = new Blob(transfer.dataChunks, { type: transfer.content_type });
+        console.log(`[webhook] 合并后的Blob大小: ${formatSize(blob.size)}, 类型: ${blob.type}`);
+        cacheImageBlob(transfer.sha256, blob);
+
+        // 转换为 Base64 并复制到剪贴板
+        const base64 = await blobToBase64(blob);
+        console.log(`[webhook] Base64长度: ${base64.length}, 前缀: ${base64.substring(0, 50)}...`);
+        const copied = await copyBase64ImageToClipboard(base64);
+
+        if (copied) {
+            CAT_UI.Message.success(`webhook消息：图片已复制到剪贴板 (${transfer.filename}, ${formatSize(transfer.totalSize)})`, 'success');
+            addLog(`webhook消息：图片已复制到剪贴板 - ${transfer.filename} (${formatSize(transfer.totalSize)})`, 'success');
+        } else {
+            CAT_UI.Message.warning('webhook消息：图片复制失败', 'warning');
+            addLog(`webhook消息：图片复制失败 - ${transfer.filename}`, 'warning');
+        }
+    } else {
+        CAT_UI.Message.warning(`webhook消息：未收到任何图片数据 - ${transfer.filename}`, 'warning');
+        addLog(`webhook消息：未收到任何图片数据 - ${transfer.filename}`, 'warning');
+    }
+}
+
 function connectwebhookWebSocket(webhookUrl, webhookToken) {
     if (webhookReconnectTimer) {
         clearTimeout(webhookReconnectTimer);
@@ -1501,7 +1569,10 @@ function connectwebhookWebSocket(webhookUrl, webhookToken) {
         const urlObj = new URL('/stream', webhookUrl.replace(/\/$/, ''));
         urlObj.protocol = urlObj.protocol === 'https:' ? 'wss:' : 'ws:';
         urlObj.searchParams.set('token', webhookToken);
+        // 请求 v2 协议（多路复用二进制传输），旧服务端会忽略该参数并按 v1 发送
+        urlObj.searchParams.set('proto', '2');
         webhookWS = new window.WebSocket(urlObj.href);
+        webhookWS.binaryType = 'arraybuffer';
         console.log('[webhook] 尝试连接: ', urlObj.href);
     } catch (e) {
         console.error('[webhook] 地址格式错误:', e);
@@ -1513,89 +1584,156 @@ function connectwebhookWebSocket(webhookUrl, webhookToken) {
         addLog('webhook 推送监听已启动', 'success');
     };
     // 二进制数据传输状态管理
+    // v1：同一时间只有一个传输；v2：按 stream_id 区分多个交错的传输
     let binaryTransfer = null;
+    let protoVersion = 1;
+    const v2Transfers = new Map();
+
+    const createTransfer = (msg) => ({
+        transfer_id: msg.transfer_id,
+        mailbox_id: msg.mailbox_id,
+        sha256: msg.sha256,
+        filename: msg.filename,
+        content_type: msg.content_type || 'image/jpeg',
+        totalSize: msg.size,
+        receivedSize: 0,
+        dataChunks: [],
+        startTime: Date.now()
+    });
+
+    // 确认已处理的离线消息，服务端从信箱中删除，重连后不再补发（v1 连接由服务端自动确认）
+    const ackMailbox = (ws, mailboxId) => {
+        if (mailboxId && protoVersion >= 2 && ws.readyState === WebSocket.OPEN) {
+            ws.send(JSON.stringify({ type: 'ack', mailbox_id: mailboxId }));
+        }
+    };
 
     webhookWS.onmessage = async (event) => {
         try {
             // 判断是否为二进制数据
-            if (event.data instanceof Blob) {
+            if (event.data instanceof ArrayBuffer || event.data instanceof Blob) {
+                if (protoVersion >= 2 && event.data instanceof ArrayBuffer) {
+                    // v2 块头部: 版本(1) | 标志(1) | 保留(2) | stream_id(4) | 块序号(4)，大端
+                    const view = new DataView(event.data);
+                    const version = view.getUint8(0);
+                    const streamId = view.getUint32(4);
+                    const seq = view.getUint32(8);
+                    const transfer = v2Transfers.get(streamId);
+                    if (version !== 2 || !transfer) {
+                        console.log(`[webhook] ⚠️ 收到意外的二进制数据块, 版本: ${version}, stream_id: ${streamId}`);
+                        return;
+                    }
+                    transfer.dataChunks[seq] = new Uint8Array(event.data, V2_CHUNK_HEADER_SIZE);
+                    transfer.receivedSize += event.data.byteLength - V2_CHUNK_HEADER_SIZE;
+                    return;
+                }
                 if (binaryTransfer && binaryTransfer.dataChunks) {
                     // 收集二进制数据块
+                    const chunkSize = event.data instanceof Blob ? event.data.size : event.data.byteLength;
                     binaryTransfer.dataChunks.push(event.data);
-                    binaryTransfer.receivedSize += event.data.size;
+                    binaryTransfer.receivedSize += chunkSize;
                     console.log(`[webhook] 收到二进制数据块 ${binaryTransfer.dataChunks.length}, 已接收 ${formatSize(binaryTransfer.receivedSize)}/${formatSize(binaryTransfer.totalSize)}, 进度: ${((binaryTransfer.receivedSize / binaryTransfer.totalSize) * 100).toFixed(1)}%`);
                 } else {
-                    console.log('[webhook] ⚠️ 收到意外的二进制数据，没有活跃的传输任务，Blob大小:', event.data.size);
+                    console.log('[webhook] ⚠️ 收到意外的二进制数据，没有活跃的传输任务，大小:', event.data.size ?? event.data.byteLength);
                 }
                 return;
             }
 
             // 解析 JSON 消息
             const msg = JSON.parse(event.data);
-            const { id, title, message: text, priority, date, type, data_type, filename, size, content_type, transfer_id } = msg;
+            const { id, title, message: text, priority, date, type, data_type, filename, size, content_type, transfer_id, stream_id } = msg;
             console.log('[webhook] 收到消息:', msg);
 
+            // 离线期间暂存的消息：文本和图片引用收到即完整，binary_start 在 binary_end 后确认
+            if (msg.mailbox_id && (type === 'message' || type === 'binary_ref')) {
+                ackMailbox(event.target, msg.mailbox_id);
+            }
+
+            // 协议协商结果
+            if (type === 'hello') {
+                protoVersion = msg.proto || 1;
+                console.log(`[webhook] 协议版本: v${protoVersion}, 最大并发传输: ${msg.max_streams}`);
+                return;
+            }
+
             // 处理二进制传输开始
             if (type === 'binary_start' && data_type === 'image') {
+                console.log(`[webhook] 开始接收二进制图片: ${filename}, 大小: ${formatSize(size)}, content_type: ${content_type}`);
+                if (stream_id !== undefined) {
+                    v2Transfers.set(stream_id, createTransfer(msg));
+                    return;
+                }
                 // 检查是否有未完成的传输
                 if (binaryTransfer && binaryTransfer.dataChunks.length > 0) {
                     console.log(`[webhook] ⚠️ 检测到未完成的传输 ${binaryTransfer.transfer_id}，被新传输 ${transfer_id} 覆盖`);
                 }
-                console.log(`[webhook] 开始接收二进制图片: ${filename}, 大小: ${formatSize(size)}, content_type: ${content_type}`);
-                binaryTransfer = {
-                    transfer_id: transfer_id,
-                    filename: filename,
-                    content_type: content_type || 'image/jpeg',
-                    totalSize: size,
-                    receivedSize: 0,
-                    dataChunks: [],
-                    startTime: Date.now()
-                };
+                binaryTransfer = createTransfer(msg);
                 return;
             }
 
-            // 处理二进制传输结束
-            if (type === 'binary_end') {
-                if (!binaryTransfer) {
-                    console.log(`[webhook] ⚠️ 收到 binary_end 但没有活跃的传输任务，transfer_id: ${transfer_id}`);
-                    return;
-                }
-                if (binaryTransfer.transfer_id !== transfer_id) {
-                    console.log(`[webhook] ⚠️ transfer_id 不匹配: 期望 ${binaryTransfer.transfer_id}, 收到 ${transfer_id}`);
+            // 重复图片：服务端只发送引用，从本地缓存取图片
+            if (type === 'binary_ref') {
+                const blob = getCachedImageBlob(msg.sha256);
+                if (!blob) {
+                    console.log(`[webhook] 本地缓存未命中, 请求补发: ${filename}, sha256: ${msg.sha256}`);
+                    event.target.send(JSON.stringify({
+                        type: 'cache_miss',
+                        sha256: msg.sha256,
+                        transfer_id: transfer_id,
+                        filename: filename
+                    }));
                     return;
                 }
+                console.log(`[webhook] 本地缓存命中: ${filename}, ${formatSize(blob.size)}`);
+                const transfer = createTransfer(msg);
+                transfer.dataChunks = [blob];
+                transfer.receivedSize = blob.size;
+                await deliverBinaryImage(transfer);
+                return;
+            }
 
-                const elapsed = Date.now() - binaryTransfer.startTime;
-                console.log(`[webhook] 二进制图片接收完成, 耗时: ${elapsed}ms, 共 ${binaryTransfer.dataChunks.length} 个数据块, 实际接收 ${formatSize(binaryTransfer.receivedSize)}/${formatSize(binaryTransfer.totalSize)}`);
-
-                // 检查数据完整性
-                if (binaryTransfer.receivedSize !== binaryTransfer.totalSize) {
-                    console.log(`[webhook] ⚠️ 数据不完整: 期望 ${formatSize(binaryTransfer.totalSize)}, 实际收到 ${formatSize(binaryTransfer.receivedSize)}, 丢失 ${formatSize(binaryTransfer.totalSize - binaryTransfer.receivedSize)}`);
-                }
+            if (type === 'binary_error') {
+                console.log(`[webhook] ⚠️ 图片补发失败: ${msg.reason}, transfer_id: ${transfer_id}`);
+                addLog(`webhook消息：图片补发失败 (${msg.reason})`, 'warning');
+                return;
+            }
 
-                // 合并所有数据块
-                if (binaryTransfer.dataChunks.length > 0) {
-                    const blob = new Blob(binaryTransfer.dataChunks, { type: binaryTransfer.content_type });
-                    console.log(`[webhook] 合并后的Blob大小: ${formatSize(blob.size)}, 类型: ${blob.type}`);
-
-                    // 转换为 Base64 并复制到剪贴板
-                    const base64 = await blobToBase64(blob);
-                    console.log(`[webhook] Base64长度: ${base64.length}, 前缀: ${base64.substring(0, 50)}...`);
-                    const copied = await copyBase64ImageToClipboard(base64);
-
-                    if (copied) {
-                        CAT_UI.Message.success(`webhook消息：图片已复制到剪贴板 (${binaryTransfer.filename}, ${formatSize(binaryTransfer.totalSize)})`, 'success');
-                        addLog(`webhook消息：图片已复制到剪贴板 - ${binaryTransfer.filename} (${formatSize(binaryTransfer.totalSize)})`, 'success');
-                    } else {
-                        CAT_UI.Message.warning('webhook消息：图片复制失败', 'warning');
-                        addLog(`webhook消息：图片复制失败 - ${binaryTransfer.filename}`, 'warning');
+            // 处理二进制传输结束
+            if (type === 'binary_end') {
+                let transfer;
+                if (stream_id !== undefined) {
+                    transfer = v2Transfers.get(stream_id);
+                    v2Transfers.delete(stream_id);
+                    if (!transfer) {
+                        console.log(`[webhook] ⚠️ 收到 binary_end 但没有对应的传输，stream_id: ${stream_id}`);
+                        return;
                     }
                 } else {
-                    CAT_UI.Message.warning(`webhook消息：未收到任何图片数据 - ${binaryTransfer.filename}`, 'warning');
-                    addLog(`webhook消息：未收到任何图片数据 - ${binaryTransfer.filename}`, 'warning');
+                    if (!binaryTransfer) {
+                        console.log(`[webhook] ⚠️ 收到 binary_end 但没有活跃的传输任务，transfer_id: ${transfer_id}`);
+                        return;
+                    }
+                    if (binaryTransfer.transfer_id !== transfer_id) {
+                        console.log(`[webhook] ⚠️ transfer_id 不匹配: 期望 ${binaryTransfer.transfer_id}, 收到 ${transfer_id}`);
+                        return;
+                    }
+                    // 先取出当前传输，后续 await 期间可能开始下一个传输
+                    transfer = binaryTransfer;
+                    binaryTransfer = null;
                 }
 
-                binaryTransfer = null;
+                // 流式上传时 binary_start 中的大小可能未知（0），以 binary_end 为准
+                if (!transfer.totalSize && size) {
+                    transfer.totalSize = size;
+                }
+                // v2 按块序号存放，缺失的块留空
+                const missing = msg.chunks - transfer.dataChunks.filter(Boolean).length;
+                if (stream_id !== undefined && missing > 0) {
+                    console.log(`[webhook] ⚠️ stream_id ${stream_id} 缺少 ${missing} 个数据块`);
+                }
+                transfer.dataChunks = transfer.dataChunks.filter(Boolean);
+                ackMailbox(event.target, transfer.mailbox_id);
+                await deliverBinaryImage(transfer);
                 return;
             }
 